@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+"""
+Load benchmark for Formsender
+
+Drives create_app() the way Gunicorn's sync workers do: each of --concurrency
+worker processes builds its own app and sends its share of the requests
+through it back to back. RT REST2 and reCAPTCHA siteverify are replaced by
+local stand-in servers with configurable latency, so no real ticket is
+created and no network is needed.
+
+For every scenario it reports throughput, p50/p95/p99 latency, the memory
+allocated per request (traced with tracemalloc in a separate pass so that
+tracing does not slow the timed run) and the peak RSS of the workers. Results
+are written as JSON so runs can be compared between releases:
+
+    python bench.py --output before.json
+    python bench.py --output after.json --baseline before.json
+"""
+import argparse
+import datetime
+import gc
+import http.server
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from io import BytesIO
+
+from werkzeug.test import EnvironBuilder
+
+# conf.py reads these at import; the benchmark never talks to a real service
+os.environ.setdefault('TOKEN', 'bench-token')
+os.environ.setdefault('RECAPTCHA_SECRET', 'bench-secret')
+os.environ.setdefault('RT_TOKEN', 'bench-rt-token')
+
+SCENARIOS = ('urlencoded', 'multipart', 'spam')
+RESULTS_VERSION = 1
+
+
+class WorkerFailed(RuntimeError):
+    """A worker process died or didn't finish in time"""
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers like RT REST2 or reCAPTCHA siteverify after server.latency
+
+    Keeps connections alive so the app's connection reuse is exercised, with
+    Nagle off so replies aren't held back waiting for delayed ACKs.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.reply(200, {})
+
+    def do_POST(self):
+        self.read_body()
+        time.sleep(self.server.latency)
+        if self.server.kind == 'rt':
+            with self.server.lock:
+                self.server.count += 1
+                ticket_id = self.server.count
+            self.reply(201, {'id': str(ticket_id), 'type': 'ticket'})
+        else:
+            with self.server.lock:
+                self.server.count += 1
+            self.reply(200, {'success': True})
+
+    def read_body(self):
+        """Reads and discards the request body, plain or chunked"""
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                self.rfile.read(size + 2)
+                if not size:
+                    break
+        else:
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stand_in(kind, latency):
+    """Starts a stand-in server on a free local port in a daemon thread"""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                             StandInHandler)
+    server.daemon_threads = True
+    server.kind = kind
+    server.latency = latency
+    server.count = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def create_bench_app():
+    """
+    Returns an app built by create_app() for benchmarking
+
+    The rate limits are lifted so they don't reject the load, and logs go
+    to /dev/null so they cost what they cost without flooding the terminal.
+    """
+    # Imported late: conf.py reads RT_URL and RECAPTCHA_URL, set by main()
+    import conf
+    import request_handler
+    conf.CEILING = 10 ** 9
+    conf.CLIENT_RATE = 10 ** 9
+    conf.CLIENT_BURST = 10 ** 9
+    app = request_handler.create_app(with_static=False)
+    # Records still go through the log queue and are formatted by its
+    # listener, which writes them to /dev/null instead of stdout
+    listener = next(handler.listener for handler in app.logger.handlers
+                    if isinstance(handler, request_handler.LogQueueHandler))
+    output = logging.StreamHandler(open(os.devnull, 'w'))
+    output.setFormatter(listener.handlers[0].formatter)
+    listener.handlers = (output,)
+    return app
+
+
+def build_environ(scenario, number, attachment):
+    """Returns the WSGI environ of submission number of scenario"""
+    import conf
+    # Every submission is unique, or the duplicate check would reject it
+    data = {'name': 'Bench Mark', 'email': 'bench@osuosl.org',
+            'last_name': '', 'token': conf.TOKEN,
+            'redirect': 'http://www.example.com',
+            'g-recaptcha-response': 'bench',
+            'message': 'Benchmark submission %d from %d' % (number,
+                                                            os.getpid())}
+    if scenario == 'spam':
+        # Bots fill in the honeypot field
+        data['last_name'] = 'Cheap watches'
+    elif scenario == 'multipart':
+        data['attachment'] = (BytesIO(attachment), 'bench.bin',
+                              'application/octet-stream')
+    builder = EnvironBuilder(method='POST', path='/', data=data,
+                             environ_base={'REMOTE_ADDR': '192.0.2.1'})
+    try:
+        return builder.get_environ()
+    finally:
+        builder.close()
+
+
+def call_app(app, environ):
+    """Sends environ through app and returns the response status code"""
+    status = []
+
+    def start_response(status_line, headers, exc_info=None):
+        status.append(int(status_line.split()[0]))
+
+    body = app(environ, start_response)
+    try:
+        for _ in body:
+            pass
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    return status[0]
+
+
+def run_worker(scenario, requests, attachment, start, results, timeout):
+    """
+    Worker process: builds an app, reports that it is ready and, once start
+    is set, times requests through it
+    """
+    app = create_bench_app()
+    # Build the environs up front so only the app is timed
+    environs = [build_environ(scenario, number, attachment)
+                for number in range(requests)]
+    # One warm-up request opens the connections to the stand-ins
+    call_app(app, build_environ(scenario, -1, attachment))
+    latencies = []
+    errors = 0
+    results.put('ready')
+    if not start.wait(timeout):
+        return
+    for environ in environs:
+        started = time.perf_counter()
+        try:
+            if call_app(app, environ) != 302:
+                errors += 1
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - started)
+    results.put({'latencies': latencies, 'errors': errors,
+                 'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+
+def collect(workers, results, timeout):
+    """
+    Returns what each worker puts in results next, raising WorkerFailed if
+    one of them dies or they take longer than timeout seconds in all
+    """
+    deadline = time.monotonic() + timeout
+    outcomes = []
+    while len(outcomes) < len(workers):
+        try:
+            outcomes.append(results.get(timeout=0.5))
+            continue
+        except queue.Empty:
+            pass
+        codes = [worker.exitcode for worker in workers]
+        if any(code not in (None, 0) for code in codes):
+            raise WorkerFailed('a worker died (exit codes: %s)' % codes)
+        if time.monotonic() > deadline:
+            raise WorkerFailed('the workers took more than %ss' % timeout)
+    return outcomes
+
+
+def percentile(ordered, fraction):
+    """Returns the nearest-rank percentile of the sorted list ordered"""
+    if not ordered:
+        return None
+    rank = max(math.ceil(fraction * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def measure_allocations(scenario, samples, attachment):
+    """
+    Returns the memory allocated per request in this process
+
+    peak_bytes is the mean of the largest amount of memory a request had
+    allocated at once, and retained_bytes/retained_blocks the memory still
+    held after all samples, divided by the number of samples.
+    """
+    app = create_bench_app()
+    environs = [build_environ(scenario, number, attachment)
+                for number in range(samples + 1)]
+    call_app(app, environs.pop())
+    gc.collect()
+    tracemalloc.start()
+    peaks = []
+    before, _ = tracemalloc.get_traced_memory()
+    blocks = sys.getallocatedblocks()
+    for environ in environs:
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        call_app(app, environ)
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    blocks = sys.getallocatedblocks() - blocks
+    tracemalloc.stop()
+    return {'peak_bytes': sum(peaks) / len(peaks),
+            'retained_bytes': (after - before) / len(peaks),
+            'retained_blocks': blocks / len(peaks)}
+
+
+def run_scenario(scenario, args, stand_ins):
+    """Runs scenario in worker processes and returns its results"""
+    context = multiprocessing.get_context('spawn')
+    attachment = os.urandom(args.attachment_size)
+    start = context.Event()
+    results = context.Queue()
+    shares = [args.requests // args.concurrency] * args.concurrency
+    for worker in range(args.requests % args.concurrency):
+        shares[worker] += 1
+    workers = [context.Process(target=run_worker, args=(
+        scenario, share, attachment, start, results, args.timeout))
+        for share in shares]
+    for worker in workers:
+        worker.start()
+    counts = {kind: server.count for kind, server in stand_ins.items()}
+    try:
+        collect(workers, results, args.timeout)
+        start.set()
+        started = time.perf_counter()
+        outcomes = collect(workers, results, args.timeout)
+        elapsed = time.perf_counter() - started
+        for worker in workers:
+            worker.join(args.timeout)
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+    # The warm-up request of each worker is counted here too
+    calls = {kind: server.count - counts[kind]
+             for kind, server in stand_ins.items()}
+
+    latencies = sorted(latency for outcome in outcomes
+                       for latency in outcome['latencies'])
+    rss = [outcome['rss'] * 1024 for outcome in outcomes]
+    return {
+        'requests': len(latencies),
+        'errors': sum(outcome['errors'] for outcome in outcomes),
+        'elapsed_seconds': elapsed,
+        'throughput_rps': len(latencies) / elapsed,
+        'latency_seconds': {
+            'mean': sum(latencies) / len(latencies),
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1],
+        },
+        'allocations': measure_allocations(scenario, args.alloc_samples,
+                                           attachment),
+        'worker_rss_bytes': {'max': max(rss), 'mean': sum(rss) / len(rss)},
+        'stand_in_calls': calls,
+    }
+
+
+def compare(results, baseline):
+    """Prints how results changed against the baseline results"""
+    print('\nChange against baseline (%s):' % baseline['started'])
+    for scenario, result in sorted(results['scenarios'].items()):
+        old = baseline['scenarios'].get(scenario)
+        if old is None:
+            continue
+        changes = [
+            ('throughput', result['throughput_rps'], old['throughput_rps']),
+            ('p50', result['latency_seconds']['p50'],
+             old['latency_seconds']['p50']),
+            ('p99', result['latency_seconds']['p99'],
+             old['latency_seconds']['p99']),
+            ('peak bytes', result['allocations']['peak_bytes'],
+             old['allocations']['peak_bytes']),
+            ('rss', result['worker_rss_bytes']['max'],
+             old['worker_rss_bytes']['max']),
+        ]
+        print('  %-10s ' % scenario + ', '.join(
+            '%s %+.1f%%' % (name, (new - was) / was * 100)
+            for name, new, was in changes if was))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='scenario to run, may be repeated '
+                             '(default: all)')
+    parser.add_argument('--requests', type=int, default=400,
+                        help='requests per scenario (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='worker processes, like gunicorn -w '
+                             '(default: %(default)s)')
+    parser.add_argument('--rt-latency', type=float, default=0.05,
+                        help='seconds the RT stand-in takes to answer '
+                             '(default: %(default)s)')
+    parser.add_argument('--recaptcha-latency', type=float, default=0.05,
+                        help='seconds the reCAPTCHA stand-in takes to answer '
+                             '(default: %(default)s)')
+    parser.add_argument('--attachment-size', type=int, default=256 * 1024,
+                        help='bytes attached in the multipart scenario '
+                             '(default: %(default)s)')
+    parser.add_argument('--alloc-samples', type=int, default=50,
+                        help='requests traced to measure allocations '
+                             '(default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds to wait for the workers of a scenario '
+                             'before giving up (default: %(default)s)')
+    parser.add_argument('--output', help='write the results as JSON here')
+    parser.add_argument('--baseline',
+                        help='JSON results of an earlier run to compare to')
+    args = parser.parse_args(argv)
+    if args.requests < args.concurrency or args.concurrency < 1:
+        parser.error('--requests must be at least --concurrency, which must '
+                     'be at least 1')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stand_ins = {'rt': start_stand_in('rt', args.rt_latency),
+                 'recaptcha': start_stand_in('recaptcha',
+                                             args.recaptcha_latency)}
+    # Read by conf.py in this process and the spawned workers
+    os.environ['RT_URL'] = 'http://127.0.0.1:%d/REST/2.0/' % (
+        stand_ins['rt'].server_address[1])
+    os.environ['RECAPTCHA_URL'] = 'http://127.0.0.1:%d/siteverify' % (
+        stand_ins['recaptcha'].server_address[1])
+    os.environ.setdefault('DELIVERY_MODE', 'inline')
+
+    results = {
+        'version': RESULTS_VERSION,
+        'started': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {name: getattr(args, name) for name in (
+            'requests', 'concurrency', 'rt_latency', 'recaptcha_latency',
+            'attachment_size', 'alloc_samples')},
+        'scenarios': {},
+    }
+    print('%-10s %8s %7s %9s %9s %9s %10s %9s' % (
+        'scenario', 'req/s', 'errors', 'p50 ms', 'p95 ms', 'p99 ms',
+        'peak KiB', 'RSS MiB'))
+    for scenario in args.scenario or SCENARIOS:
+        result = run_scenario(scenario, args, stand_ins)
+        results['scenarios'][scenario] = result
+        latency = result['latency_seconds']
+        print('%-10s %8.1f %7d %9.2f %9.2f %9.2f %10.1f %9.1f' % (
+            scenario, result['throughput_rps'], result['errors'],
+            latency['p50'] * 1000, latency['p95'] * 1000,
+            latency['p99'] * 1000,
+            result['allocations']['peak_bytes'] / 1024,
+            result['worker_rss_bytes']['max'] / 1024 / 1024))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(results, json.load(baseline))
+    return results
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except WorkerFailed as error:
+        sys.exit('bench.py: %s' % error)
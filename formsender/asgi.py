@@ -0,0 +1,19 @@
+from request_handler import create_asgi_app, SettingsReloader
+import conf
+
+if getattr(conf, 'SENTRY_URI', None):
+    import sentry_sdk
+
+    sentry_sdk.init(dsn=conf.SENTRY_URI)
+
+# Serve with an ASGI server, e.g. uvicorn formsender.asgi:application. RT
+# connections are opened in the background from lifespan startup when
+# RT_PRECONNECT is set.
+application = create_asgi_app()
+
+# Reload conf.py when it changes or the process gets SIGHUP
+if getattr(conf, 'SETTINGS_POLL_INTERVAL', None):
+    reloader = SettingsReloader(application, conf.__file__,
+                                conf.SETTINGS_POLL_INTERVAL)
+    reloader.listen()
+    reloader.start()
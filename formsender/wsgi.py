@@ -1,4 +1,4 @@
-from request_handler import create_app
+from request_handler import create_app, SettingsReloader
 import conf
 
 if hasattr('conf', 'SENTRY_URI'):
@@ -10,3 +10,17 @@ if hasattr('conf', 'SENTRY_URI'):
 
 else:
     application = create_app()
+
+# Gunicorn imports this module once per worker, so this warms the worker's RT
+# connections in the background, without holding up its boot if RT is down
+if getattr(conf, 'RT_PRECONNECT', False):
+    application.rt_clients.preconnect_in_background(application.logger)
+
+# Reload conf.py into this worker when it changes or the worker (not
+# Gunicorn's master, which restarts its workers) gets SIGHUP, keeping its
+# connections and tables warm
+if getattr(conf, 'SETTINGS_POLL_INTERVAL', None):
+    reloader = SettingsReloader(application, conf.__file__,
+                                conf.SETTINGS_POLL_INTERVAL)
+    reloader.listen()
+    reloader.start()
@@ -14,20 +14,50 @@ import six.moves.urllib.request
 import six.moves.urllib.parse
 import six.moves.urllib.error
 import hashlib
-from urllib.parse import urlencode
-from urllib.request import urlopen
+import httpx
+import httpx2
 from werkzeug.wrappers import Request, Response
 from werkzeug.routing import Map, Rule
-from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import (HTTPException, ClientDisconnected, Forbidden,
+                                 MethodNotAllowed, NotFound,
+                                 RequestEntityTooLarge, ServiceUnavailable,
+                                 TooManyRequests, UnsupportedMediaType)
 from werkzeug.middleware.shared_data import SharedDataMiddleware
-from jinja2 import Environment, FileSystemLoader
-from validate_email import validate_email
-from datetime import datetime
+from werkzeug.formparser import FormDataParser, default_stream_factory
+from werkzeug.sansio.multipart import (Data, Epilogue, Field, File,
+                                       MultipartDecoder, NeedData)
+from jinja2 import Environment, FileSystemLoader, TemplateNotFound
+from validate_email import ATEXT, VALID_ADDRESS_REGEXP
+from datetime import datetime, timezone
 import logging
 import logging.handlers
 import conf
 import time
 import json
+import sqlite3
+import threading
+import contextlib
+import contextvars
+import tomllib
+import re
+import types
+import inspect
+import asyncio
+import queue
+import random
+import tempfile
+import collections
+import collections.abc
+import atexit
+import fcntl
+import mmap
+import struct
+import socket
+import signal
+import ipaddress
+import math
+import unicodedata
+import rt.exceptions
 import rt.rest2
 
 
@@ -36,21 +66,120 @@ class Forms:
     This class listens for a form submission, checks that the data is valid, and
     sends the form data in a formatted message to the email specified in conf.py
     """
-    def __init__(self, controller, logger):
+    # The parts of the app built from settings, and the settings each is
+    # built from; apply_settings rebuilds those whose settings changed. The
+    # validators come after mx, which they depend on.
+    RELOADABLE = {
+        'rt_clients': ('URL', 'RT_TOKEN', 'RT_POOL_SIZE', 'RT_TIMEOUT'),
+        'limiter': ('RT_CONCURRENCY_LIMIT', 'RT_CONCURRENCY_MIN',
+                    'RT_CONCURRENCY_MAX', 'RT_LATENCY_TARGET'),
+        'rt_breaker': ('RT_BREAKER_FAILURES', 'RT_BREAKER_PROBE_INTERVAL'),
+        'retry_policy': ('RT_RETRY_ATTEMPTS', 'RT_RETRY_BASE_DELAY',
+                         'RT_RETRY_MAX_DELAY', 'RT_RETRY_BUDGET'),
+        'tenants': ('TENANTS', 'RT_POOL_SIZE', 'ASGI_RT_POOL_SIZE',
+                    'RT_TIMEOUT', 'RT_CONCURRENCY_LIMIT', 'RT_CONCURRENCY_MIN',
+                    'RT_CONCURRENCY_MAX', 'RT_LATENCY_TARGET',
+                    'RT_BREAKER_FAILURES', 'RT_BREAKER_PROBE_INTERVAL'),
+        'recaptcha': ('RECAPTCHA_SECRET', 'RECAPTCHA_URL',
+                      'RECAPTCHA_CONNECT_TIMEOUT', 'RECAPTCHA_READ_TIMEOUT',
+                      'RECAPTCHA_FAIL_OPEN', 'RECAPTCHA_BREAKER_FAILURES',
+                      'RECAPTCHA_BREAKER_PROBE_INTERVAL'),
+        'mx': ('CHECK_MX', 'MX_NAMESERVER', 'MX_TIMEOUT', 'MX_CACHE_SIZE',
+               'MX_NEGATIVE_TTL', 'MX_MAX_TTL', 'MX_FAIL_OPEN'),
+        'validators': ('CHECK_MX', 'VALIDATOR_ORDER', 'VALIDATORS_DISABLED'),
+        'admission': ('BLOCKED_NETWORKS', 'MAX_CONTENT_LENGTH',
+                      'ADMISSION_DRAIN_LIMIT'),
+        'uploads': ('ATTACHMENT_MEMORY_BUDGET',),
+        'parse_budget': ('MAX_FORM_PARTS', 'MAX_FIELD_SIZE', 'MAX_FILES',
+                         'MAX_FILE_SIZE'),
+        'forms': ('FORMS_DIR',),
+        'layouts': ('BODY_LAYOUT_CACHE_SIZE',),
+        'emails': ('EMAIL_CACHE_SIZE',),
+    }
+    # Settings applied in place, keeping what the app holds: the
+    # Controllers' tables (see Controller.retune) and the log level
+    TUNABLE = ('CLIENT_RATE', 'CLIENT_BURST', 'CLIENT_TABLE_SIZE',
+               'DUPLICATE_CHECK_TIME', 'DUPLICATE_MAX_ENTRIES',
+               'NEAR_DUPLICATE_DISTANCE', 'LOG_LEVEL')
+    # Settings read when the worker starts, which a reload can't change
+    RESTART = ('STATE_BACKEND', 'SHARED_STATE_PATH', 'DELIVERY_MODE',
+               'RT_BREAKER_FALLBACK', 'RT_LEDGER_SIZE',
+               'SPOOL_PATH', 'SPOOL_MAX_ATTEMPTS', 'SPOOL_RETRY_DELAY',
+               'SPOOL_POLL_INTERVAL', 'METRICS_DIR', 'METRICS_FLUSH_INTERVAL',
+               'LOG_FORMAT', 'LOG_REDACT', 'LOG_SAMPLE_RATES',
+               'TRACE_SAMPLE_RATE', 'TRACE_EXPORT', 'TRACE_PATH',
+               'TRACE_ENDPOINT', 'TRACE_QUEUE_SIZE', 'SENTRY_URI', 'HOST',
+               'PORT', 'SETTINGS_POLL_INTERVAL')
+
+    def __init__(self, controller, logger, spool=None, rt_clients=None,
+                 recaptcha=None, uploads=None, metrics=None, tracer=None,
+                 forms=None, mx=None, validators=None, admission=None,
+                 parse_budget=None, tenants=None, limiter=None,
+                 rt_breaker=None, fallback_spool=None, retry_policy=None,
+                 ledger=None):
         # Sets up the path to the template files
         template_path = os.path.join(os.path.dirname(__file__), 'templates')
+        self.logger = logger
         self.controller = controller
+        self.metrics = metrics or Metrics()
+        # Long-lived RT clients so each ticket reuses a warm connection
+        self.rt_clients = rt_clients or self.build_rt_clients()
+        # Sheds form posts while too many tickets are in flight to RT
+        self.limiter = limiter or self.build_limiter()
+        # Stops calling RT while it keeps failing
+        self.rt_breaker = rt_breaker or self.build_rt_breaker()
+        # Retries failed creates, and remembers the tickets created so a
+        # retried create isn't repeated
+        self.retry_policy = retry_policy or self.build_retry_policy()
+        self.ledger = ledger or TicketLedger(
+            getattr(conf, 'RT_LEDGER_SIZE', 10000))
+        # Other RT instances served by this app, with their own clients,
+        # rate limits and duplicates; the above are for everything else
+        self.tenants = tenants or self.build_tenants()
+        self.recaptcha = recaptcha or self.build_recaptcha()
+        # Checks that email domains accept mail, with CHECK_MX on
+        self.mx = mx or self.build_mx()
+        # The checks a submission goes through, cheapest first
+        self.validator_list = validators or VALIDATORS
+        self.validators = self.build_validators(self.mx)
+        # Turns form posts away from their headers, before reading the body
+        self.admission = admission or self.build_admission()
+        # Caps how much of the uploaded files this worker keeps in memory
+        self.uploads = uploads or self.build_uploads()
+        # Caps the parts, fields and files a form is parsed into
+        self.parse_budget = parse_budget or self.build_parse_budget()
+        # The version of the settings the app was last built from, and the
+        # lock reloads take turns on
+        self.settings_version = 1
+        self.settings_lock = threading.Lock()
+        self.metrics.collect(self.collect_metrics)
+        # Samples requests for tracing; self.trace is the current request's
+        self.tracer = tracer or Tracer()
+        self.trace = NULL_TRACE
+        # When a spool is given, tickets are queued on disk and created in RT
+        # by a background SpoolWorker instead of during the request
+        self.spool = spool
+        # Otherwise, with a fallback spool, tickets are queued there while
+        # RT's CircuitBreaker is open
+        self.fallback_spool = fallback_spool
+        # Server-side form definitions, served at /forms/<form_id>
+        self.forms = forms or self.build_forms()
         self.error = None
         # Creates jinja template environment
         self.jinja_env = Environment(loader=FileSystemLoader(template_path),
                                      autoescape=True)
+        # Ticket bodies are plain text, so their templates aren't escaped
+        self.body_env = self.jinja_env.overlay(autoescape=False)
+        self.layouts = self.build_layouts()
+        self.emails = self.build_emails()
         # When the browser is pointed at the root of the website, call
         # on_form_page
         self.url_map = Map([
             Rule('/', endpoint='form_page'),
+            Rule('/forms/<form_id>', endpoint='form_page'),
             Rule('/server-status', endpoint='server_status'),
+            Rule('/metrics', endpoint='metrics'),
             ])
-        self.logger = logger
 
     def dispatch_request(self, request):
         """Evaluates request to decide what happens"""
@@ -66,130 +195,682 @@ class Forms:
         """
         Starts wsgi_app by creating a Request and Response based on the Request
         """
-        request = Request(environ)
+        started = time.perf_counter()
+        request = self.create_request(environ)
+        try:
+            error = self.admit(request)
+            if error is not None:
+                response = self.turn_away(request, error)
+            else:
+                response = self.dispatch_request(request)
+        finally:
+            # Release the uploaded files (and their share of the budget); any
+            # ticket that needs them has been created or spooled by now
+            request.close()
+        self.record_response(response, started)
+        return response(environ, start_response)
+
+    def create_request(self, environ):
+        """Returns the FormRequest for environ"""
+        self.tenants.mount(environ)
+        request = FormRequest(environ)
+        request.upload_budget = self.uploads
+        request.parse_budget = self.parse_budget
         # Cap the total request body so file uploads can't exhaust memory. An
         # oversized body raises RequestEntityTooLarge (413) when form/files are
         # parsed, which dispatch_request returns as an HTTP error.
         request.max_content_length = getattr(conf, 'MAX_CONTENT_LENGTH',
                                              10 * 1024 * 1024)
-        response = self.dispatch_request(request)
-        return response(environ, start_response)
+        return request
+
+    def admit(self, request):
+        """
+        Returns the HTTP error to answer a request for a form with before its
+        body is read (see Admission), or None to handle it
+        """
+        try:
+            endpoint, values = self.url_map.bind_to_environ(
+                request.environ).match()
+        except HTTPException:
+            return None  # dispatch_request answers it
+        if endpoint != 'form_page':
+            return None
+        client = client_address(request)
+        tenant = self.tenants.route(request, values.get('form_id'))
+        if tenant is None:
+            controller, limiter, breaker = (self.controller, self.limiter,
+                                            self.rt_breaker)
+        else:
+            controller, limiter, breaker = (tenant.controller, tenant.limiter,
+                                            tenant.rt_breaker)
+        # Spooled tickets don't wait on RT, so there is nothing to shed, and
+        # with a fallback spool they are spooled while RT is down
+        if self.spool is None:
+            error = self.admission.check(
+                request, client, controller, limiter,
+                breaker if self.fallback_spool is None else None)
+        else:
+            error = self.admission.check(request, client, controller)
+        if error is not None:
+            self.metrics.inc('formsender_admission_rejections_total',
+                             status=error.code)
+            self.logger.debug('formsender: turned away %(client)s: '
+                              '%(error)s', {'client': client, 'error': error},
+                              extra={'event': 'admission'})
+        return error
+
+    def turn_away(self, request, error):
+        """
+        Returns the response to error. A small unread body is read and
+        dropped so the connection can be reused; otherwise the connection is
+        closed instead of reading it.
+        """
+        response = error.get_response(request.environ)
+        length = request.content_length
+        if length and length <= self.admission.drain_limit:
+            while request.stream.read(64 * 1024):
+                pass
+        elif length or 'chunked' in request.headers.get('Transfer-Encoding',
+                                                        ''):
+            response.headers['Connection'] = 'close'
+        return response
+
+    def record_response(self, response, started):
+        """Records the metrics of a response to a request started then"""
+        status = getattr(response, 'status_code', None) or response.code
+        if status >= 400:
+            self.metrics.inc('formsender_http_errors_total', status=status)
+        self.metrics.observe('formsender_request_duration_seconds',
+                             time.perf_counter() - started)
+        self.metrics.maybe_flush()
 
     def __call__(self, environ, start_response):
         return self.wsgi_app(environ, start_response)
 
     def on_server_status(self, request):
         """
-        Returns an OK on a GET. This is to support health checks by any
-        monitoring software on this application
+        Returns an OK on a GET, followed by the state of the circuit breaker
+        of each upstream, one "<name>: <state>" per line. This is to support
+        health checks by any monitoring software on this application
         """
         if request.method == 'GET':
-            return Response('OK', status=200)
+            lines = ['OK'] + ['{}: {}'.format(breaker.name, breaker.state)
+                              for breaker in self.breakers()]
+            return Response('\n'.join(lines), status=200)
 
         # Do not process anything else
         return Response('', status=400)
 
-    def on_form_page(self, request):
+    def on_metrics(self, request):
         """
-        Checks for valid form data, creates an RT ticket, returns a redirect
+        Returns the metrics of every worker in the Prometheus text format on
+        a GET
         """
-        # Increment rate because we received a request
-        self.controller.increment_rate()
-        self.error = None
-        error_number = self.are_fields_invalid(request)
+        if request.method == 'GET':
+            return Response(self.metrics.render(), status=200,
+                            content_type='text/plain; version=0.0.4')
+
+        # Do not process anything else
+        return Response('', status=400)
+
+    def breakers(self):
+        """Returns the CircuitBreakers of RT (and each tenant's) and reCAPTCHA"""
+        return ([self.rt_breaker] +
+                [tenant.rt_breaker for tenant in self.tenants] +
+                [self.recaptcha.breaker])
+
+    def collect_metrics(self):
+        """
+        Returns gauges for the sizes of the Controller's tables (and each
+        tenant's, as <table>:<tenant>), the body layout cache and the email
+        verdict cache, for the RT concurrency limits (each tenant's labelled
+        with its name), the circuit breakers and the settings version
+        """
+        gauges = []
+        tables = dict(self.controller.stats(), layouts=self.layouts.stats(),
+                      emails=self.emails.stats())
+        for tenant in self.tenants:
+            for table, stats in tenant.controller.stats().items():
+                tables['{}:{}'.format(table, tenant.name)] = stats
+        if self.mx is not None:
+            tables['mx'] = self.mx.stats()
+        for table, stats in tables.items():
+            for key, value in stats.items():
+                gauges.append(('formsender_table_' + key, {'table': table},
+                               value))
+        limiters = [({}, self.limiter)] + [
+            ({'tenant': tenant.name}, tenant.limiter)
+            for tenant in self.tenants]
+        for labels, limiter in limiters:
+            for key, value in limiter.stats().items():
+                gauges.append(('formsender_rt_concurrency_' + key, labels,
+                               value))
+        for breaker in self.breakers():
+            for key, value in breaker.stats().items():
+                gauges.append(('formsender_circuit_' + key,
+                               {'circuit': breaker.name}, value))
+        gauges.append(('formsender_settings_version', {},
+                       self.settings_version))
+        return gauges
+
+    def build_rt_clients(self):
+        """Returns the RTClientPool for the app's own RT"""
+        return RTClientPool(getattr(conf, 'RT_POOL_SIZE', 2),
+                            getattr(conf, 'RT_TIMEOUT', 20))
+
+    def build_limiter(self):
+        """Returns the ConcurrencyLimiter for the app's own RT"""
+        return create_concurrency_limiter()
+
+    def build_rt_breaker(self):
+        """Returns the CircuitBreaker for the app's own RT"""
+        return create_circuit_breaker('rt', 'RT', self.metrics)
+
+    def build_retry_policy(self):
+        """Returns the RetryPolicy for creating tickets in RT"""
+        return RetryPolicy(getattr(conf, 'RT_RETRY_ATTEMPTS', 3),
+                           getattr(conf, 'RT_RETRY_BASE_DELAY', 0.5),
+                           getattr(conf, 'RT_RETRY_MAX_DELAY', 5),
+                           getattr(conf, 'RT_RETRY_BUDGET', 10))
+
+    def build_tenants(self):
+        """
+        Returns the TenantTable of TENANTS. Tenants the app already has keep
+        their Controllers.
+        """
+        return TenantTable.from_settings(getattr(conf, 'TENANTS', {}),
+                                         getattr(self, 'tenants', ()),
+                                         self.metrics)
+
+    def build_recaptcha(self, verifier_class=None):
+        """Returns the app's reCAPTCHA verifier"""
+        return (verifier_class or RecaptchaVerifier)(
+            conf.RECAPTCHA_SECRET,
+            getattr(conf, 'RECAPTCHA_URL', RecaptchaVerifier.URL),
+            getattr(conf, 'RECAPTCHA_CONNECT_TIMEOUT', 2),
+            getattr(conf, 'RECAPTCHA_READ_TIMEOUT', 3),
+            getattr(conf, 'RECAPTCHA_FAIL_OPEN', False), self.logger,
+            breaker=create_circuit_breaker('recaptcha', 'RECAPTCHA',
+                                           self.metrics))
+
+    def build_mx(self, resolver_class=None):
+        """Returns the app's MXResolver with CHECK_MX on, otherwise None"""
+        if not getattr(conf, 'CHECK_MX', False):
+            return None
+        return (resolver_class or MXResolver)(
+            getattr(conf, 'MX_NAMESERVER', None),
+            getattr(conf, 'MX_TIMEOUT', 1),
+            getattr(conf, 'MX_CACHE_SIZE', 10000),
+            getattr(conf, 'MX_NEGATIVE_TTL', 300),
+            getattr(conf, 'MX_MAX_TTL', 86400),
+            getattr(conf, 'MX_FAIL_OPEN', True), self.logger)
+
+    def build_validators(self, mx):
+        """
+        Returns the ValidatorPipeline of the app's validators, without the
+        mx check when mx (the MXResolver) is None
+        """
+        return ValidatorPipeline(
+            [validator for validator in self.validator_list
+             if validator.name != 'mx' or mx is not None],
+            getattr(conf, 'VALIDATOR_ORDER', ()),
+            getattr(conf, 'VALIDATORS_DISABLED', ()))
+
+    def build_admission(self):
+        """Returns the app's Admission"""
+        return Admission(self.controller)
+
+    def build_uploads(self):
+        """Returns the app's UploadBudget"""
+        return UploadBudget(getattr(conf, 'ATTACHMENT_MEMORY_BUDGET',
+                                    1024 * 1024))
+
+    def build_parse_budget(self):
+        """Returns the ParseBudget of forms without limits of their own"""
+        return ParseBudget(getattr(conf, 'MAX_FORM_PARTS', 1000),
+                           getattr(conf, 'MAX_FIELD_SIZE', 500 * 1024),
+                           getattr(conf, 'MAX_FILES', 10),
+                           getattr(conf, 'MAX_FILE_SIZE', None))
+
+    def build_forms(self):
+        """Returns the FormRegistry of the definitions in FORMS_DIR"""
+        if not getattr(conf, 'FORMS_DIR', None):
+            return FormRegistry()
+        forms = FormRegistry.load(conf.FORMS_DIR)
+        self.logger.info('formsender: loaded %s form definitions from %s',
+                         len(forms), conf.FORMS_DIR)
+        return forms
+
+    def build_layouts(self):
+        """Returns the app's BodyLayouts cache"""
+        return BodyLayouts(getattr(conf, 'BODY_LAYOUT_CACHE_SIZE', 256))
+
+    def build_emails(self):
+        """Returns the app's EmailValidator"""
+        return EmailValidator(getattr(conf, 'EMAIL_CACHE_SIZE', 4096))
+
+    def reload_settings(self, path):
+        """
+        Loads the settings file at path as the next version of the settings
+        and applies it (see apply_settings). Returns True if it was applied;
+        a file that doesn't load or isn't valid is logged and left out.
+        """
+        try:
+            settings = Settings.load(path, self.settings_version + 1)
+            self.apply_settings(settings)
+        except Exception as error:
+            self.metrics.inc('formsender_settings_reloads_total',
+                             result='rejected')
+            self.logger.error('formsender: kept settings version %s, %s is '
+                              'not valid: %s', self.settings_version, path,
+                              error)
+            return False
+        self.metrics.inc('formsender_settings_reloads_total',
+                         result='applied')
+        return True
+
+    def apply_settings(self, settings):
+        """
+        Makes settings (a Settings) the current conf, rebuilding only the
+        parts of the app whose settings changed (see RELOADABLE) and tuning
+        the Controllers' tables in place, so the rest stays warm. Raises
+        ValueError, leaving the current settings and app in place, when
+        settings don't validate or a part can't be built from them. Returns
+        the names of the settings that changed.
+        """
+        global conf
+        with self.settings_lock:
+            settings.validate()
+            changed = settings.changed(conf)
+            previous = conf
+            conf = settings
+            try:
+                parts = {}
+                for name, names in self.RELOADABLE.items():
+                    if changed.intersection(names):
+                        parts[name] = (
+                            self.build_validators(parts.get('mx', self.mx))
+                            if name == 'validators'
+                            else getattr(self, 'build_' + name)())
+            except Exception as error:
+                conf = previous
+                raise ValueError(str(error))
+            # Add the mx check after its resolver, remove it before
+            mx = parts.get('mx', self.mx)
+            for name in sorted(parts, key=lambda name: (
+                    1 if name != 'validators' else 2 if mx is not None else 0)):
+                setattr(self, name, parts[name])
+            if changed.intersection(self.TUNABLE):
+                for controller in [self.controller] + [
+                        tenant.controller for tenant in self.tenants]:
+                    controller.retune()
+                self.logger.setLevel(getattr(conf, 'LOG_LEVEL', 'DEBUG'))
+            self.settings_version = settings.version
+        self.logger.info('formsender: applied settings version %s, '
+                         'changed %s', settings.version,
+                         ', '.join(sorted(changed)) or 'nothing')
+        for name in sorted(changed.intersection(self.RESTART)):
+            self.logger.warning('formsender: %s changes when the worker '
+                                'restarts', name)
+        return changed
+
+    def on_form_page(self, request, form_id=None):
+        """
+        Checks for valid form data, creates an RT ticket, returns a redirect.
+        form_id names the FormDefinition of forms posted to /forms/<form_id>.
+        """
+        definition = None if form_id is None else self.forms.get(form_id)
+        tenant = self.tenants.route(request, form_id)
+        self.trace = self.tracer.start()
+        try:
+            response = self.handle_form(request, definition, tenant)
+        finally:
+            self.trace.finish()
+        if self.trace.sampled:
+            response.headers['Server-Timing'] = self.trace.server_timing()
+            response.headers['X-Request-ID'] = self.trace.trace_id
+        return response
+
+    def handle_form(self, request, definition=None, tenant=None):
+        """Validates the form and creates the ticket or an error redirect"""
+        try:
+            submission = self.start_form(request, definition, tenant)
+        except FormTooLarge as error:
+            return self.form_too_large(request, error)
+        error_number = self.are_fields_invalid(submission)
         if request.method == 'POST' and error_number:
             # Error was found
             return self.handle_error(request, error_number)
         elif request.method == 'POST':
             # No errors
-            return self.handle_no_error(request)
+            try:
+                return self.handle_no_error(submission)
+            except Exception:
+                # Neither delivered nor spooled, so it may be sent again
+                self.undo_checks(self.validators, submission)
+                raise
         else:
             # Renders error message locally if sent GET request
             self.logger.error('formsender: server received unhandled GET '
                               'request, expected POST request')
             return self.error_redirect()
 
-    def are_fields_invalid(self, request):
-        """
-        If a field in the request is invalid, sets the error message and returns
-        the error number, returns False if fields are valid
-        """
-        # Sends request to each error function and returns first error it sees
-        if not is_valid_email(request):
-            self.error = 'Invalid Email'
-            error_number = 1
-            invalid_option = 'email'
-        elif not validate_name(request):
-            self.error = 'Invalid Name'
-            error_number = 2
-            invalid_option = 'name'
-        elif (not (is_hidden_field_empty(request) and
-                   is_valid_token(request)) or
-                not (is_valid_fields_to_join(request))):
-            self.error = 'Improper Form Submission'
-            error_number = 3
-            invalid_option = 'name'
-        elif self.controller.is_rate_violation():
-            self.error = 'Too Many Requests'
-            error_number = 4
-            invalid_option = 'name'
-        elif self.controller.is_duplicate(create_msg(request)):
-            self.error = 'Duplicate Request'
-            error_number = 5
-            invalid_option = 'name'
-        elif not is_valid_recaptcha(request):
-            self.error = 'Invalid Recaptcha'
-            error_number = 6
-            invalid_option = 'name'
-        else:
-            # If nothing above is true, there is no error
-            return False
-        # There is an error if it got this far
-        self.logger.warning('formsender: received %s: %s from %s',
-                            self.error,
-                            request.form[invalid_option],
-                            request.form['email'])
+    def start_form(self, request, definition=None, tenant=None):
+        """
+        Parses the form into a Submission, which every later step shares, and
+        counts it towards the rate limits (of its tenant, if it has one). A
+        definition's limits replace those of the app's ParseBudget.
+        """
+        if definition is not None and definition.limits:
+            request.parse_budget = self.parse_budget.replace(
+                **definition.limits)
+        with self.trace.span('parse'):
+            submission = Submission.from_request(request, definition, tenant)
+        # Increment rate because we received a request
+        self.controller_of(submission).increment_rate(submission.client)
+        self.error = None
+        return submission
+
+    def form_too_large(self, request, error):
+        """
+        Counts and logs a form that went over its ParseBudget. Returns an
+        error redirect if the form's redirect field was parsed before it did,
+        otherwise raises the 413.
+        """
+        self.metrics.inc('formsender_rejections_total', error=7)
+        self.logger.warning('formsender: received Form Too Large: %(limit)s '
+                            'from %(client)s',
+                            {'limit': error.limit,
+                             'client': client_address(request)})
+        if 'redirect' not in request.form:
+            raise error
+        self.error = 'Form Too Large'
+        return self.handle_error(request, 7)
+
+    def controller_of(self, submission):
+        """Returns the Controller of the submission's tenant"""
+        if submission.tenant is None:
+            return self.controller
+        return submission.tenant.controller
+
+    def tenant_of(self, ticket_args):
+        """
+        Returns the Tenant that create_ticket_args named in ticket_args (None
+        for this app's own RT), and ticket_args without it
+        """
+        if 'tenant' not in ticket_args:
+            return None, ticket_args
+        ticket_args = dict(ticket_args)
+        return self.tenants.get(ticket_args.pop('tenant')), ticket_args
+
+    def check(self, name, check, *args):
+        """Calls check(*args) in a trace span called name"""
+        with self.trace.span(name):
+            return check(*args)
+
+    def are_fields_invalid(self, submission):
+        """
+        If a field in the submission is invalid, sets the error message and
+        returns the error number, returns False if fields are valid
+        """
+        with self.metrics.timer('formsender_validation_duration_seconds'):
+            error_number = self.find_invalid_field(submission)
+        if error_number:
+            self.metrics.inc('formsender_rejections_total',
+                             error=error_number)
+        return error_number
+
+    def find_invalid_field(self, submission):
+        """
+        Runs the validators in order, sets the error message and returns the
+        error number of the first that fails, or False
+        """
+        passed = []
+        for validator in self.validators:
+            with self.metrics.timer('formsender_validator_duration_seconds',
+                                    validator=validator.name):
+                valid = self.check(validator.name, validator.check, self,
+                                   submission)
+            if not valid:
+                self.undo_checks(passed, submission)
+                return self.reject_by(validator, submission)
+            passed.append(validator)
+        return False
+
+    def undo_checks(self, validators, submission):
+        """Takes back what the validators recorded of the submission"""
+        for validator in validators:
+            if validator.undo is not None:
+                validator.undo(self, submission)
+
+    def reject_by(self, validator, submission):
+        """Counts a rejection by validator, returns reject's error number"""
+        self.metrics.inc('formsender_validator_rejections_total',
+                         validator=validator.name)
+        return self.reject(submission, validator.error_number,
+                           validator.error, validator.invalid_option)
+
+    def reject(self, submission, error_number, error, invalid_option='name'):
+        """Sets and logs the error message, returns error_number"""
+        self.error = error
+        self.logger.warning('formsender: received %(error)s: %(value)s from '
+                            '%(email)s',
+                            {'error': error,
+                             'value': submission.form[invalid_option],
+                             'email': submission.form['email']})
         return error_number
 
-    def handle_no_error(self, request):
+    def is_valid_recaptcha(self, submission):
+        """Timed is_valid_recaptcha using this app's verifier"""
+        with self.metrics.timer('formsender_recaptcha_duration_seconds'):
+            return is_valid_recaptcha(submission, self.recaptcha)
+
+    def is_deliverable(self, submission):
+        """
+        Checks the MX records of the submitted email's domain with this
+        app's MXResolver; True if the address has no plain domain to look
+        up. With an AsyncMXResolver, returns a coroutine to await instead.
+        """
+        domain = email_domain(submission.form['email'])
+        if domain is None:
+            return True
+        return self.mx.is_deliverable(domain)
+
+    def handle_no_error(self, submission):
         """
-        Creates a message and an RT ticket when there is no error, then
+        Creates an RT ticket from the submission when there is no error, then
         redirects to the provided redirect url
         """
-        message = create_msg(request)
+        message = submission.fields
         if message:
-            self.logger.debug('formsender: name is: %s', message['name'])
-            self.logger.debug('formsender: creating ticket from: %s',
-                              message['email'])
-            # The following are optional fields, so first check that they exist
-            # in the message
-            if 'send_to' in message and message['send_to']:
-                self.logger.debug('formsender: ticket queue: %s',
-                                  message['send_to'])
-            # Should log full request
-            self.logger.debug('formsender message: %s', message)
-
-            attachments = extract_attachments(request)
-            for attachment in attachments:
-                self.logger.debug('formsender: attaching file: %s',
-                                  attachment.file_name)
-            custom_fields, cf_sources = extract_custom_fields(request)
-            if custom_fields:
-                self.logger.debug('formsender: custom fields: %s',
-                                  list(custom_fields))
-            send_ticket(format_message(message, cf_sources),
-                        set_mail_subject(message),
-                        send_to_address(message), message['email'],
-                        attachments, custom_fields)
-            redirect_url = message['redirect']
-            return werkzeug.utils.redirect(redirect_url, code=302)
+            ticket_args = self.create_ticket_args(submission)
+            if self.spool is not None:
+                item_id = self.check('spool', self.spool.enqueue, ticket_args)
+                self.logger.debug('formsender: spooled ticket as item %s',
+                                  item_id)
+            else:
+                try:
+                    self.check('rt', self.deliver, ticket_args)
+                except CircuitOpen:
+                    if self.fallback_spool is None:
+                        raise
+                    item_id = self.check('spool', self.fallback_spool.enqueue,
+                                         ticket_args)
+                    self.logger.warning('formsender: RT is unavailable, '
+                                        'spooled ticket as item %s', item_id)
+            return self.redirect(message['redirect'])
         else:
             return self.error_redirect()
 
+    def create_ticket_args(self, submission):
+        """Returns the create_ticket arguments for a valid submission"""
+        message = submission.fields
+        # Fields are passed as mappings (formatted, redacted and sampled per
+        # event by the logging pipeline, see create_logger); message is
+        # immutable, so it is logged without a copy
+        ticket = {'event': 'ticket'}
+        self.logger.debug('formsender: name is: %(name)s', message,
+                          extra=ticket)
+        self.logger.debug('formsender: creating ticket from: %(email)s',
+                          message, extra=ticket)
+        # The following are optional fields, so first check that they exist
+        # in the message
+        if 'send_to' in message and message['send_to']:
+            self.logger.debug('formsender: ticket queue: %(send_to)s',
+                              message, extra=ticket)
+        # Should log full request
+        self.logger.debug('formsender message: %(message)s',
+                          {'message': message}, extra={'event': 'message'})
+
+        for attachment in submission.attachments:
+            self.logger.debug('formsender: attaching file: %(file_name)s',
+                              {'file_name': attachment.file_name},
+                              extra={'event': 'attachment'})
+            self.metrics.inc('formsender_attachment_bytes_total',
+                             attachment.size)
+        if submission.custom_fields:
+            self.logger.debug('formsender: custom fields: %(custom_fields)s',
+                              {'custom_fields': list(submission.custom_fields)},
+                              extra={'event': 'custom_fields'})
+        body = self.check('format_message', self.format_body, submission)
+        key = idempotency_key(submission)
+        custom_fields = dict(submission.custom_fields)
+        field = getattr(conf, 'RT_IDEMPOTENCY_FIELD', None)
+        if field:
+            custom_fields[field] = key
+        ticket_args = build_ticket_args(body, submission.subject(),
+                                        submission.queue(), message['email'],
+                                        list(submission.attachments),
+                                        custom_fields)
+        # Spooled along with the ticket, so every attempt to create it
+        # shares the key
+        ticket_args['idempotency_key'] = key
+        if submission.tenant is not None:
+            # Tells deliver which RT to use, spooled along with the ticket
+            ticket_args['tenant'] = submission.tenant.name
+        return ticket_args
+
+    def deliver(self, ticket_args):
+        """
+        Creates a ticket in RT (its tenant's, if it has one) using a pooled
+        client, returns its ID. A ticket already created under the same
+        idempotency key isn't created again, and failed creates are retried
+        (see retry). Raises CircuitOpen while RT's CircuitBreaker is open.
+        """
+        tenant, ticket_args = self.tenant_of(ticket_args)
+        owner = self if tenant is None else tenant
+        ticket_args = dict(ticket_args)
+        key = ticket_args.pop('idempotency_key', None)
+        ticket_id = self.ledger.get(key)
+        if ticket_id is not None:
+            self.metrics.inc('formsender_rt_idempotent_hits_total',
+                             source='ledger')
+            return ticket_id
+        delays = self.retry_policy.delays(self.retry_policy.clock())
+        uncertain = False
+        while True:
+            try:
+                if uncertain:
+                    ticket_id = self.find_ticket(owner, key)
+                if ticket_id is None:
+                    with owner.rt_breaker.call(RT_REFUSALS), \
+                            self.metrics.timer(
+                                'formsender_send_ticket_duration_seconds'), \
+                            owner.limiter.track(), \
+                            owner.rt_clients.client() as tracker:
+                        ticket_id = deliver_ticket(ticket_args, tracker)
+                break
+            except Exception as error:
+                kind, delay = self.retry(error, key, delays)
+            uncertain = uncertain or kind == 'unknown'
+            time.sleep(delay)
+        self.ledger.record(key, ticket_id)
+        return ticket_id
+
+    def retry(self, error, key, delays):
+        """
+        Returns the kind of failure (see retry_kind) and the delay before
+        retrying the create that raised error, or re-raises it: if retrying
+        won't help, delays (from RetryPolicy.delays) are used up, or the
+        ticket may have been created and there is no RT_IDEMPOTENCY_FIELD to
+        look it up by key.
+        """
+        kind = retry_kind(error.__cause__
+                          if isinstance(error, ConnectionError) else error)
+        if kind == 'unknown' and not (
+                key and getattr(conf, 'RT_IDEMPOTENCY_FIELD', None)):
+            kind = None
+        delay = None if kind is None else next(delays, None)
+        if delay is None:
+            raise error
+        self.metrics.inc('formsender_rt_retries_total', kind=kind)
+        self.logger.warning('formsender: creating ticket failed (%s), '
+                            'retrying in %.2fs: %s', kind, delay, error)
+        return kind, delay
+
+    def idempotency_query(self, key):
+        """Returns the TicketSQL that finds the ticket created under key"""
+        return "'CF.{%s}' = '%s'" % (conf.RT_IDEMPOTENCY_FIELD, key)
+
+    def find_ticket(self, owner, key):
+        """
+        Returns the ID of the ticket created in owner's RT under key, or
+        None
+        """
+        with owner.rt_breaker.call(RT_REFUSALS), \
+                owner.rt_clients.client() as tracker:
+            for ticket in tracker.search(
+                    raw_query=self.idempotency_query(key)):
+                return self.found_ticket(ticket)
+        return None
+
+    def found_ticket(self, ticket):
+        """Returns the ID of a ticket found by find_ticket"""
+        self.metrics.inc('formsender_rt_idempotent_hits_total', source='rt')
+        self.logger.warning('formsender: ticket %s was created despite the '
+                            'failure, not creating it again', ticket['id'])
+        return int(ticket['id'])
+
     def handle_error(self, request, error_number):
         """Creates error url and redirects with error query"""
         error_url = create_error_url(error_number, self.error, request)
-        return werkzeug.utils.redirect(error_url, code=302)
+        return self.redirect(error_url)
+
+    def format_body(self, submission):
+        """
+        Returns the ticket body of a submission: its body_template rendered,
+        if the form names one, otherwise the format_message layout
+        """
+        message = submission.fields
+        template_name = message.get('body_template')
+        if template_name:
+            try:
+                return self.render_body_template(template_name, submission)
+            except TemplateNotFound:
+                self.logger.warning('formsender: no body template %s, using '
+                                    'the default layout', template_name)
+        return format_message(message, submission.cf_sources, self.layouts)
+
+    def render_body_template(self, template_name, submission):
+        """
+        Renders templates/bodies/<template_name>.txt with the submission's
+        name, email, the shown fields as (title, value) pairs and the whole
+        message. Raises TemplateNotFound for a missing or invalid name.
+        """
+        if not BODY_TEMPLATE_NAME.fullmatch(template_name):
+            raise TemplateNotFound(template_name)
+        template = self.body_env.get_template(
+            'bodies/{}.txt'.format(template_name))
+        message = submission.fields
+        layout = self.layouts.get(message, submission.cf_sources)
+        return template.render(name=message['name'], email=message['email'],
+                               fields=layout.items(message),
+                               message=dict(message))
+
+    def redirect(self, url):
+        """Returns a 302 redirect to url"""
+        with self.trace.span('redirect'):
+            return werkzeug.utils.redirect(url, code=302)
 
     def error_redirect(self):
         """Renders local error html file"""
@@ -200,23 +881,28 @@ class Forms:
 
 class Controller:
     """
-    Track number of form submissions per second
+    Track number of form submissions per second (overall and per client) and
+    recent submissions
 
     __init__
     set_time_diff
     increment_rate
     reset_rate
     is_rate_violation
+    is_duplicate
+    forget
     """
     def __init__(self):
         # Rate variables
         self.rate = 0
         self.time_diff = 0
         self.start_time = datetime.now()
+        self.clients = create_client_limiter()
         # Duplicate-submission check variables
-        self.time_diff_hash = 0
-        self.start_time_hash = datetime.now()
-        self.hash_list = []
+        self.duplicates = DuplicateIndex(
+            conf.DUPLICATE_CHECK_TIME,
+            getattr(conf, 'DUPLICATE_MAX_ENTRIES', 100000))
+        self.near_duplicates = create_near_duplicate_index()
 
     def set_time_diff(self, begin_time):
         """Returns time difference between begin_time and now in seconds"""
@@ -224,9 +910,11 @@ class Controller:
         return time_d.seconds
 
     # Rate methods
-    def increment_rate(self):
-        """Increments self.rate by 1"""
+    def increment_rate(self, client=None):
+        """Increments self.rate by 1 and counts a request from client"""
         self.rate += 1
+        if client is not None:
+            self.clients.hit(client)
 
     def reset_rate(self):
         """Reset rate to initial values"""
@@ -234,367 +922,4405 @@ class Controller:
         self.start_time = datetime.now()
         self.time_diff = 0
 
-    def is_rate_violation(self):
+    def is_rate_violation(self, client=None):
         """
-        Returns False if rate doesn't violate CEILING in 1 second (no violation)
-        and True otherwise (violation)
+        Returns False if rate doesn't violate CEILING in 1 second and client
+        is within its own limit (no violation) and True otherwise (violation)
         """
         self.time_diff = self.set_time_diff(self.start_time)
         if self.time_diff < 1 and self.rate > conf.CEILING:
             return True
         elif self.time_diff > 1:
             self.reset_rate()
-        return False
+        return client is not None and self.clients.is_limited(client)
 
-    # Duplicate-submission check methods
-    def is_duplicate(self, submission):
-        """Calculates a hash from a submission and adds it to the hash list"""
-        # Create a hexidecmal hash of the submission using sha512
-        init_hash = hashlib.sha512()
-        init_hash.update((str(submission)).encode())
-        sub_hash = init_hash.hexdigest()
-        # If the time difference is under the limit in settings, check for a
-        # duplicate hash in hash_list
-        if self.check_time_diff_hash():
-            return self.check_for_duplicate_hash(sub_hash)
-        # If the time difference is greater than the limit in settings, there is
-        # no duplicate since hash_list was reset in check_time_diff_hash
-        return False
+    def retry_after(self, client=None):
+        """
+        Returns how many seconds to wait before a submission (from client)
+        would be within CEILING and its own limit, 0 if it would be now.
+        Unlike is_rate_violation it doesn't need the submission counted.
+        """
+        if self.is_rate_violation():
+            return 1
+        if client is None:
+            return 0
+        return self.clients.retry_after(client)
 
-    def check_time_diff_hash(self):
+    def retune(self):
         """
-        Checks time_diff_hash for a value greater than DUPL_CHECK_LIM from
-        conf.py
+        Applies the current CLIENT_* and DUPLICATE_* settings to the tables
+        in place, keeping the clients and submissions they hold (entries
+        expire DUPLICATE_CHECK_TIME after they were first seen, as if it had
+        always been the new one). The near-duplicate index
+        starts over when NEAR_DUPLICATE_DISTANCE changes, since its bands
+        depend on it. A SharedState keeps the settings it was created with.
         """
-        self.time_diff_hash = self.set_time_diff(self.start_time_hash)
-        # If time difference is greater than DUPLICATE_CHECK_TIME, reset the
-        # hash list and time variables
-        if self.time_diff_hash > (conf.DUPLICATE_CHECK_TIME):  # from conf.py
-            self.reset_hash()
-            return False
-        return True
+        self.clients.rate = getattr(conf, 'CLIENT_RATE', 0.2)
+        self.clients.burst = getattr(conf, 'CLIENT_BURST', 10)
+        self.clients.max_clients = getattr(conf, 'CLIENT_TABLE_SIZE', 10000)
+        for index in (self.duplicates, self.near_duplicates):
+            if isinstance(index, (DuplicateIndex, NearDuplicateIndex)):
+                index.set_ttl(conf.DUPLICATE_CHECK_TIME)
+                index.max_entries = getattr(conf, 'DUPLICATE_MAX_ENTRIES',
+                                            100000)
+        if getattr(self.near_duplicates, 'distance', None) != getattr(
+                conf, 'NEAR_DUPLICATE_DISTANCE', None):
+            self.near_duplicates = create_near_duplicate_index()
 
-    def reset_hash(self):
-        """Resets hash_list and hash_times"""
-        self.hash_list = []
-        self.time_diff_hash = 0
-        self.start_time_hash = datetime.now()
+    def stats(self):
+        """Returns the size counters of each table, keyed by table name"""
+        tables = {'duplicates': self.duplicates.stats(),
+                  'clients': self.clients.stats()}
+        if self.near_duplicates is not None:
+            tables['near_duplicates'] = self.near_duplicates.stats()
+        return tables
 
-    def check_for_duplicate_hash(self, sub_hash):
+    # Duplicate-submission check methods
+    def is_duplicate(self, submission):
         """
-        Checks for a duplicate hash in hash_list
-        Returns True if there is a duplicate and False otherwise
+        Returns True if the same submission (a Submission, or any message),
+        or with NEAR_DUPLICATE_DISTANCE one within that many SimHash bits of
+        it, was seen in the last DUPLICATE_CHECK_TIME seconds, and remembers
+        it otherwise
         """
-        if sub_hash in self.hash_list:
+        if isinstance(submission, Submission):
+            digest, fields = submission.fingerprint, submission.fields
+        else:
+            digest, fields = fingerprint(submission), submission
+        if self.duplicates.seen(digest):
             return True
-        # If there is no duplicate, add hash to the list and return False
-        self.hash_list.append(sub_hash)
-        return False
+        return (self.near_duplicates is not None and
+                self.near_duplicates.seen(simhash(fields)))
 
+    def forget(self, submission):
+        """
+        Forgets a submission is_duplicate remembered, so it can be submitted
+        again (after it was rejected or couldn't be delivered)
+        """
+        if isinstance(submission, Submission):
+            digest, fields = submission.fingerprint, submission.fields
+        else:
+            digest, fields = fingerprint(submission), submission
+        self.duplicates.forget(digest)
+        if self.near_duplicates is not None:
+            self.near_duplicates.forget(simhash(fields))
 
-# Standalone/helper functions
-def create_app(with_static=True):
+
+class ClientRateLimiter:
     """
-    Initializes Controller (controller) and Forms (app) objects, pass
-    controller to app to keep track of number of submissions per minute
+    Token-bucket rate limit per client address
+
+    Each client's bucket holds up to burst tokens and refills at rate tokens
+    per second on a monotonic clock; every request takes a token, and a client
+    whose last request found the bucket empty is limited. Buckets are kept in
+    least-recently-used order and the least recently seen client is forgotten
+    once max_clients are tracked, so memory stays bounded no matter how many
+    distinct addresses show up.
     """
-    # Initiate a logger
-    logger = logging.getLogger('formsender')
-    handler = logging.StreamHandler(sys.stdout)
-    formatter = logging.Formatter('%(levelname)s %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    logger.setLevel(logging.DEBUG)
-
-    # Initiate rate/duplicate controller and application
-    controller = Controller()
-    app = Forms(controller, logger)
-    if with_static:
-        app.wsgi_app = SharedDataMiddleware(app.wsgi_app, {
-            '/static':  os.path.join(os.path.dirname(__file__), 'static')
-        })
-    return app
+    def __init__(self, rate=0.2, burst=10, max_clients=10000,
+                 clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.clock = clock
+        # client -> [tokens, last refill time, limited]
+        self.buckets = collections.OrderedDict()
+        self.evictions = 0
 
+    def hit(self, client):
+        """Takes a token from client's bucket, returns False if it was empty"""
+        now = self.clock()
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            bucket = self.buckets[client] = [self.burst, now, False]
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.buckets.move_to_end(client)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        bucket[2] = bucket[0] < 1
+        if not bucket[2]:
+            bucket[0] -= 1
+        return not bucket[2]
 
-def create_msg(request):
-    """Creates the message to be sent in the email"""
-    message = dict()
-    if request.method == 'POST':
-        # Takes the information from the request and puts it into the message
-        # dict. request.form cannot be returned directly because it is a
-        # multidict.
-        for key in request.form:
-            message[key] = request.form.get(key)
-        # If there is a message, return it, otherwise return None
-        if message:
-            message['redirect'] = strip_query(message['redirect'])
-            return message
-        return None
-    return None
+    def retry_after(self, client):
+        """
+        Returns how many seconds until client's bucket has a token, 0 if it
+        has one now, without taking it
+        """
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            return 0
+        tokens = min(self.burst,
+                     bucket[0] + (self.clock() - bucket[1]) * self.rate)
+        if tokens >= 1:
+            return 0
+        return (1 - tokens) / self.rate if self.rate > 0 else math.inf
 
+    def is_limited(self, client):
+        """Returns True if client's last request found its bucket empty"""
+        bucket = self.buckets.get(client)
+        return bucket is not None and bucket[2]
 
-def is_valid_email(request):
-    """
-    Check that email server exists at request.form['email']
-    return the email if it is valid, False if not
-    """
-    valid_email = validate_email(request.form['email'],
-                                 check_mx=False,  # DNS resolution is not reliable
-                                 verify=False)  # disabling RCPT is occasionally used to fight spam
-    if valid_email:
-        return valid_email
-    return False
+    def stats(self):
+        """Returns the client table's size counters"""
+        return {
+            'entries': len(self.buckets),
+            'max_entries': self.max_clients,
+            'evictions': self.evictions,
+        }
+
+
+def create_client_limiter():
+    """Returns a ClientRateLimiter configured from conf.py"""
+    return ClientRateLimiter(getattr(conf, 'CLIENT_RATE', 0.2),
+                             getattr(conf, 'CLIENT_BURST', 10),
+                             getattr(conf, 'CLIENT_TABLE_SIZE', 10000))
 
 
-def is_valid_recaptcha(request):
+class DuplicateIndex:
     """
-    Check that recaptcha responce is valid
-    by sending a POST request to google's servers
+    Digests of recently seen submissions, each forgotten ttl seconds after it
+    was first seen
+
+    Digests map to their expiry time in an insertion-ordered dict. Since every
+    entry lives for the same ttl, insertion order is also expiry order, so the
+    dict doubles as an expiry ring: lookups are O(1) and expired entries are
+    popped from the front. When more than max_entries digests are live, the
+    oldest are evicted early so memory stays bounded during a flood. The
+    index is shared by the worker's threads, including the one reloading
+    settings, so every access holds its lock.
     """
+    DIGEST_SIZE = 16  # bytes
 
-    recaptchaURL = 'https://www.google.com/recaptcha/api/siteverify'
-    recaptcha_response = request.form['g-recaptcha-response']
-    secret_key = conf.RECAPTCHA_SECRET
-    URLParams = urlencode({
-        'secret':    secret_key,
-        'response':  recaptcha_response,
-        'remote_ip': request.remote_addr,
-    })
+    def __init__(self, ttl, max_entries=100000, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        # Counters
+        self.expirations = 0
+        self.evictions = 0
+
+    def seen(self, digest):
+        """
+        Returns True if digest is live in the index, otherwise adds it and
+        returns False
+        """
+        with self.lock:
+            now = self.clock()
+            self.expire(now)
+            if digest in self.entries:
+                return True
+            self.entries[digest] = now + self.ttl
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            return False
+
+    def set_ttl(self, ttl):
+        """
+        Changes the ttl, moving every entry's expiry time by the same amount
+        so the entries stay in expiry order
+        """
+        with self.lock:
+            change = ttl - self.ttl
+            if change:
+                for digest in self.entries:
+                    self.entries[digest] += change
+            self.ttl = ttl
 
-    google_response = urlopen(recaptchaURL, URLParams.encode('utf-8')).read()
-    recaptcha_result = json.loads(google_response)
-    recaptcha_success = recaptcha_result.get('success', None)
+    def forget(self, digest):
+        """Drops digest from the index, if it is there"""
+        with self.lock:
+            self.entries.pop(digest, None)
 
-    return recaptcha_success
+    def expire(self, now):
+        """Drops every entry whose expiry time has passed, under the lock"""
+        entries = self.entries
+        while entries:
+            digest = next(iter(entries))
+            if entries[digest] > now:
+                break
+            del entries[digest]
+            self.expirations += 1
 
+    def stats(self):
+        """Returns the index's size and memory counters"""
+        # Each entry holds a bytes digest and a float expiry time
+        entry_size = (sys.getsizeof(b'\0' * self.DIGEST_SIZE) +
+                      sys.getsizeof(0.0))
+        with self.lock:
+            entries = len(self.entries)
+            return {
+                'entries': entries,
+                'max_entries': self.max_entries,
+                'expirations': self.expirations,
+                'evictions': self.evictions,
+                'bytes': sys.getsizeof(self.entries) + entries * entry_size,
+            }
 
-def validate_name(request):
+
+class NearDuplicateIndex:
     """
-    Make sure request has a 'name' field with more than just spaces return
-    stripped name if true, False if not
+    SimHashes of recently seen submissions, each forgotten ttl seconds after
+    it was first seen, matched to within distance differing bits
+
+    The 64 bits are cut into distance + 1 bands, and each band has a table
+    from its value to the SimHashes that have it. Two SimHashes within
+    distance bits of each other can differ in at most distance bands, so
+    they share at least one band exactly: a lookup compares the SimHashes in
+    its bands' buckets rather than every one. Entries expire and are evicted,
+    under a lock, as in DuplicateIndex.
     """
-    name = request.form['name']
-    if name.strip():
-        return True
-    return False
+    BITS = 64
 
+    def __init__(self, ttl, distance=3, max_entries=100000,
+                 clock=time.monotonic):
+        if not 0 <= distance < self.BITS:
+            raise ValueError('distance must be from 0 to {}'.format(
+                self.BITS - 1))
+        self.ttl = ttl
+        self.distance = distance
+        self.max_entries = max_entries
+        self.clock = clock
+        bands = distance + 1
+        # (shift, mask) of each band
+        self.bands = [
+            (self.BITS * band // bands,
+             (1 << (self.BITS * (band + 1) // bands -
+                    self.BITS * band // bands)) - 1)
+            for band in range(bands)]
+        self.lock = threading.Lock()
+        self.tables = [{} for _ in self.bands]
+        self.entries = collections.OrderedDict()
+        # Counters
+        self.expirations = 0
+        self.evictions = 0
+        self.comparisons = 0
 
-def is_hidden_field_empty(request):
-    """Make sure hidden 'last_name' field is empty, return True or False"""
-    if request.form['last_name'] == "":
-        return True
-    return False
+    def band_keys(self, value):
+        """Returns the value of each band of value"""
+        return [(value >> shift) & mask for shift, mask in self.bands]
 
+    def seen(self, value):
+        """
+        Returns True if a SimHash within distance bits of value is live in
+        the index, otherwise adds value and returns False
+        """
+        keys = self.band_keys(value)
+        with self.lock:
+            now = self.clock()
+            self.expire(now)
+            candidates = set()
+            for table, key in zip(self.tables, keys):
+                candidates.update(table.get(key, ()))
+            self.comparisons += len(candidates)
+            if any((value ^ other).bit_count() <= self.distance
+                   for other in candidates):
+                return True
+            self.entries[value] = now + self.ttl
+            for table, key in zip(self.tables, keys):
+                table.setdefault(key, set()).add(value)
+            while len(self.entries) > self.max_entries:
+                self.drop_bands(self.entries.popitem(last=False)[0])
+                self.evictions += 1
+            return False
 
-def is_valid_token(request):
-    """Make sure request's 'token' field matches TOKEN in conf.py"""
-    if request.form['token'] == conf.TOKEN:
-        return True
-    return False
+    def set_ttl(self, ttl):
+        """
+        Changes the ttl, moving every entry's expiry time by the same amount
+        so the entries stay in expiry order
+        """
+        with self.lock:
+            change = ttl - self.ttl
+            if change:
+                for value in self.entries:
+                    self.entries[value] += change
+            self.ttl = ttl
 
+    def forget(self, value):
+        """Drops value from the index, if it is there"""
+        with self.lock:
+            if self.entries.pop(value, None) is not None:
+                self.drop_bands(value)
 
-def is_valid_fields_to_join(request):
+    def drop_bands(self, value):
+        """Drops value from the band tables"""
+        for table, key in zip(self.tables, self.band_keys(value)):
+            bucket = table[key]
+            bucket.discard(value)
+            if not bucket:
+                del table[key]
+
+    def expire(self, now):
+        """Drops every entry whose expiry time has passed, under the lock"""
+        entries = self.entries
+        while entries:
+            value = next(iter(entries))
+            if entries[value] > now:
+                break
+            del entries[value]
+            self.drop_bands(value)
+            self.expirations += 1
+
+    def stats(self):
+        """Returns the index's size counters"""
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'expirations': self.expirations,
+                'evictions': self.evictions,
+                'buckets': sum(len(table) for table in self.tables),
+                'comparisons': self.comparisons,
+            }
+
+
+def create_near_duplicate_index():
     """
-    Make sure that if request has 'fields_to_join' field, that the specified
-    fields to join exist
+    Returns a NearDuplicateIndex configured from conf.py, or None when
+    NEAR_DUPLICATE_DISTANCE isn't set
     """
-    if 'fields_to_join' in request.form:
-        for field in request.form['fields_to_join'].split(','):
-            if field not in request.form and field != 'date':
-                return False
-    return True
+    distance = getattr(conf, 'NEAR_DUPLICATE_DISTANCE', None)
+    if distance is None:
+        return None
+    return NearDuplicateIndex(conf.DUPLICATE_CHECK_TIME, distance,
+                              getattr(conf, 'DUPLICATE_MAX_ENTRIES', 100000))
 
 
-def create_error_url(error_number, message, request):
-    """Construct error message and append to redirect url"""
-    values = [('error', str(error_number)), ('message', message)]
-    query = six.moves.urllib.parse.urlencode(values)
-    return request.form['redirect'] + '?' + query
+class SharedController(Controller):
+    """
+    Controller whose rate counter and duplicate index live in a SharedState,
+    so every worker on the host enforces one CEILING and catches duplicates
+    submitted to any worker
+    """
+    def __init__(self, state):
+        self.state = state
+        self.duplicates = state
+        # Per-client limits and near-duplicates stay per worker
+        self.clients = create_client_limiter()
+        self.near_duplicates = create_near_duplicate_index()
 
+    @property
+    def rate(self):
+        """Number of submissions in the current one-second window"""
+        return self.state.read_rate()[1]
 
-def strip_query(url):
-    """Remove query string from a url"""
-    return url.split('?', 1)[0]
+    def increment_rate(self, client=None):
+        """Increments the shared rate by 1 and counts a request from client"""
+        self.state.increment_rate()
+        if client is not None:
+            self.clients.hit(client)
 
+    def reset_rate(self):
+        """Reset the shared rate to initial values"""
+        self.state.reset_rate()
 
-def format_message(msg, exclude=None):
-    """Formats a dict (msg) into a nice-looking string
+    def is_rate_violation(self, client=None):
+        """
+        Returns False if the shared rate doesn't violate CEILING in 1 second
+        and client is within its own limit (no violation) and True otherwise
+        (violation)
+        """
+        if self.state.is_rate_violation(conf.CEILING):
+            return True
+        return client is not None and self.clients.is_limited(client)
 
-    Fields named in ``exclude`` (e.g. those already sent as RT custom fields)
-    are left out of the body to avoid duplication.
+
+class SharedState:
     """
-    # Ignore these fields when writing to formatted message
-    hidden_fields = ['redirect', 'last_name', 'token', 'op',
-                     'name', 'email', 'mail_subject', 'send_to',
-                     'fields_to_join_name', 'support', 'ibm_power',
-                     'mail_subject_prefix', 'mail_subject_key',
-                     'custom_fields', 'g-recaptcha-response']
-    if exclude:
-        hidden_fields += list(exclude)
-    # Contact information goes at the top
-    f_message = ("Contact:\n--------\n"
-                 "NAME:   {}\nEMAIL:   {}\n"
-                 "\nInformation:\n------------\n"
-                 .format(msg['name'], msg['email']))
-
-    # If fields_to_join_name specified, add the key, data to the dictionary
-    # Otherwise, create fields_to_join key, data and add to dictionary
-    if 'fields_to_join' in msg:
-        # handle fields_to_join
-        fields_to_join = msg['fields_to_join'].split(',')  # list of fields
-        joined_data = (':'.join(str(int(time.time())) if field == 'date' else msg[field] for field in fields_to_join))
-
-        # If the fields to join name is specified, and the name does not exist
-        # as a key in current msg dictionary
-        if 'fields_to_join_name' in msg and msg['fields_to_join_name'] not in msg:
-            msg[str(msg['fields_to_join_name'])] = joined_data
-        else:
-            msg['Fields To Join'] = joined_data
-        msg.pop('fields_to_join', None)
+    Rate counter and duplicate index shared by processes through an mmap'd
+    file
 
-    # Create another dictionary that has lowercase title as key and original
-    # title as value
-    titles = {}
-    for key in msg:
-        titles[key.lower()] = key
+    The file starts with a header holding the rate window and counters,
+    followed by a fixed open-addressing hash table of (digest, expiry) slots.
+    A digest is looked up by linear probing from its home slot, at most
+    PROBE_LIMIT slots, stopping at a never-used slot. Expired and forgotten
+    slots are reused by later inserts; when the probed slots are all live,
+    the one closest to expiry is evicted. The header counts the occupied
+    slots (those holding a digest that hasn't been forgotten, live or
+    expired), so stats doesn't have to scan the table. Every operation holds a POSIX lock on the file (shared
+    between processes) and a thread lock (shared between threads).
 
-    # Write each formatted key in title case and corresponding message to
-    # f_message, each key and message is separated by two lines.
-    for key in sorted(titles):
-        if key not in hidden_fields:
-            f_message += \
-                ('{}:\n{}\n\n'.format(convert_key_to_title(titles[key]),
-                                      msg[titles[key]]))
+    Other processes may have the file mapped, and shrinking a mapped file
+    makes their next access fault, so a file laid out for another table size
+    is never rebuilt in place: it is a ValueError.
+    """
+    MAGIC = b'FSSTATE2'
+    # magic, rate window start, rate, slots, inserts, evictions, occupied
+    HEADER = struct.Struct('<8sdqqqqq')
+    SLOT = struct.Struct('<16sd')
+    # Expiry of a never-used slot, and of a forgotten one
+    UNUSED = 0
+    FORGOTTEN = -1
+    PROBE_LIMIT = 16
+    DIGEST_SIZE = DuplicateIndex.DIGEST_SIZE
 
-    return f_message
+    def __init__(self, path, slots=100000, ttl=3600, clock=time.time):
+        self.path = path
+        self.slots = slots
+        self.ttl = ttl
+        self.max_entries = slots
+        # Wall-clock time, since the file is shared by processes and may
+        # outlive them
+        self.clock = clock
+        self.size = self.HEADER.size + slots * self.SLOT.size
+        self.thread_lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self.locked(mapped=False):
+            header = os.pread(self.fd, self.HEADER.size, 0)
+            if len(header) < self.HEADER.size:
+                # A new file, which nobody can have mapped yet
+                os.ftruncate(self.fd, self.size)
+                os.pwrite(self.fd, self.HEADER.pack(self.MAGIC, self.clock(),
+                                                    0, slots, 0, 0, 0), 0)
+                header = os.pread(self.fd, self.HEADER.size, 0)
+        magic, _, _, file_slots, _, _, _ = self.HEADER.unpack(header)
+        if magic != self.MAGIC or file_slots != slots:
+            os.close(self.fd)
+            raise ValueError('{} is not a state file with {} slots'.format(
+                path, slots))
+        self.map = mmap.mmap(self.fd, self.size)
 
+    @contextlib.contextmanager
+    def locked(self, mapped=True):
+        """Holds the state lock across threads and processes"""
+        with self.thread_lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                yield self.map if mapped else None
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
 
-def convert_key_to_title(snake_case_key):
-    """Replace underscores with spaces and convert to title case"""
-    return snake_case_key.replace('_', ' ').title()
+    def read_header(self, state):
+        """
+        Returns the header as (window start, rate, inserts, evictions,
+        occupied)
+        """
+        (_, start, rate, _, inserts, evictions,
+         occupied) = self.HEADER.unpack_from(state)
+        return start, rate, inserts, evictions, occupied
 
+    def write_header(self, state, start, rate, inserts, evictions, occupied):
+        """Writes the header fields"""
+        self.HEADER.pack_into(state, 0, self.MAGIC, start, rate, self.slots,
+                              inserts, evictions, occupied)
 
-def set_mail_subject(message):
-    """
-    Returns a string to be used as a subject in an email, format:
+    # Rate methods
+    def read_rate(self):
+        """Returns (window start, rate)"""
+        with self.locked() as state:
+            return self.read_header(state)[:2]
 
-    message['mail_subject_prefix']: message[message['mail_subject_key']
-        or
-    message['mail_subject_prefix']
-        or
-    message[message['mail_subject_key']]
-        or the default
-    'Form Submission'
-    """
-    mail_subject = ''
-    # If mail_subject_prefix exists in the message dict and has content, add
-    # it to the mail_subject string. Then check if mail_subject_key also exists
-    # and points to valid data and append if necessary.
-    if 'mail_subject_prefix' in message and message['mail_subject_prefix']:
-        mail_subject += message['mail_subject_prefix']
-        if ('mail_subject_key' in message and
-                message['mail_subject_key'] and
+    def increment_rate(self):
+        """Increments the rate by 1"""
+        with self.locked() as state:
+            start, rate, *counters = self.read_header(state)
+            self.write_header(state, start, rate + 1, *counters)
+
+    def reset_rate(self):
+        """Starts a new rate window"""
+        with self.locked() as state:
+            _, _, *counters = self.read_header(state)
+            self.write_header(state, self.clock(), 0, *counters)
+
+    def is_rate_violation(self, ceiling):
+        """
+        Returns True if more than ceiling submissions arrived within a second
+        of the window start, and starts a new window once it is over a second
+        old
+        """
+        with self.locked() as state:
+            start, rate, *counters = self.read_header(state)
+            elapsed = self.clock() - start
+            if elapsed < 1:
+                return rate > ceiling
+            if elapsed >= 2:
+                self.write_header(state, self.clock(), 0, *counters)
+            return False
+
+    # Duplicate-submission check methods
+    def seen(self, digest):
+        """
+        Returns True if digest (DIGEST_SIZE bytes) is live in the table,
+        otherwise adds it and returns False
+        """
+        home = int.from_bytes(digest[:8], 'little') % self.slots
+        with self.locked() as state:
+            now = self.clock()
+            free = None
+            oldest = None
+            for probe in range(min(self.PROBE_LIMIT, self.slots)):
+                offset = (self.HEADER.size +
+                          (home + probe) % self.slots * self.SLOT.size)
+                key, expiry = self.SLOT.unpack_from(state, offset)
+                if expiry == self.UNUSED:
+                    # Never used: the digest can't be further along
+                    free = free or (offset, expiry)
+                    break
+                if expiry <= now:
+                    free = free or (offset, expiry)
+                    continue
+                if key == digest:
+                    return True
+                if oldest is None or expiry < oldest[1]:
+                    oldest = (offset, expiry)
+            start, rate, inserts, evictions, occupied = self.read_header(
+                state)
+            if free is None:
+                free = oldest
+                evictions += 1
+            if free[1] in (self.UNUSED, self.FORGOTTEN):
+                occupied += 1
+            self.SLOT.pack_into(state, free[0], digest, now + self.ttl)
+            self.write_header(state, start, rate, inserts + 1, evictions,
+                              occupied)
+            return False
+
+    def forget(self, digest):
+        """Expires digest's slot, if digest is live in the table"""
+        home = int.from_bytes(digest[:8], 'little') % self.slots
+        with self.locked() as state:
+            now = self.clock()
+            for probe in range(min(self.PROBE_LIMIT, self.slots)):
+                offset = (self.HEADER.size +
+                          (home + probe) % self.slots * self.SLOT.size)
+                key, expiry = self.SLOT.unpack_from(state, offset)
+                if expiry == self.UNUSED:
+                    return
+                if key == digest and expiry > now:
+                    # Not UNUSED, so lookups keep probing past it
+                    self.SLOT.pack_into(state, offset, digest, self.FORGOTTEN)
+                    start, rate, inserts, evictions, occupied = \
+                        self.read_header(state)
+                    self.write_header(state, start, rate, inserts, evictions,
+                                      occupied - 1)
+                    return
+
+    def stats(self):
+        """
+        Returns the table's size and memory counters; its entries are the
+        occupied slots, expired ones included until they are reused
+        """
+        with self.locked() as state:
+            _, _, inserts, evictions, occupied = self.read_header(state)
+        return {
+            'entries': occupied,
+            'max_entries': self.slots,
+            'inserts': inserts,
+            'evictions': evictions,
+            'bytes': self.size,
+        }
+
+
+# Standalone/helper functions
+def create_logger():
+    """
+    Returns the formsender logger, setting it up the first time
+
+    Records are handed to a QueueListener, which formats them (as LOG_FORMAT,
+    with the LOG_REDACT fields redacted) and writes them to stdout on its own
+    thread, so a request never waits on the output. Records of the events in
+    LOG_SAMPLE_RATES are sampled before they are queued.
+    """
+    logger = logging.getLogger('formsender')
+    with LOGGER_LOCK:
+        if not any(isinstance(handler, LogQueueHandler)
+                   for handler in logger.handlers):
+            formatter_class = (JSONLogFormatter
+                               if getattr(conf, 'LOG_FORMAT', 'text') == 'json'
+                               else RedactingFormatter)
+            output = StdoutHandler()
+            output.setFormatter(formatter_class(
+                '%(levelname)s %(message)s',
+                redact=getattr(conf, 'LOG_REDACT', ())))
+            records = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(records, output)
+            listener.start()
+            # Write out what is still queued when the worker exits
+            atexit.register(listener.stop)
+            handler = LogQueueHandler(records)
+            handler.listener = listener
+            handler.addFilter(LogSampler(getattr(conf, 'LOG_SAMPLE_RATES',
+                                                 {})))
+            logger.addHandler(handler)
+        logger.setLevel(getattr(conf, 'LOG_LEVEL', 'DEBUG'))
+    return logger
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that queues records as they are, leaving the formatting
+    (and redaction) of their arguments to the QueueListener's thread. Log
+    calls must not pass arguments they will change later.
+    """
+    def prepare(self, record):
+        return record
+
+
+class LogSampler(logging.Filter):
+    """
+    Keeps a fraction of the records of some events, given as {event: rate}
+    for the event= extra attribute of a log call; other records are kept
+    """
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, 'event', None))
+        return rate is None or random.random() < rate
+
+
+class StdoutHandler(logging.StreamHandler):
+    """StreamHandler writing to whatever sys.stdout is at the time"""
+    stream = property(lambda self: sys.stdout, lambda self, stream: None)
+
+
+class RedactingFormatter(logging.Formatter):
+    """
+    Formatter that replaces the values of the fields named in redact when
+    a log call's arguments are a mapping (logger.debug('%(email)s', fields))
+    """
+    REDACTED = '[redacted]'
+
+    def __init__(self, fmt=None, redact=()):
+        super().__init__(fmt)
+        self.redact = frozenset(redact)
+
+    def format(self, record):
+        return super().format(self.redacted(record))
+
+    def redacted(self, record):
+        """Returns record with its mapping arguments redacted"""
+        if isinstance(record.args, collections.abc.Mapping):
+            record = logging.makeLogRecord(
+                dict(record.__dict__, args=self.redact_fields(record.args)))
+        return record
+
+    def redact_fields(self, value):
+        """Returns value with the fields in any mappings in it redacted"""
+        if isinstance(value, collections.abc.Mapping):
+            return {key: self.REDACTED if key in self.redact
+                    else self.redact_fields(item)
+                    for key, item in value.items()}
+        return value
+
+
+class JSONLogFormatter(RedactingFormatter):
+    """
+    RedactingFormatter writing a JSON object per record, with the log
+    call's mapping arguments under 'fields'
+    """
+    def format(self, record):
+        record = self.redacted(record)
+        entry = {
+            'time': datetime.fromtimestamp(record.created,
+                                           timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'event', None):
+            entry['event'] = record.event
+        if isinstance(record.args, collections.abc.Mapping):
+            entry['fields'] = record.args
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Held while create_logger sets the logger up
+LOGGER_LOCK = threading.Lock()
+
+
+class Settings:
+    """
+    One version of the settings in conf.py, read like the conf module:
+    settings.CEILING, getattr(settings, 'CHECK_MX', False)
+
+    Settings never change. A reload loads the settings file into a new
+    Settings and Forms.apply_settings puts it in place of the module's conf
+    in one assignment, so each read sees one version or the next.
+    """
+    __slots__ = ('values', 'version', 'path')
+
+    # Settings conf.py must set
+    REQUIRED = ('TOKEN', 'RECAPTCHA_SECRET', 'URL', 'RT_TOKEN', 'CEILING',
+                'DUPLICATE_CHECK_TIME')
+    # Settings that are counts, sizes or durations when set
+    NUMBERS = ('CEILING', 'CLIENT_RATE', 'CLIENT_BURST', 'CLIENT_TABLE_SIZE',
+               'DUPLICATE_CHECK_TIME', 'DUPLICATE_MAX_ENTRIES',
+               'MAX_CONTENT_LENGTH', 'ADMISSION_DRAIN_LIMIT',
+               'ATTACHMENT_MEMORY_BUDGET', 'BODY_LAYOUT_CACHE_SIZE',
+               'EMAIL_CACHE_SIZE', 'RT_POOL_SIZE', 'RT_TIMEOUT',
+               'ASGI_RT_POOL_SIZE', 'RECAPTCHA_CONNECT_TIMEOUT',
+               'RECAPTCHA_READ_TIMEOUT', 'MX_TIMEOUT', 'MX_CACHE_SIZE',
+               'MX_NEGATIVE_TTL', 'MX_MAX_TTL', 'RT_CONCURRENCY_MIN',
+               'RT_CONCURRENCY_MAX', 'RT_LATENCY_TARGET',
+               'RT_BREAKER_FAILURES', 'RT_BREAKER_PROBE_INTERVAL',
+               'RECAPTCHA_BREAKER_FAILURES',
+               'RECAPTCHA_BREAKER_PROBE_INTERVAL', 'RT_RETRY_ATTEMPTS',
+               'RT_RETRY_BASE_DELAY', 'RT_RETRY_MAX_DELAY', 'RT_RETRY_BUDGET',
+               'RT_LEDGER_SIZE')
+
+    def __init__(self, values, version=1, path=None):
+        object.__setattr__(self, 'values', types.MappingProxyType(
+            dict(values)))
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'path', path)
+
+    @classmethod
+    def from_module(cls, module, version=1, path=None):
+        """Returns the Settings of module's upper-case names"""
+        return cls({name: value for name, value in vars(module).items()
+                    if name.isupper()}, version, path)
+
+    @classmethod
+    def load(cls, path, version=1):
+        """
+        Returns the Settings of the Python file at path, run afresh like
+        conf.py is on import (so it reads the environment again)
+        """
+        module = types.ModuleType('conf')
+        module.__file__ = path
+        with open(path) as source:
+            exec(compile(source.read(), path, 'exec'), vars(module))
+        return cls.from_module(module, version, path)
+
+    def __getattr__(self, name):
+        try:
+            return self.values[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Settings are immutable')
+
+    def validate(self):
+        """Raises ValueError if a setting is missing or out of range"""
+        for name in self.REQUIRED:
+            if name not in self.values:
+                raise ValueError('{} is not set'.format(name))
+        for name in self.NUMBERS:
+            value = self.values.get(name, 0)
+            if isinstance(value, bool) or not isinstance(
+                    value, (int, float)) or value < 0:
+                raise ValueError('{} must be a number, 0 or more'.format(
+                    name))
+        distance = self.values.get('NEAR_DUPLICATE_DISTANCE')
+        if distance is not None and (
+                not isinstance(distance, int) or
+                not 0 <= distance < NearDuplicateIndex.BITS):
+            raise ValueError('NEAR_DUPLICATE_DISTANCE must be from 0 to '
+                             '{}'.format(NearDuplicateIndex.BITS - 1))
+        level = self.values.get('LOG_LEVEL', 'DEBUG')
+        if not isinstance(level, int) and not isinstance(
+                logging.getLevelName(level), int):
+            raise ValueError('LOG_LEVEL must be a logging level')
+
+    def changed(self, other):
+        """
+        Returns the names of the settings whose values differ in other, a
+        Settings or the conf module
+        """
+        if not isinstance(other, Settings):
+            other = Settings.from_module(other)
+        missing = object()
+        return {name for name in self.values.keys() | other.values.keys()
+                if self.values.get(name, missing) !=
+                other.values.get(name, missing)}
+
+
+class SettingsReloader(threading.Thread):
+    """
+    Background thread that reloads the settings file at path into app (see
+    Forms.reload_settings) when the file has changed, which it checks every
+    interval seconds, or when asked to by request(), e.g. on SIGHUP (see
+    listen)
+    """
+    def __init__(self, app, path=None, interval=5):
+        super().__init__(name='formsender-settings', daemon=True)
+        self.app = app
+        self.path = path or conf.__file__
+        self.interval = interval
+        self.stamp = self.read_stamp()
+        self.requested = threading.Event()
+        self.stopping = threading.Event()
+
+    def run(self):
+        """Reloads the settings as they change until stop() is called"""
+        while not self.stopping.is_set():
+            self.requested.wait(self.interval)
+            if not self.stopping.is_set():
+                self.check()
+
+    def stop(self):
+        """Asks the thread to exit"""
+        self.stopping.set()
+        self.requested.set()
+
+    def request(self, *args):
+        """
+        Asks for a reload whether or not the file changed. Takes the
+        arguments of a signal handler, and only sets an Event, so it is
+        safe to call from one.
+        """
+        self.requested.set()
+
+    def listen(self, signum=signal.SIGHUP):
+        """Reloads the settings when this process gets signal signum"""
+        signal.signal(signum, self.request)
+
+    def check(self):
+        """
+        Reloads the settings if they were asked for or the file changed
+        since the last check; returns True if new settings were applied
+        """
+        requested = self.requested.is_set()
+        self.requested.clear()
+        stamp = self.read_stamp()
+        if not requested and stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        return self.app.reload_settings(self.path)
+
+    def read_stamp(self):
+        """
+        Returns what tells a changed file apart: its modification time,
+        size and inode (which a file replaced by a rename changes); None if
+        it can't be read
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def create_controller(tenant=None):
+    """
+    Returns the Controller configured in conf.py, for the app or for the
+    tenant called tenant. With the shared STATE_BACKEND, each tenant has its
+    own state file next to the app's. The file's name ends in its number of
+    slots, so workers started with another DUPLICATE_MAX_ENTRIES (e.g.
+    during a rolling deploy) use a file of their own.
+    """
+    if getattr(conf, 'STATE_BACKEND', 'local') == 'shared':
+        slots = getattr(conf, 'DUPLICATE_MAX_ENTRIES', 100000)
+        return SharedController(SharedState(
+            '{}.{}'.format(shared_state_path(tenant), slots), slots,
+            conf.DUPLICATE_CHECK_TIME))
+    return Controller()
+
+
+def shared_state_path(tenant=None):
+    """
+    Returns what the names of the shared STATE_BACKEND's files start with,
+    for the app or for the tenant called tenant
+    """
+    path = getattr(conf, 'SHARED_STATE_PATH', '/tmp/formsender-state')
+    if tenant is not None:
+        path = '{}-{}'.format(path, tenant)
+    return path
+
+
+def create_app(with_static=True, app_class=None):
+    """
+    Initializes Controller (controller) and Forms (app) objects, pass
+    controller to app to keep track of number of submissions per minute.
+    app_class=AsyncForms builds the ASGI app instead (see create_asgi_app).
+    """
+    logger = create_logger()
+
+    # Initiate rate/duplicate controller and application. The app builds
+    # its RT clients, tenants, verifiers and caches from conf.py itself, so
+    # apply_settings can rebuild them the same way.
+    controller = create_controller()
+    spool = fallback_spool = None
+    if getattr(conf, 'DELIVERY_MODE', 'inline') == 'spool':
+        spool = TicketSpool(getattr(conf, 'SPOOL_PATH',
+                                    '/tmp/formsender-spool.sqlite3'))
+    elif getattr(conf, 'RT_BREAKER_FALLBACK', 'reject') == 'spool':
+        # Tickets are only spooled while RT's circuit breaker is open
+        fallback_spool = TicketSpool(getattr(conf, 'SPOOL_PATH',
+                                             '/tmp/formsender-spool.sqlite3'))
+    app_class = app_class or Forms
+    metrics = Metrics(getattr(conf, 'METRICS_DIR', None),
+                      getattr(conf, 'METRICS_FLUSH_INTERVAL', 5))
+    app = app_class(controller, logger, spool=spool, metrics=metrics,
+                    tracer=create_tracer(metrics),
+                    fallback_spool=fallback_spool)
+    if (spool or fallback_spool) is not None:
+        SpoolWorker(spool or fallback_spool, logger,
+                    deliver=app.deliver).start()
+    if with_static:
+        app.wsgi_app = SharedDataMiddleware(app.wsgi_app, {
+            '/static':  os.path.join(os.path.dirname(__file__), 'static')
+        })
+    return app
+
+
+class AsyncForms(Forms):
+    """
+    ASGI version of Forms
+
+    Runs the same validation and formatting as Forms, but verifies reCAPTCHA
+    and creates RT tickets with httpx coroutines, so one worker process keeps
+    serving other submissions while it waits on those services. The request
+    body is read into the app's UploadBudget before werkzeug parses it.
+
+    error and trace are kept in context variables: every request runs in its
+    own asyncio task, so concurrent requests each see their own.
+    """
+    RELOADABLE = dict(Forms.RELOADABLE, async_rt_clients=(
+        'URL', 'RT_TOKEN', 'ASGI_RT_POOL_SIZE', 'RT_TIMEOUT'))
+
+    def __init__(self, controller, logger, async_rt_clients=None, **kwargs):
+        self.error_var = contextvars.ContextVar('error', default=None)
+        self.trace_var = contextvars.ContextVar('trace', default=NULL_TRACE)
+        super().__init__(controller, logger, **kwargs)
+        self.async_rt_clients = (async_rt_clients or
+                                 self.build_async_rt_clients())
+
+    def build_async_rt_clients(self):
+        """Returns the AsyncRTClientPool for the app's own RT"""
+        return AsyncRTClientPool(getattr(conf, 'ASGI_RT_POOL_SIZE', 50),
+                                 getattr(conf, 'RT_TIMEOUT', 20))
+
+    def build_recaptcha(self, verifier_class=None):
+        return super().build_recaptcha(verifier_class or
+                                       AsyncRecaptchaVerifier)
+
+    def build_mx(self, resolver_class=None):
+        return super().build_mx(resolver_class or AsyncMXResolver)
+
+    error = property(lambda self: self.error_var.get(),
+                     lambda self, error: self.error_var.set(error))
+    trace = property(lambda self: self.trace_var.get(),
+                     lambda self, trace: self.trace_var.set(trace))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.asgi_app(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """
+        Starts pre-connecting to RT on startup, without waiting for it, and
+        closes connections on shutdown
+        """
+        preconnecting = []
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if getattr(conf, 'RT_PRECONNECT', False):
+                    preconnecting = [
+                        asyncio.ensure_future(rt_clients.preconnect(
+                            self.logger))
+                        for rt_clients in self.all_async_rt_clients()]
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for task in preconnecting:
+                    task.cancel()
+                await asyncio.gather(*preconnecting, return_exceptions=True)
+                for rt_clients in self.all_async_rt_clients():
+                    await rt_clients.aclose()
+                await self.recaptcha.session.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def all_async_rt_clients(self):
+        """Returns the app's AsyncRTClientPool and those of its tenants"""
+        return [self.async_rt_clients] + [tenant.async_rt_clients
+                                          for tenant in self.tenants]
+
+    async def asgi_app(self, scope, receive, send):
+        """Answers one HTTP request"""
+        started = time.perf_counter()
+        environ = asgi_environ(scope, None)
+        error = self.admit(self.create_request(environ))
+        if error is not None:
+            # The body is never read; the server drops it
+            self.record_response(error, started)
+            await send_response(error.get_response(environ), environ, send)
+            return
+        try:
+            body = await self.read_body(scope, receive)
+        except ClientDisconnected:
+            return
+        except HTTPException as error:
+            self.logger.error('formsender: %s', error)
+            self.record_response(error, started)
+            await send_response(error.get_response(environ), environ, send)
+            return
+        environ = asgi_environ(scope, body)
+        request = self.create_request(environ)
+        try:
+            response = await self.dispatch_request(request)
+        finally:
+            # Release the uploaded files (and their share of the budget)
+            request.close()
+            body.close()
+        self.record_response(response, started)
+        if isinstance(response, HTTPException):
+            response = response.get_response(environ)
+        await send_response(response, environ, send)
+
+    async def read_body(self, scope, receive):
+        """
+        Returns the request body in a file from the UploadBudget. Raises
+        RequestEntityTooLarge beyond MAX_CONTENT_LENGTH, and ClientDisconnected
+        if the client goes away first.
+        """
+        limit = getattr(conf, 'MAX_CONTENT_LENGTH', 10 * 1024 * 1024)
+        length = dict(scope['headers']).get(b'content-length')
+        length = int(length) if length and length.isdigit() else None
+        if length is not None and length > limit:
+            raise RequestEntityTooLarge()
+        body = self.uploads.open(length or 0)
+        size = 0
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    raise ClientDisconnected()
+                chunk = message.get('body', b'')
+                size += len(chunk)
+                if size > limit:
+                    raise RequestEntityTooLarge()
+                body.write(chunk)
+                if not message.get('more_body', False):
+                    break
+        except Exception:
+            body.close()
+            raise
+        body.seek(0)
+        return body
+
+    async def dispatch_request(self, request):
+        """Evaluates request to decide what happens"""
+        adapter = self.url_map.bind_to_environ(request.environ)
+        try:
+            endpoint, values = adapter.match()
+            response = getattr(self, 'on_' + endpoint)(request, **values)
+            if asyncio.iscoroutine(response):
+                response = await response
+            return response
+        except HTTPException as error:
+            self.logger.error('formsender: %s', error)
+            return error
+
+    async def on_form_page(self, request, form_id=None):
+        """
+        Checks for valid form data, creates an RT ticket, returns a redirect.
+        form_id names the FormDefinition of forms posted to /forms/<form_id>.
+        """
+        definition = None if form_id is None else self.forms.get(form_id)
+        tenant = self.tenants.route(request, form_id)
+        self.trace = self.tracer.start()
+        try:
+            response = await self.handle_form(request, definition, tenant)
+        finally:
+            self.trace.finish()
+        if self.trace.sampled:
+            response.headers['Server-Timing'] = self.trace.server_timing()
+            response.headers['X-Request-ID'] = self.trace.trace_id
+        return response
+
+    async def handle_form(self, request, definition=None, tenant=None):
+        """Validates the form and creates the ticket or an error redirect"""
+        try:
+            submission = self.start_form(request, definition, tenant)
+        except FormTooLarge as error:
+            return self.form_too_large(request, error)
+        error_number = await self.are_fields_invalid(submission)
+        if request.method == 'POST' and error_number:
+            # Error was found
+            return self.handle_error(request, error_number)
+        elif request.method == 'POST':
+            # No errors
+            try:
+                return await self.handle_no_error(submission)
+            except Exception:
+                # Neither delivered nor spooled, so it may be sent again
+                self.undo_checks(self.validators, submission)
+                raise
+        else:
+            # Renders error message locally if sent GET request
+            self.logger.error('formsender: server received unhandled GET '
+                              'request, expected POST request')
+            return self.error_redirect()
+
+    async def are_fields_invalid(self, submission):
+        """
+        If a field in the submission is invalid, sets the error message and
+        returns the error number, returns False if fields are valid
+        """
+        with self.metrics.timer('formsender_validation_duration_seconds'):
+            error_number = await self.find_invalid_field(submission)
+        if error_number:
+            self.metrics.inc('formsender_rejections_total',
+                             error=error_number)
+        return error_number
+
+    async def find_invalid_field(self, submission):
+        """
+        Runs the validators in order, sets the error message and returns the
+        error number of the first that fails, or False. Remote checks are
+        awaited.
+        """
+        passed = []
+        for validator in self.validators:
+            with self.metrics.timer('formsender_validator_duration_seconds',
+                                    validator=validator.name):
+                with self.trace.span(validator.name):
+                    valid = validator.check(self, submission)
+                    if inspect.isawaitable(valid):
+                        valid = await valid
+            if not valid:
+                self.undo_checks(passed, submission)
+                return self.reject_by(validator, submission)
+            passed.append(validator)
+        return False
+
+    async def is_valid_recaptcha(self, submission):
+        """Timed is_valid_recaptcha using this app's verifier"""
+        with self.metrics.timer('formsender_recaptcha_duration_seconds'):
+            return await is_valid_recaptcha(submission, self.recaptcha)
+
+    async def handle_no_error(self, submission):
+        """
+        Creates an RT ticket from the submission when there is no error, then
+        redirects to the provided redirect url
+        """
+        message = submission.fields
+        if message:
+            ticket_args = self.create_ticket_args(submission)
+            if self.spool is not None:
+                # SQLite writes block, so they run off the event loop
+                with self.trace.span('spool'):
+                    item_id = await asyncio.to_thread(self.spool.enqueue,
+                                                      ticket_args)
+                self.logger.debug('formsender: spooled ticket as item %s',
+                                  item_id)
+            else:
+                try:
+                    with self.trace.span('rt'):
+                        await self.deliver_async(ticket_args)
+                except CircuitOpen:
+                    if self.fallback_spool is None:
+                        raise
+                    with self.trace.span('spool'):
+                        item_id = await asyncio.to_thread(
+                            self.fallback_spool.enqueue, ticket_args)
+                    self.logger.warning('formsender: RT is unavailable, '
+                                        'spooled ticket as item %s', item_id)
+            return self.redirect(message['redirect'])
+        else:
+            return self.error_redirect()
+
+    async def deliver_async(self, ticket_args):
+        """
+        Creates a ticket in RT (its tenant's, if it has one) using a pooled
+        async client, returns its ID. Retries and idempotency keys work as
+        in deliver. Raises CircuitOpen while RT's CircuitBreaker is open.
+        """
+        tenant, ticket_args = self.tenant_of(ticket_args)
+        owner = self if tenant is None else tenant
+        ticket_args = dict(ticket_args)
+        key = ticket_args.pop('idempotency_key', None)
+        ticket_id = self.ledger.get(key)
+        if ticket_id is not None:
+            self.metrics.inc('formsender_rt_idempotent_hits_total',
+                             source='ledger')
+            return ticket_id
+        delays = self.retry_policy.delays(self.retry_policy.clock())
+        uncertain = False
+        while True:
+            try:
+                if uncertain:
+                    ticket_id = await self.find_ticket_async(owner, key)
+                if ticket_id is None:
+                    with owner.rt_breaker.call(RT_REFUSALS), \
+                            self.metrics.timer(
+                                'formsender_send_ticket_duration_seconds'), \
+                            owner.limiter.track():
+                        async with owner.async_rt_clients.client() as tracker:
+                            ticket_id = await tracker.create_ticket(
+                                **ticket_args)
+                break
+            except Exception as error:
+                kind, delay = self.retry(error, key, delays)
+            uncertain = uncertain or kind == 'unknown'
+            await asyncio.sleep(delay)
+        self.ledger.record(key, ticket_id)
+        return ticket_id
+
+    async def find_ticket_async(self, owner, key):
+        """find_ticket with owner's async RT clients"""
+        with owner.rt_breaker.call(RT_REFUSALS):
+            async with owner.async_rt_clients.client() as tracker:
+                async for ticket in tracker.search(
+                        raw_query=self.idempotency_query(key)):
+                    return self.found_ticket(ticket)
+        return None
+
+
+def create_asgi_app():
+    """
+    Initializes an AsyncForms app configured like create_app's Forms. Static
+    files are not served; the ASGI app only handles the form endpoints.
+    """
+    return create_app(with_static=False, app_class=AsyncForms)
+
+
+def asgi_environ(scope, body):
+    """Returns the WSGI environ of the ASGI HTTP scope with body as input"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # The whole body has been read, so werkzeug may read to its end even
+        # without a Content-Length
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+async def send_response(response, environ, send):
+    """Sends a werkzeug Response over ASGI"""
+    app_iter, status, headers = response.get_wsgi_response(environ)
+    try:
+        body = b''.join(app_iter)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+    await send({
+        'type': 'http.response.start',
+        'status': int(status.split(' ', 1)[0]),
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class Admission:
+    """
+    Turns requests for a form away from their method and headers alone,
+    before the body is read or parsed:
+
+    - 405 for methods other than GET and POST
+    - 413 when Content-Length is over max_content_length
+    - 415 for a POST whose body isn't a form
+    - 403 for clients in blocked_networks (addresses or CIDR networks)
+    - 429, with Retry-After, while CEILING is exceeded or the client has
+      used up its own rate limit (see Controller.retry_after)
+    - 503, with Retry-After, while as many tickets are in flight to RT as
+      the ConcurrencyLimiter allows, or RT's CircuitBreaker is open
+
+    Bodies up to drain_limit bytes are read and dropped so keep-alive
+    connections survive; larger ones aren't read at all.
+    """
+    METHODS = ('GET', 'POST')
+    FORM_TYPES = frozenset(['application/x-www-form-urlencoded',
+                            'multipart/form-data'])
+    # Longest Retry-After given, in seconds
+    MAX_RETRY_AFTER = 3600
+
+    def __init__(self, controller, blocked_networks=None,
+                 max_content_length=None, drain_limit=None):
+        self.controller = controller
+        if blocked_networks is None:
+            blocked_networks = getattr(conf, 'BLOCKED_NETWORKS', ())
+        self.blocked_networks = tuple(
+            ipaddress.ip_network(network.strip(), strict=False)
+            for network in blocked_networks if network.strip())
+        self.max_content_length = (
+            max_content_length if max_content_length is not None
+            else getattr(conf, 'MAX_CONTENT_LENGTH', 10 * 1024 * 1024))
+        self.drain_limit = (drain_limit if drain_limit is not None else
+                            getattr(conf, 'ADMISSION_DRAIN_LIMIT', 64 * 1024))
+
+    def check(self, request, client, controller=None, limiter=None,
+              breaker=None):
+        """
+        Returns the HTTPException to turn request away with, or None.
+        controller replaces this Admission's for the rate limits, e.g. with
+        the one of the request's tenant, and limiter and breaker are the
+        ConcurrencyLimiter and CircuitBreaker of the RT its ticket would go
+        to.
+        """
+        if request.method not in self.METHODS:
+            return MethodNotAllowed(valid_methods=self.METHODS)
+        length = request.content_length
+        if length is not None and length > self.max_content_length:
+            return RequestEntityTooLarge()
+        if request.method == 'POST' and (
+                request.mimetype not in self.FORM_TYPES
+                if request.mimetype else length):
+            return UnsupportedMediaType()
+        if self.is_blocked(client):
+            return Forbidden()
+        retry_after = (controller or self.controller).retry_after(client)
+        if retry_after:
+            return TooManyRequests(retry_after=math.ceil(
+                min(retry_after, self.MAX_RETRY_AFTER)))
+        if breaker is not None and breaker.is_open():
+            return CircuitOpen(breaker)
+        if limiter is not None and limiter.is_full():
+            return ServiceUnavailable(retry_after=min(
+                limiter.retry_after(), self.MAX_RETRY_AFTER))
+        return None
+
+    def is_blocked(self, client):
+        """Returns True if client is in one of the blocked networks"""
+        if not self.blocked_networks or not client:
+            return False
+        try:
+            address = ipaddress.ip_address(client)
+        except ValueError:
+            return False
+        return any(address in network for network in self.blocked_networks)
+
+
+class Submission:
+    """
+    The form of one request, parsed once and shared by validation, the
+    duplicate check, formatting and delivery
+
+    form is the submitted (immutable) MultiDict, so the field checks that
+    read request.form accept a Submission too. fields is create_msg's message
+    (None for an empty form), read-only. client is the submitter's address
+    (see client_address), attachments the uploaded files and fingerprint the
+    digest the duplicate check remembers. definition is the FormDefinition
+    of a form posted to /forms/<form_id>, None for other forms, and tenant
+    the Tenant the form was routed to, None for the app's own RT. A
+    Submission can't be modified.
+    """
+    __slots__ = ('form', 'fields', 'remote_addr', 'client', 'custom_fields',
+                 'cf_sources', 'attachments', 'fingerprint', 'definition',
+                 'tenant')
+
+    def __init__(self, form, fields, remote_addr=None, client=None,
+                 custom_fields=None, cf_sources=(), attachments=(),
+                 definition=None, tenant=None):
+        values = {
+            'definition': definition,
+            'tenant': tenant,
+            'form': form,
+            'fields': None if fields is None else types.MappingProxyType(
+                fields),
+            'remote_addr': remote_addr,
+            'client': client,
+            'custom_fields': types.MappingProxyType(custom_fields or {}),
+            'cf_sources': frozenset(cf_sources),
+            'attachments': tuple(attachments),
+            'fingerprint': fingerprint(fields),
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Submission is immutable')
+
+    @classmethod
+    def from_request(cls, request, definition=None, tenant=None):
+        """
+        Returns the Submission of request, parsing its body. With a
+        definition, its settings replace the form's hidden setting fields.
+        """
+        message = create_msg(request)
+        if definition is None:
+            custom_fields, cf_sources = extract_custom_fields(request)
+        else:
+            custom_fields, cf_sources = definition.extract_custom_fields(
+                request.form)
+            if message:
+                message = definition.apply(message)
+        return cls(request.form, message, request.remote_addr,
+                   client_address(request), custom_fields, cf_sources,
+                   extract_attachments(request), definition, tenant)
+
+    def subject(self):
+        """Returns the ticket subject"""
+        if self.definition is not None:
+            return self.definition.subject(self.fields)
+        return set_mail_subject(self.fields)
+
+    def queue(self):
+        """
+        Returns the RT queue the ticket goes to; a form that names none goes
+        to its tenant's queue, if the tenant has one
+        """
+        if self.definition is not None and self.definition.send_to:
+            return self.definition.send_to
+        if (self.tenant is not None and self.tenant.queue and
+                not self.fields.get('send_to')):
+            return self.tenant.queue
+        return send_to_address(self.fields)
+
+
+def load_yaml(data):
+    """Parses YAML form definitions, which needs PyYAML"""
+    try:
+        import yaml
+    except ImportError:
+        raise ValueError('PyYAML is needed for YAML form definitions')
+    return yaml.safe_load(data)
+
+
+class FormDefinition:
+    """
+    Server-side settings of one form, posted to /forms/<form_id>
+
+    Holds what a form would otherwise send in hidden fields (send_to,
+    mail_subject_prefix, mail_subject_key, custom_fields, fields_to_join,
+    fields_to_join_name and body_template), plus fields the form requires and
+    limits replacing those of the app's ParseBudget.
+    They are checked and compiled when the definition is loaded, and
+    submissions can't override them. Immutable, like Submission.
+    """
+    __slots__ = ('form_id', 'send_to', 'mail_subject_prefix',
+                 'mail_subject_key', 'custom_fields', 'fields_to_join',
+                 'fields_to_join_name', 'body_template', 'required',
+                 'limits', 'settings')
+
+    # Hidden fields a definition replaces
+    SETTING_FIELDS = frozenset([
+        'send_to', 'mail_subject_prefix', 'mail_subject_key', 'custom_fields',
+        'fields_to_join', 'fields_to_join_name', 'body_template'])
+
+    def __init__(self, form_id, send_to=None, mail_subject_prefix=None,
+                 mail_subject_key=None, custom_fields=None,
+                 fields_to_join=None, fields_to_join_name=None,
+                 body_template=None, required=(), limits=None):
+        for name, value in (('send_to', send_to),
+                            ('mail_subject_prefix', mail_subject_prefix),
+                            ('mail_subject_key', mail_subject_key),
+                            ('fields_to_join_name', fields_to_join_name),
+                            ('body_template', body_template)):
+            if value is not None and not isinstance(value, str):
+                raise ValueError('form {}: {} must be a string'.format(
+                    form_id, name))
+        if body_template and not BODY_TEMPLATE_NAME.fullmatch(body_template):
+            raise ValueError('form {}: invalid body_template {!r}'.format(
+                form_id, body_template))
+        custom_fields = dict(custom_fields or {})
+        if fields_to_join_name is not None and fields_to_join is None:
+            raise ValueError('form {}: fields_to_join_name needs '
+                             'fields_to_join'.format(form_id))
+        if isinstance(fields_to_join, str):
+            fields_to_join = fields_to_join.split(',')
+        fields_to_join = tuple(fields_to_join or ())
+        if any(not isinstance(field, str) or not field
+               for field in (list(custom_fields) +
+                             list(custom_fields.values()) +
+                             list(fields_to_join) + list(required))):
+            raise ValueError('form {}: field names must be non-empty '
+                             'strings'.format(form_id))
+        limits = dict(limits or {})
+        try:
+            ParseBudget().replace(**limits)
+        except TypeError:
+            raise ValueError('form {}: limits must be some of {}'.format(
+                form_id, ', '.join(ParseBudget.LIMITS)))
+        except ValueError as error:
+            raise ValueError('form {}: {}'.format(form_id, error))
+        # What apply adds to each message, as the hidden fields would have
+        settings = {'send_to': send_to,
+                    'mail_subject_prefix': mail_subject_prefix,
+                    'mail_subject_key': mail_subject_key,
+                    'fields_to_join': ','.join(fields_to_join) or None,
+                    'fields_to_join_name': fields_to_join_name,
+                    'body_template': body_template}
+        values = {
+            'form_id': form_id,
+            'send_to': send_to,
+            'mail_subject_prefix': mail_subject_prefix,
+            'mail_subject_key': mail_subject_key,
+            'custom_fields': tuple(custom_fields.items()),
+            'fields_to_join': fields_to_join,
+            'fields_to_join_name': fields_to_join_name,
+            'body_template': body_template,
+            # Fields the form must have; fields_to_join must exist too
+            'required': frozenset(required).union(
+                field for field in fields_to_join if field != 'date'),
+            'limits': types.MappingProxyType(limits),
+            'settings': types.MappingProxyType({
+                name: value for name, value in settings.items()
+                if value is not None}),
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('FormDefinition is immutable')
+
+    def apply(self, message):
+        """
+        Returns message with its hidden setting fields replaced by this
+        definition's settings
+        """
+        message = {key: value for key, value in message.items()
+                   if key not in self.SETTING_FIELDS}
+        message.update(self.settings)
+        return message
+
+    def is_valid(self, form):
+        """Returns True if form has every field this form requires"""
+        return all(field in form for field in self.required)
+
+    def extract_custom_fields(self, form):
+        """
+        Returns (custom_fields, consumed_form_fields) like
+        extract_custom_fields, from the definition's mapping
+        """
+        custom_fields = {}
+        for cf_name, field in self.custom_fields:
+            values = [value for value in form.getlist(field) if value != '']
+            if values:
+                custom_fields[cf_name] = (values[0] if len(values) == 1
+                                          else values)
+        return custom_fields, frozenset(field for _, field
+                                        in self.custom_fields)
+
+    def subject(self, message):
+        """Returns the ticket subject, like set_mail_subject"""
+        subject = ''
+        if self.mail_subject_prefix:
+            subject = self.mail_subject_prefix
+            if self.mail_subject_key and message.get(self.mail_subject_key):
+                subject += ': {}'.format(message[self.mail_subject_key])
+        elif self.mail_subject_key is not None and (
+                self.mail_subject_key in message):
+            subject = message[self.mail_subject_key]
+        return subject or 'Form Submission'
+
+
+class FormRegistry:
+    """
+    FormDefinitions by form ID, loaded from a directory
+
+    Each .json, .toml, .yaml or .yml file in the directory defines the form
+    whose ID is the file name without its extension. YAML files need PyYAML.
+    A file with a mistake stops the registry from loading, so a bad
+    definition is caught at startup rather than on a submission.
+    """
+    LOADERS = {
+        '.json': json.loads,
+        '.toml': tomllib.loads,
+        '.yaml': load_yaml,
+        '.yml': load_yaml,
+    }
+
+    def __init__(self, definitions=()):
+        self.definitions = types.MappingProxyType(
+            {definition.form_id: definition for definition in definitions})
+
+    @classmethod
+    def load(cls, directory):
+        """Returns a FormRegistry of the definitions in directory"""
+        definitions = []
+        for file_name in sorted(os.listdir(directory)):
+            form_id, extension = os.path.splitext(file_name)
+            if extension not in cls.LOADERS:
+                continue
+            with open(os.path.join(directory, file_name)) as definition:
+                settings = cls.LOADERS[extension](definition.read())
+            if not isinstance(settings, dict):
+                raise ValueError('form {}: expected a mapping of '
+                                 'settings'.format(form_id))
+            try:
+                definitions.append(FormDefinition(form_id, **settings))
+            except TypeError as error:
+                raise ValueError('form {}: {}'.format(form_id, error))
+        return cls(definitions)
+
+    def get(self, form_id):
+        """Returns the definition of form_id, raises NotFound if unknown"""
+        try:
+            return self.definitions[form_id]
+        except KeyError:
+            raise NotFound('No form {}'.format(form_id))
+
+    def __len__(self):
+        return len(self.definitions)
+
+
+# Fields that change on every submit of the same form (or are credentials),
+# so the duplicate checks leave them out
+VOLATILE_FIELDS = frozenset(['g-recaptcha-response', 'token'])
+
+# Fields that are the same for every submission of a form rather than what
+# the submitter wrote, so near-duplicates are looked for without them
+SETTING_FIELDS = FormDefinition.SETTING_FIELDS.union(['redirect'])
+
+
+def canonical_fields(message, exclude=VOLATILE_FIELDS):
+    """
+    Returns the fields of message (a mapping, or any value standing for one
+    field) but those in exclude as sorted (name, value) pairs, each value
+    NFKC-normalized and case-folded, with its whitespace collapsed
+    """
+    if message is None:
+        return []
+    if not isinstance(message, collections.abc.Mapping):
+        message = {'': message}
+    return sorted((name, ' '.join(unicodedata.normalize(
+        'NFKC', str(value)).casefold().split()))
+        for name, value in message.items() if name not in exclude)
+
+
+def fingerprint_key():
+    """
+    Returns the key fingerprints are hashed with. It is derived from TOKEN,
+    so every worker sharing a SharedState hashes alike.
+    """
+    return hashlib.blake2b(conf.TOKEN.encode(), digest_size=32,
+                           person=b'fingerprint').digest()
+
+
+def fingerprint(message):
+    """
+    Returns the digest the duplicate check remembers a message by: a keyed
+    blake2b of its canonical fields, so a resubmission matches whatever its
+    field order, spacing, case or reCAPTCHA response
+    """
+    canonical = json.dumps(canonical_fields(message), ensure_ascii=False,
+                           separators=(',', ':'))
+    return hashlib.blake2b(canonical.encode(),
+                           digest_size=DuplicateIndex.DIGEST_SIZE,
+                           key=fingerprint_key()).digest()
+
+
+def simhash(message):
+    """
+    Returns the 64-bit SimHash of what was written in message
+
+    Each word of each field (as field:word, from canonical_fields without
+    VOLATILE_FIELDS and SETTING_FIELDS) is hashed to 64 bits, and bit i of
+    the SimHash is set when most of the words' hashes have it set. Messages
+    that differ in a few words get SimHashes that differ in a few bits.
+    """
+    hashes = [
+        format(int(hashlib.blake2b('{}:{}'.format(name, word).encode(),
+                                   digest_size=8).hexdigest(), 16), '064b')
+        for name, value in canonical_fields(
+            message, VOLATILE_FIELDS | SETTING_FIELDS)
+        for word in value.split()]
+    half = len(hashes) / 2
+    # zip(*hashes) walks the bits column by column
+    return int('0' + ''.join('1' if column.count('1') > half else '0'
+                             for column in zip(*hashes)), 2)
+
+
+def create_msg(request):
+    """Creates the message to be sent in the email"""
+    message = dict()
+    if request.method == 'POST':
+        # Takes the information from the request and puts it into the message
+        # dict. request.form cannot be returned directly because it is a
+        # multidict.
+        for key in request.form:
+            message[key] = request.form.get(key)
+        # If there is a message, return it, otherwise return None
+        if message:
+            message['redirect'] = strip_query(message['redirect'])
+            return message
+        return None
+    return None
+
+
+def client_address(request):
+    """
+    Returns the IP address of the client that submitted the request
+
+    X-Forwarded-For is only believed for hops added by TRUSTED_PROXIES (the
+    proxies gunicorn is told to trust with --forwarded-allow-ips): the client
+    is the last address in the chain that isn't one of them.
+    """
+    address = request.remote_addr
+    trusted = getattr(conf, 'TRUSTED_PROXIES', ())
+    if address in trusted and 'X-Forwarded-For' in request.headers:
+        for hop in reversed(request.access_route):
+            address = hop
+            if hop not in trusted:
+                break
+    return address
+
+
+def is_valid_email(request, validator=None):
+    """
+    Check that request.form['email'] is a syntactically valid address, like
+    validate_email with check_mx and verify off (disabling RCPT is
+    occasionally used to fight spam; domains are looked up by an MXResolver
+    when CHECK_MX is on). return True if it is valid, False if not
+    """
+    if validator is None:
+        validator = EMAIL_VALIDATOR
+    return validator.is_valid(request.form['email'])
+
+
+class EmailValidator:
+    """
+    Checks email addresses against validate_email's RFC 2822 grammar, caching
+    the verdicts for the max_entries most recently seen addresses
+
+    Plain dot-atom addresses are accepted by a pattern that can't backtrack.
+    Only addresses with comments, folding whitespace, quoted strings or
+    domain literals are matched against validate_email's full pattern.
+    """
+    # Without any of these an address can only match as dot-atom@dot-atom;
+    # the newline is there because validate_email's $ matches before one
+    GRAMMAR_CHARACTERS = frozenset(' \t("[\n')
+    DOT_ATOM = r'(?:{0})++(?:\.(?:{0})++)*+'.format(ATEXT)
+    PLAIN_ADDRESS = re.compile(DOT_ATOM + '@' + DOT_ATOM)
+    # Verdicts on longer addresses aren't worth the memory (RFC 5321 caps
+    # addresses at 254 characters)
+    MAX_CACHED_LENGTH = 320
+
+    def __init__(self, max_entries=4096, pattern=None):
+        self.max_entries = max_entries
+        self.pattern = pattern or ADDRESS_PATTERN
+        self.verdicts = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def is_valid(self, address):
+        """Returns whether address is valid, checking it the first time"""
+        if len(address) > self.MAX_CACHED_LENGTH:
+            return self.check(address)
+        with self.lock:
+            verdict = self.verdicts.get(address)
+            if verdict is not None:
+                self.verdicts.move_to_end(address)
+                self.hits += 1
+                return verdict
+            self.misses += 1
+        verdict = self.check(address)
+        with self.lock:
+            self.verdicts[address] = verdict
+            while len(self.verdicts) > self.max_entries:
+                self.verdicts.popitem(last=False)
+                self.evictions += 1
+        return verdict
+
+    def check(self, address):
+        """Returns whether address is valid, without the cache"""
+        if self.PLAIN_ADDRESS.fullmatch(address):
+            return True
+        if self.GRAMMAR_CHARACTERS.isdisjoint(address):
+            return False
+        return self.pattern.match(address) is not None
+
+    def stats(self):
+        """Returns the number of cached verdicts and cache hits and misses"""
+        with self.lock:
+            return {
+                'entries': len(self.verdicts),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+# validate_email's grammar, for addresses that aren't plain dot-atoms
+ADDRESS_PATTERN = re.compile(VALID_ADDRESS_REGEXP)
+# Verdicts of is_valid_email calls that don't bring their own validator
+EMAIL_VALIDATOR = EmailValidator()
+
+
+def is_valid_recaptcha(request, verifier=None):
+    """
+    Check that recaptcha responce is valid
+    by sending a POST request to google's servers. With an
+    AsyncRecaptchaVerifier, returns a coroutine to await instead.
+    """
+    if verifier is None:
+        # A one-off verifier, whose session is closed once it has answered
+        with RecaptchaVerifier(conf.RECAPTCHA_SECRET) as verifier:
+            return is_valid_recaptcha(request, verifier)
+    return verifier.verify(request.form['g-recaptcha-response'],
+                           request.remote_addr)
+
+
+class RecaptchaVerifier:
+    """
+    Client for the reCAPTCHA siteverify endpoint
+
+    Keeps a pooled keep-alive HTTP session to the endpoint and bounds every
+    verification by connect_timeout and read_timeout (in seconds). If the
+    endpoint can't be reached or answered in time, verify returns fail_open:
+    False rejects the submission, True lets it through. It does so at once,
+    without calling the endpoint, while breaker (a CircuitBreaker) is open.
+    url can point at a local stand-in verifier for tests and benchmarks.
+    """
+    URL = 'https://www.google.com/recaptcha/api/siteverify'
+
+    def __init__(self, secret, url=URL, connect_timeout=2, read_timeout=3,
+                 fail_open=False, logger=None, transport=None, breaker=None):
+        self.secret = secret
+        self.url = url
+        self.fail_open = fail_open
+        self.breaker = breaker or CircuitBreaker('recaptcha')
+        self.logger = logger or logging.getLogger('formsender')
+        timeout = httpx.Timeout(read_timeout, connect=connect_timeout,
+                                pool=connect_timeout)
+        self.session = self.client_class(timeout=timeout, transport=transport)
+
+    client_class = httpx.Client
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Closes the HTTP session"""
+        self.session.close()
+
+    def verify(self, response, remote_ip=None):
+        """Returns True if siteverify accepts the reCAPTCHA response"""
+        try:
+            with self.breaker.call():
+                recaptcha_result = self.result(self.session.post(
+                    self.url, data=self.params(response, remote_ip)))
+        except CircuitOpen:
+            return self.failed('circuit breaker open')
+        except (httpx.HTTPError, ValueError) as error:
+            return self.failed(error)
+        return recaptcha_result.get('success') is True
+
+    def params(self, response, remote_ip):
+        """Returns the form posted to siteverify"""
+        params = {'secret': self.secret, 'response': response}
+        if remote_ip:
+            params['remoteip'] = remote_ip
+        return params
+
+    def result(self, google_response):
+        """
+        Returns siteverify's answer from its response, or raises
+        httpx.HTTPError or ValueError if it didn't give one
+        """
+        google_response.raise_for_status()
+        recaptcha_result = google_response.json()
+        if not isinstance(recaptcha_result, dict):
+            raise ValueError('unexpected answer: {!r}'.format(
+                recaptcha_result))
+        return recaptcha_result
+
+    def failed(self, error):
+        """Logs a verification that didn't complete, returns fail_open"""
+        self.logger.warning('formsender: reCAPTCHA verification failed '
+                            '(failing %s): %s',
+                            'open' if self.fail_open else 'closed', error)
+        return self.fail_open
+
+
+class AsyncRecaptchaVerifier(RecaptchaVerifier):
+    """RecaptchaVerifier whose verify is a coroutine, for the ASGI app"""
+    client_class = httpx.AsyncClient
+
+    async def verify(self, response, remote_ip=None):
+        """Returns True if siteverify accepts the reCAPTCHA response"""
+        try:
+            with self.breaker.call():
+                recaptcha_result = self.result(await self.session.post(
+                    self.url, data=self.params(response, remote_ip)))
+        except CircuitOpen:
+            return self.failed('circuit breaker open')
+        except (httpx.HTTPError, ValueError) as error:
+            return self.failed(error)
+        return recaptcha_result.get('success') is True
+
+
+def email_domain(address):
+    """
+    Returns the ASCII hostname an email address is delivered to, or None if
+    it has no plain hostname (a domain literal, comments, ...)
+    """
+    domain = address.rpartition('@')[2].rstrip('\n').lower()
+    try:
+        domain = domain.encode('idna').decode('ascii')
+    except UnicodeError:
+        return None
+    if HOSTNAME.fullmatch(domain):
+        return domain.rstrip('.')
+    return None
+
+
+class MXResolver:
+    """
+    Checks that email domains can receive mail by asking a nameserver for
+    their MX records
+
+    Every lookup is bounded by timeout (in seconds). Answers are cached for
+    their TTL (at most max_ttl), and names that don't exist or don't accept
+    mail (a null MX) for the TTL their zone gives negative answers, or
+    negative_ttl. The max_entries most recently used domains are kept. When
+    the nameserver fails or doesn't answer in time, is_deliverable returns
+    fail_open and nothing is cached. Domains that exist but have no MX record
+    are deliverable: mail falls back to their address records.
+
+    nameserver is 'host' or 'host:port' ('[host]:port' for IPv6) and
+    defaults to the first nameserver in /etc/resolv.conf.
+    """
+    MX, SOA = 15, 6
+    NOERROR, NXDOMAIN = 0, 3
+    HEADER = struct.Struct('!HHHHHH')
+    RECORD = struct.Struct('!HHIH')
+
+    def __init__(self, nameserver=None, timeout=1, max_entries=10000,
+                 negative_ttl=300, max_ttl=86400, fail_open=True,
+                 logger=None):
+        self.nameserver = parse_nameserver(nameserver or
+                                           system_nameserver())
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self.max_ttl = max_ttl
+        self.fail_open = fail_open
+        self.logger = logger or logging.getLogger('formsender')
+        self.answers = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.failures = 0
+
+    def is_deliverable(self, domain):
+        """Returns whether domain accepts mail, asking the first time"""
+        verdict = self.cached(domain)
+        if verdict is not None:
+            return verdict
+        query_id, query = self.question(domain)
+        try:
+            with socket.socket(self.family, socket.SOCK_DGRAM) as sock:
+                sock.connect(self.nameserver)
+                sock.send(query)
+                deadline = time.monotonic() + self.timeout
+                while True:
+                    sock.settimeout(max(deadline - time.monotonic(), 0))
+                    answer = self.answer(domain, sock.recv(4096), query_id)
+                    if answer is not None:
+                        return answer
+        except (OSError, ValueError) as error:
+            return self.failed(domain, error)
+
+    @property
+    def family(self):
+        return socket.AF_INET6 if ':' in self.nameserver[0] else socket.AF_INET
+
+    def cached(self, domain):
+        """Returns the cached verdict on domain, or None"""
+        with self.lock:
+            entry = self.answers.get(domain)
+            if entry is not None and entry[1] > time.monotonic():
+                self.answers.move_to_end(domain)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def store(self, domain, verdict, ttl):
+        """Caches verdict on domain for ttl seconds, returns verdict"""
+        with self.lock:
+            self.answers[domain] = (verdict, time.monotonic() + ttl)
+            self.answers.move_to_end(domain)
+            while len(self.answers) > self.max_entries:
+                self.answers.popitem(last=False)
+                self.evictions += 1
+        return verdict
+
+    def question(self, domain):
+        """Returns a query ID and an MX query for domain"""
+        query_id = random.getrandbits(16)
+        query = self.HEADER.pack(query_id, 0x0100, 1, 0, 0, 0)  # RD
+        for label in domain.split('.'):
+            query += bytes([len(label)]) + label.encode('ascii')
+        return query_id, query + struct.pack('!BHH', 0, self.MX, 1)
+
+    def answer(self, domain, response, query_id):
+        """
+        Caches and returns the verdict in the response to query query_id, or
+        returns None if response answers some other query. Raises ValueError
+        if the nameserver failed or its response can't be read.
+        """
+        try:
+            (response_id, flags, questions, answers,
+             authorities, _) = self.HEADER.unpack_from(response)
+        except struct.error:
+            raise ValueError('short DNS response')
+        if response_id != query_id or not flags & 0x8000:  # QR
+            return None
+        rcode = flags & 0x000F
+        if rcode not in (self.NOERROR, self.NXDOMAIN):
+            raise ValueError('DNS response code %d' % rcode)
+        try:
+            offset = self.HEADER.size
+            exchanges = []
+            ttls = []
+            negative_ttl = self.negative_ttl
+            for _ in range(questions):
+                offset = skip_name(response, offset) + 4
+            for _ in range(answers + authorities):
+                offset = skip_name(response, offset)
+                rtype, _, ttl, length = self.RECORD.unpack_from(response,
+                                                                offset)
+                offset += self.RECORD.size
+                data = response[offset:offset + length]
+                offset += length
+                if rtype == self.MX and len(data) >= 3:
+                    # A lone root label is a null MX (RFC 7505)
+                    exchanges.append(data[2:] != b'\x00')
+                    ttls.append(ttl)
+                elif rtype == self.SOA and len(data) >= 20:
+                    # Negative answers are cached for the lesser of the
+                    # SOA's TTL and MINIMUM (RFC 2308)
+                    negative_ttl = min(ttl, struct.unpack('!I', data[-4:])[0])
+        except struct.error:
+            raise ValueError('malformed DNS response')
+        # Names that exist without an MX record get mail at their address
+        verdict = rcode == self.NOERROR and (any(exchanges) or not exchanges)
+        ttl = min(ttls) if ttls else negative_ttl
+        return self.store(domain, verdict, min(ttl, self.max_ttl))
+
+    def failed(self, domain, error):
+        """Logs a lookup that didn't complete, returns fail_open"""
+        with self.lock:
+            self.failures += 1
+        self.logger.warning('formsender: MX lookup for %s failed '
+                            '(failing %s): %s', domain,
+                            'open' if self.fail_open else 'closed',
+                            error or 'timed out')
+        return self.fail_open
+
+    def stats(self):
+        """Returns the number of cached domains and cache hits and misses"""
+        with self.lock:
+            return {
+                'entries': len(self.answers),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'failures': self.failures,
+            }
+
+
+class AsyncMXResolver(MXResolver):
+    """MXResolver whose is_deliverable is a coroutine, for the ASGI app"""
+    async def is_deliverable(self, domain):
+        """Returns whether domain accepts mail, asking the first time"""
+        verdict = self.cached(domain)
+        if verdict is not None:
+            return verdict
+        query_id, query = self.question(domain)
+        loop = asyncio.get_running_loop()
+        answer = loop.create_future()
+        try:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: DatagramAnswer(answer, lambda response: self.answer(
+                    domain, response, query_id)),
+                remote_addr=self.nameserver, family=self.family)
+            try:
+                transport.sendto(query)
+                return await asyncio.wait_for(answer, self.timeout)
+            finally:
+                transport.close()
+        except (OSError, ValueError, asyncio.TimeoutError) as error:
+            return self.failed(domain, error)
+
+
+class DatagramAnswer(asyncio.DatagramProtocol):
+    """
+    Sets future to the first answer that read (a function of a datagram)
+    returns other than None, or to the exception it or the socket raises
+    """
+    def __init__(self, future, read):
+        self.future = future
+        self.read = read
+
+    def datagram_received(self, data, address):
+        if not self.future.done():
+            try:
+                answer = self.read(data)
+            except ValueError as error:
+                self.future.set_exception(error)
+            else:
+                if answer is not None:
+                    self.future.set_result(answer)
+
+    def error_received(self, error):
+        if not self.future.done():
+            self.future.set_exception(error)
+
+
+def skip_name(message, offset):
+    """Returns the offset just past the DNS name at offset in message"""
+    while True:
+        length = message[offset] if offset < len(message) else None
+        if length is None:
+            raise struct.error('name past end of message')
+        if length & 0xC0 == 0xC0:  # compression pointer
+            return offset + 2
+        offset += 1 + length
+        if length == 0:
+            return offset
+
+
+def parse_nameserver(nameserver):
+    """Returns the (host, port) of a 'host', 'host:port' or '[host]:port'"""
+    host, port = nameserver, 53
+    if nameserver.startswith('['):
+        host, _, port = nameserver[1:].partition(']')
+        port = port.lstrip(':') or 53
+    elif nameserver.count(':') == 1:
+        host, port = nameserver.split(':')
+    return host, int(port)
+
+
+def system_nameserver(path='/etc/resolv.conf'):
+    """Returns the first nameserver in resolv.conf, or 127.0.0.1"""
+    try:
+        with open(path) as resolv_conf:
+            for line in resolv_conf:
+                fields = line.split()
+                if len(fields) > 1 and fields[0] == 'nameserver':
+                    return ('[%s]' % fields[1] if ':' in fields[1] else
+                            fields[1])
+    except OSError:
+        pass
+    return '127.0.0.1'
+
+
+# Domains email_domain looks up; anything else skips the MX check
+HOSTNAME = re.compile(r'(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+'
+                      r'[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.?')
+
+
+def validate_name(request):
+    """
+    Make sure request has a 'name' field with more than just spaces return
+    stripped name if true, False if not
+    """
+    name = request.form['name']
+    if name.strip():
+        return True
+    return False
+
+
+def is_hidden_field_empty(request):
+    """Make sure hidden 'last_name' field is empty, return True or False"""
+    if request.form['last_name'] == "":
+        return True
+    return False
+
+
+def is_valid_token(request):
+    """Make sure request's 'token' field matches TOKEN in conf.py"""
+    if request.form['token'] == conf.TOKEN:
+        return True
+    return False
+
+
+def is_valid_fields_to_join(request):
+    """
+    Make sure that if request has 'fields_to_join' field, that the specified
+    fields to join exist
+    """
+    if 'fields_to_join' in request.form:
+        for field in request.form['fields_to_join'].split(','):
+            if field not in request.form and field != 'date':
+                return False
+    return True
+
+
+def is_valid_form(request):
+    """
+    Check the hidden field is empty, the token matches and the fields to
+    join exist (or, for a form with a FormDefinition, its required fields)
+    """
+    return (is_hidden_field_empty(request) and is_valid_token(request) and
+            (request.definition.is_valid(request.form)
+             if getattr(request, 'definition', None) else
+             is_valid_fields_to_join(request)))
+
+
+class Validator:
+    """
+    A check every submission must pass
+
+    check(app, submission) returns whether the submission passes, or in the
+    ASGI app an awaitable of that. cost is one of COST_CLASSES: 'cpu' checks
+    only look at the submission, 'state' checks read and update the rate and
+    duplicate tables, 'remote' checks wait on another service. A submission
+    that fails is rejected with error_number and error, logging its
+    invalid_option field. undo(app, submission), if given, takes back what a
+    passing check recorded of the submission, once a later check rejects it
+    or it couldn't be delivered.
+    """
+    __slots__ = ('name', 'cost', 'error_number', 'error', 'check',
+                 'invalid_option', 'undo')
+
+    COST_CLASSES = ('cpu', 'state', 'remote')
+
+    def __init__(self, name, cost, error_number, error, check,
+                 invalid_option='name', undo=None):
+        if cost not in self.COST_CLASSES:
+            raise ValueError('validator %s: unknown cost class %r'
+                             % (name, cost))
+        self.name = name
+        self.cost = cost
+        self.error_number = error_number
+        self.error = error
+        self.check = check
+        self.invalid_option = invalid_option
+        self.undo = undo
+
+    def __repr__(self):
+        return 'Validator(%r, %r)' % (self.name, self.cost)
+
+
+class ValidatorPipeline:
+    """
+    The validators a submission goes through, in the order they run:
+    cheapest cost class first, in the order given within a class
+
+    Validators named in order run first, in that order, and those named in
+    disabled don't run at all, so a deployment can reject the bots it sees
+    most with its cheapest checks.
+    """
+    def __init__(self, validators, order=(), disabled=()):
+        order = list(order)
+        unknown = (set(order) | set(disabled)) - {
+            validator.name for validator in validators}
+        if unknown:
+            raise ValueError('unknown validators: %s'
+                             % ', '.join(sorted(unknown)))
+        self.validators = tuple(sorted(
+            (validator for validator in validators
+             if validator.name not in disabled),
+            key=lambda validator: (
+                order.index(validator.name) if validator.name in order
+                else len(order),
+                Validator.COST_CLASSES.index(validator.cost))))
+
+    def __iter__(self):
+        return iter(self.validators)
+
+
+# The checks of Forms.find_invalid_field. Field checks read submission.form,
+# like they read request.form
+VALIDATORS = (
+    Validator('email', 'cpu', 1, 'Invalid Email',
+              lambda app, submission: is_valid_email(submission, app.emails),
+              'email'),
+    Validator('name', 'cpu', 2, 'Invalid Name',
+              lambda app, submission: validate_name(submission)),
+    Validator('form', 'cpu', 3, 'Improper Form Submission',
+              lambda app, submission: is_valid_form(submission)),
+    Validator('rate', 'state', 4, 'Too Many Requests',
+              lambda app, submission: not app.controller_of(
+                  submission).is_rate_violation(submission.client)),
+    Validator('duplicate', 'state', 5, 'Duplicate Request',
+              lambda app, submission: not app.controller_of(
+                  submission).is_duplicate(submission),
+              undo=lambda app, submission: app.controller_of(
+                  submission).forget(submission)),
+    Validator('mx', 'remote', 1, 'Invalid Email',
+              lambda app, submission: app.is_deliverable(submission),
+              'email'),
+    Validator('recaptcha', 'remote', 6, 'Invalid Recaptcha',
+              lambda app, submission: app.is_valid_recaptcha(submission)),
+)
+
+
+def create_error_url(error_number, message, request):
+    """Construct error message and append to redirect url"""
+    values = [('error', str(error_number)), ('message', message)]
+    query = six.moves.urllib.parse.urlencode(values)
+    return request.form['redirect'] + '?' + query
+
+
+def strip_query(url):
+    """Remove query string from a url"""
+    return url.split('?', 1)[0]
+
+
+def format_message(msg, exclude=None, layouts=None):
+    """Formats a dict (msg) into a nice-looking string
+
+    Fields named in ``exclude`` (e.g. those already sent as RT custom fields)
+    are left out of the body to avoid duplication. The layout of the body is
+    compiled once per form field-set and kept in layouts (BodyLayouts).
+    """
+    if layouts is None:
+        layouts = BODY_LAYOUTS
+    return layouts.get(msg, exclude).render(msg)
+
+
+class BodyLayout:
+    """
+    The ticket body layout of one form field-set
+
+    Compiled from the field names: which fields are shown, in which order
+    and under which title, and where fields_to_join goes. Rendering a message
+    is then a single pass over the rows.
+    """
+    __slots__ = ('rows', 'join_fields', 'join_key')
+
+    HEADER = ("Contact:\n--------\n"
+              "NAME:   {}\nEMAIL:   {}\n"
+              "\nInformation:\n------------\n")
+    # Ignore these fields when writing to formatted message
+    HIDDEN_FIELDS = frozenset([
+        'redirect', 'last_name', 'token', 'op', 'name', 'email',
+        'mail_subject', 'send_to', 'fields_to_join_name', 'support',
+        'ibm_power', 'mail_subject_prefix', 'mail_subject_key',
+        'custom_fields', 'g-recaptcha-response', 'body_template'])
+
+    def __init__(self, keys, exclude=None, fields_to_join=None,
+                 fields_to_join_name=None):
+        hidden_fields = self.HIDDEN_FIELDS.union(exclude or ())
+        keys = dict.fromkeys(keys)
+        self.join_fields = self.join_key = None
+        # If fields_to_join_name specified, the joined fields go under that
+        # name, otherwise under 'Fields To Join'
+        if fields_to_join is not None:
+            self.join_fields = tuple(fields_to_join.split(','))
+            if (fields_to_join_name is not None and
+                    fields_to_join_name not in keys):
+                self.join_key = str(fields_to_join_name)
+            else:
+                self.join_key = 'Fields To Join'
+            keys[self.join_key] = None
+            keys.pop('fields_to_join', None)
+        # Fields are sorted case-insensitively; of fields differing only in
+        # case the last one wins
+        titles = {}
+        for key in keys:
+            titles[key.lower()] = key
+        self.rows = tuple(
+            (titles[key], '{}:\n'.format(convert_key_to_title(titles[key])))
+            for key in sorted(titles) if key not in hidden_fields)
+
+    def items(self, msg):
+        """Returns the (title, value) of each shown field of msg"""
+        joined_data = None
+        if self.join_fields is not None:
+            joined_data = ':'.join(str(int(time.time())) if field == 'date'
+                                   else msg[field]
+                                   for field in self.join_fields)
+        return [(prefix[:-2], joined_data if key == self.join_key
+                 else msg[key]) for key, prefix in self.rows]
+
+    def render(self, msg):
+        """Returns the ticket body of msg"""
+        parts = [self.HEADER.format(msg['name'], msg['email'])]
+        for (_, prefix), (_, value) in zip(self.rows, self.items(msg)):
+            parts.append('{}{}\n\n'.format(prefix, value))
+        return ''.join(parts)
+
+
+class BodyLayouts:
+    """
+    BodyLayouts compiled so far, keyed by form field-set
+
+    Forms with the same fields (in the same order) and the same exclusions
+    and fields_to_join share a layout. The least recently used layout is
+    dropped once there are max_layouts.
+    """
+    def __init__(self, max_layouts=256):
+        self.max_layouts = max_layouts
+        self.layouts = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, msg, exclude=None):
+        """Returns the layout for msg, compiling it the first time"""
+        key = (tuple(msg), frozenset(exclude or ()),
+               msg.get('fields_to_join'), msg.get('fields_to_join_name'))
+        with self.lock:
+            layout = self.layouts.get(key)
+            if layout is not None:
+                self.layouts.move_to_end(key)
+                self.hits += 1
+                return layout
+            self.misses += 1
+        layout = BodyLayout(*key)
+        with self.lock:
+            self.layouts[key] = layout
+            while len(self.layouts) > self.max_layouts:
+                self.layouts.popitem(last=False)
+                self.evictions += 1
+        return layout
+
+    def stats(self):
+        """Returns the number of layouts and cache hits and misses"""
+        with self.lock:
+            return {
+                'entries': len(self.layouts),
+                'max_entries': self.max_layouts,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+# Layouts of format_message calls that don't bring their own
+BODY_LAYOUTS = BodyLayouts()
+# Names a form may give as body_template; keeps them inside templates/bodies
+BODY_TEMPLATE_NAME = re.compile(r'[A-Za-z0-9_-]+')
+
+
+def convert_key_to_title(snake_case_key):
+    """Replace underscores with spaces and convert to title case"""
+    return snake_case_key.replace('_', ' ').title()
+
+
+def set_mail_subject(message):
+    """
+    Returns a string to be used as a subject in an email, format:
+
+    message['mail_subject_prefix']: message[message['mail_subject_key']
+        or
+    message['mail_subject_prefix']
+        or
+    message[message['mail_subject_key']]
+        or the default
+    'Form Submission'
+    """
+    mail_subject = ''
+    # If mail_subject_prefix exists in the message dict and has content, add
+    # it to the mail_subject string. Then check if mail_subject_key also exists
+    # and points to valid data and append if necessary.
+    if 'mail_subject_prefix' in message and message['mail_subject_prefix']:
+        mail_subject += message['mail_subject_prefix']
+        if ('mail_subject_key' in message and
+                message['mail_subject_key'] and
                 message['mail_subject_key'] in message and
                 message[message['mail_subject_key']]):
             mail_subject += ": {}".format(message[message['mail_subject_key']])
 
-    # If mail_subject_key is in the message and the field it points to exists,
-    # add it to the mail_subject. It is ok if it is an empty string, because
-    # it will just be ignored
-    elif ('mail_subject_key' in message and
-            message['mail_subject_key'] in message):
-        mail_subject += message[message['mail_subject_key']]
+    # If mail_subject_key is in the message and the field it points to exists,
+    # add it to the mail_subject. It is ok if it is an empty string, because
+    # it will just be ignored
+    elif ('mail_subject_key' in message and
+            message['mail_subject_key'] in message):
+        mail_subject += message[message['mail_subject_key']]
+
+    # Otherwise mail_subject if it has something or the default
+    return mail_subject if mail_subject else 'Form Submission'
+
+
+def send_to_address(message):
+    """
+    Returns a string to be used as the address the email is being sent to
+
+    Default is 'support@osuosl.org'
+    """
+    # If a send to address is included in html form, return its assoc. string
+    if 'send_to' in message and message['send_to']:
+        return message['send_to']
+    # Otherwise, return default
+    return 'OSLSupport'
+
+
+def extract_attachments(request):
+    """
+    Turn any uploaded files in the request into SpooledAttachment objects so
+    they can be attached to the RT ticket. Files only arrive when the form is
+    submitted as multipart/form-data; empty file inputs are skipped.
+    """
+    attachments = []
+    for _, file_storage in request.files.items(multi=True):
+        if not file_storage or not file_storage.filename:
+            continue
+        # The upload is already in a spool file; measure it without reading
+        stream = file_storage.stream
+        size = stream.seek(0, os.SEEK_END)
+        if not size:
+            continue
+        file_type = file_storage.mimetype or 'application/octet-stream'
+        attachments.append(SpooledAttachment(file_storage.filename,
+                                             file_type, stream, size))
+    return attachments
+
+
+class SpooledAttachment:
+    """
+    A file to attach to an RT ticket, read from an open file instead of being
+    held in memory
+
+    Stands in for rt.rest2.Attachment: multipart_form_element hands RT's HTTP
+    client the open file, which it reads and uploads in chunks.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, file_name, file_type, stream, size):
+        self.file_name = file_name
+        self.file_type = file_type
+        self.stream = stream
+        self.size = size
+
+    @classmethod
+    def from_bytes(cls, file_name, file_type, content):
+        """Returns a SpooledAttachment holding content"""
+        stream = tempfile.SpooledTemporaryFile()
+        stream.write(content)
+        return cls(file_name, file_type, stream, len(content))
+
+    @property
+    def file_content(self):
+        """The whole file as bytes"""
+        self.stream.seek(0)
+        return self.stream.read()
+
+    def chunks(self):
+        """Yields the file's content CHUNK_SIZE bytes at a time"""
+        self.stream.seek(0)
+        chunk = self.stream.read(self.CHUNK_SIZE)
+        while chunk:
+            yield chunk
+            chunk = self.stream.read(self.CHUNK_SIZE)
+
+    def multipart_form_element(self):
+        """Convert to a tuple as required for multipart-form-data submission"""
+        self.stream.seek(0)
+        return self.file_name, self.stream, self.file_type
+
+    def to_dict(self):
+        """Convert to a dictionary for submitting to the REST API"""
+        return rt.rest2.Attachment(self.file_name, self.file_type,
+                                   self.file_content).to_dict()
+
+
+class UploadBudget:
+    """
+    Bytes of uploaded files a worker may keep in memory at once
+
+    Each uploaded file is written to a SpooledTemporaryFile that stays in
+    memory up to the share of the budget it reserved and rolls over to disk
+    beyond that; once the budget is used up, new files go straight to disk.
+    A file's reservation is returned when it is closed.
+    """
+    def __init__(self, limit=1024 * 1024):
+        self.limit = limit
+        self.reserved = 0
+        self.lock = threading.Lock()
+
+    def open(self, total_content_length):
+        """Returns a writable file for an upload in a request of this size"""
+        with self.lock:
+            size = min(self.limit - self.reserved, total_content_length or 0)
+            self.reserved += size
+        if size <= 0:
+            return tempfile.TemporaryFile('rb+')
+        return BudgetedFile(self, size)
+
+    def release(self, size):
+        """Returns size bytes to the budget"""
+        with self.lock:
+            self.reserved -= size
+
+
+class BudgetedFile(tempfile.SpooledTemporaryFile):
+    """SpooledTemporaryFile that returns its reservation to an UploadBudget"""
+    def __init__(self, budget, size):
+        super().__init__(max_size=size, mode='rb+')
+        self.budget = budget
+        self.budget_size = size
+
+    def close(self):
+        if self.budget is not None:
+            self.budget.release(self.budget_size)
+            self.budget = None
+        super().close()
+
+
+class ParseBudget:
+    """
+    How much parsing one form's body may allocate
+
+    max_parts       fields and files in the form
+    max_field_size  bytes of any one field, which is held in memory
+    max_files       uploaded files
+    max_file_size   bytes of any one uploaded file
+
+    The limits are checked as werkzeug streams the body in, so a body stops
+    being parsed at the first limit it goes over (see FormTooLarge). None
+    lifts a limit. Immutable, like FormDefinition.
+    """
+    LIMITS = ('max_parts', 'max_field_size', 'max_files', 'max_file_size')
+    __slots__ = LIMITS
+
+    def __init__(self, max_parts=1000, max_field_size=500 * 1024,
+                 max_files=10, max_file_size=None):
+        for name, value in zip(self.LIMITS, (max_parts, max_field_size,
+                                             max_files, max_file_size)):
+            if value is not None and (isinstance(value, bool) or
+                                      not isinstance(value, int) or
+                                      value < 0):
+                raise ValueError('{} must be a whole number'.format(name))
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ParseBudget is immutable')
+
+    def replace(self, **limits):
+        """Returns a ParseBudget with limits replacing these"""
+        values = {name: getattr(self, name) for name in self.LIMITS}
+        values.update(limits)
+        return ParseBudget(**values)
+
+
+class FormTooLarge(RequestEntityTooLarge):
+    """
+    A form that went over a limit of its ParseBudget. form holds the fields
+    parsed before it did.
+    """
+    def __init__(self, limit, form=None):
+        super().__init__('The form is over its {} limit.'.format(limit))
+        self.limit = limit
+        self.form = form
+
+
+class BudgetedFormDataParser(FormDataParser):
+    """
+    FormDataParser that reads forms through a BudgetedStream, and closes the
+    files it opened for a form that went over its budget
+    """
+    def __init__(self, budget, stream_factory=None, **kwargs):
+        # The stream checks field sizes itself: werkzeug holds the decoder's
+        # whole buffer, a read and all, to max_form_memory_size
+        super().__init__(stream_factory=self.open_file,
+                         max_form_memory_size=None,
+                         max_form_parts=budget.max_parts, **kwargs)
+        self.budget = budget
+        self.file_factory = stream_factory or default_stream_factory
+        self.files = []
+
+    def open_file(self, **kwargs):
+        """Returns a file for an upload, from the parser's stream_factory"""
+        file = self.file_factory(**kwargs)
+        self.files.append(file)
+        return file
+
+    def parse(self, stream, mimetype, content_length, options=None):
+        budgeted = BudgetedStream(stream, self.budget, mimetype,
+                                  options or {}, self.cls)
+        try:
+            _, form, files = super().parse(budgeted, mimetype,
+                                           content_length, options)
+        except FormTooLarge:
+            for file in self.files:
+                file.close()
+            raise
+        return stream, form, files
+
+
+class BudgetedStream:
+    """
+    Request body that counts the parts, files and bytes of the form werkzeug
+    reads from it against a ParseBudget, and stops the read that takes the
+    form over a limit (see FormTooLarge)
+
+    Multipart bodies are decoded as they are read, urlencoded ones split on
+    "&" as they are read. The fields read before the limit are kept for the
+    FormTooLarge.
+    """
+    def __init__(self, stream, budget, mimetype, options, cls):
+        self.stream = stream
+        self.budget = budget
+        self.cls = cls
+        self.fields = []
+        if mimetype == 'multipart/form-data':
+            boundary = options.get('boundary', '').encode('ascii')
+            self.check = self.check_multipart
+            self.decoder = MultipartDecoder(boundary)
+            # What the decoder keeps back of a part's data, in case it is the
+            # start of the boundary
+            self.held_back = len(b'\r\n--' + boundary)
+            self.parts = self.file_count = self.size = 0
+            # The part being read, its value so far (None for files) and limit
+            self.part = self.value = self.limit = self.name = None
+        elif mimetype == 'application/x-www-form-urlencoded':
+            self.check = self.check_urlencoded
+            self.body = bytearray()
+            # The "&"s read, and where in body the pair being read starts
+            # and its value (once its "=" is read) starts
+            self.pairs = self.pair_start = 0
+            self.value_start = None
+        else:
+            self.check = lambda data: None
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.check(data)
+        return data
+
+    def over(self, limit):
+        """Returns the FormTooLarge for the limit, with the fields so far"""
+        return FormTooLarge(limit, self.cls(self.fields))
+
+    def check_multipart(self, data):
+        """Counts the parts decoded from data against the budget"""
+        budget = self.budget
+        decoder = self.decoder
+        decoder.receive_data(data or None)
+        event = decoder.next_event()
+        while not isinstance(event, (Epilogue, NeedData)):
+            if isinstance(event, Data):
+                self.size += len(event.data)
+                if self.limit is not None and self.size > self.limit:
+                    raise self.over(self.name)
+                if self.value is not None:
+                    self.value.append(event.data)
+                    if not event.more_data:
+                        self.fields.append((self.part.name, b''.join(
+                            self.value).decode('utf-8', 'replace')))
+            elif isinstance(event, (Field, File)):
+                self.parts += 1
+                if budget.max_parts is not None and (
+                        self.parts > budget.max_parts):
+                    raise self.over('max_parts')
+                self.part = event
+                self.size = 0
+            if isinstance(event, Field):
+                self.limit, self.name = budget.max_field_size, 'max_field_size'
+                self.value = []
+            elif isinstance(event, File):
+                self.file_count += 1
+                if budget.max_files is not None and (
+                        self.file_count > budget.max_files):
+                    raise self.over('max_files')
+                self.limit, self.name = budget.max_file_size, 'max_file_size'
+                self.value = None
+            event = decoder.next_event()
+        # What is left undecoded is a part's headers (or the preamble), which
+        # are held to the field size too
+        if isinstance(event, NeedData) and (
+                budget.max_field_size is not None and
+                len(decoder.buffer) > budget.max_field_size + self.held_back):
+            raise self.over('max_field_size')
+
+    def check_urlencoded(self, data):
+        """
+        Counts the fields in data, the pairs it ends and the one it ends in,
+        against the budget. Only data is scanned, however the body is read.
+        """
+        budget = self.budget
+        self.pairs += data.count(b'&')
+        if budget.max_parts is not None and self.pairs >= budget.max_parts:
+            raise FormTooLarge('max_parts')
+        scanned = len(self.body)
+        self.body += data
+        if budget.max_field_size is None:
+            return
+        while True:
+            end = self.body.find(b'&', scanned)
+            if end < 0:
+                self.check_pair(scanned, len(self.body), complete=False)
+                return
+            self.check_pair(scanned, end)
+            self.pair_start = scanned = end + 1
+            self.value_start = None
+
+    def check_pair(self, scanned, end, complete=True):
+        """
+        Checks the value of the pair being read, up to end, against
+        max_field_size; the pair has no "=" before scanned
+        """
+        if self.value_start is None:
+            equals = self.body.find(b'=', scanned, end)
+            if equals < 0:
+                return
+            self.value_start = equals + 1
+        limit = self.budget.max_field_size
+        # Unquoting never lengthens a value, so only values over the limit as
+        # sent are unquoted to be measured
+        if end - self.value_start <= limit:
+            return
+        pair = bytes(self.body[self.pair_start:end])
+        if not complete:
+            # Leave out an escape that isn't all read yet
+            escape = pair.find(b'%', len(pair) - 2)
+            pair = pair if escape < 0 else pair[:escape]
+        if any(len(value) > limit for _, value in parse_urlencoded(pair)):
+            self.fields = parse_urlencoded(
+                bytes(self.body[:max(self.pair_start - 1, 0)]))
+            raise self.over('max_field_size')
+
+
+def parse_urlencoded(body):
+    """Splits a urlencoded body into (name, value) pairs, as werkzeug does"""
+    return six.moves.urllib.parse.parse_qsl(
+        body.decode(), keep_blank_values=True, errors='werkzeug.url_quote')
+
+
+class FormRequest(Request):
+    """
+    Request that spools uploaded files within the app's UploadBudget and
+    parses forms within its ParseBudget
+    """
+    upload_budget = None
+    parse_budget = None
+
+    def make_form_data_parser(self):
+        if self.parse_budget is None:
+            return super().make_form_data_parser()
+        return BudgetedFormDataParser(
+            self.parse_budget, stream_factory=self._get_file_stream,
+            max_content_length=self.max_content_length,
+            cls=self.parameter_storage_class)
+
+    def _load_form_data(self):
+        try:
+            super()._load_form_data()
+        except FormTooLarge as error:
+            # Keep the fields parsed so far, so the error can be redirected
+            self.__dict__['form'] = (error.form or
+                                     self.parameter_storage_class())
+            self.__dict__['files'] = self.parameter_storage_class()
+            raise
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        if self.upload_budget is None:
+            return super()._get_file_stream(total_content_length,
+                                            content_type, filename,
+                                            content_length)
+        return self.upload_budget.open(total_content_length)
+
+
+def extract_custom_fields(request):
+    """
+    Build an RT CustomFields dict from a declarative form mapping.
+
+    A hidden ``custom_fields`` field lists ``CFName:form_field`` pairs separated
+    by commas, e.g. ``CompanyName:companyname,WorkingGroups:workgroups``. Each
+    form field's value(s) are sent to the matching RT custom field; a field with
+    multiple values (e.g. a checkbox group) is sent as a list for multi-value
+    custom fields.
+
+    Returns a tuple of (custom_fields_dict, set_of_consumed_form_field_names) so
+    the consumed fields can be omitted from the ticket body.
+    """
+    custom_fields = {}
+    consumed = set()
+    spec = request.form.get('custom_fields', '')
+    for item in spec.split(','):
+        item = item.strip()
+        if not item or ':' not in item:
+            continue
+        cf_name, field = (part.strip() for part in item.split(':', 1))
+        if not cf_name or not field:
+            continue
+        # The form field is claimed by the mapping, so keep it out of the
+        # ticket body even when empty (an unfilled optional field should not
+        # show up as a blank line).
+        consumed.add(field)
+        values = [v for v in request.form.getlist(field) if v != '']
+        if not values:
+            continue
+        custom_fields[cf_name] = values[0] if len(values) == 1 else values
+    return custom_fields, consumed
+
+
+def send_ticket(msg, subject, send_to_queue='General',
+                mail_from='noreply@osuosl.org', attachments=None,
+                custom_fields=None):
+    """Creates ticket and sends to RT"""
+    return deliver_ticket(build_ticket_args(msg, subject, send_to_queue,
+                                            mail_from, attachments,
+                                            custom_fields))
+
+
+def build_ticket_args(msg, subject, send_to_queue='General',
+                      mail_from='noreply@osuosl.org', attachments=None,
+                      custom_fields=None):
+    """Returns the keyword arguments for rt.rest2.Rt.create_ticket"""
+    ticket_args = {
+        'queue': send_to_queue,
+        'subject': subject,
+        'content': msg,
+        'Requestor': mail_from,
+    }
+    # Only pass attachments/custom fields when present, so the call is unchanged
+    # for forms that submit no files or custom fields.
+    if attachments:
+        ticket_args['attachments'] = attachments
+    if custom_fields:
+        ticket_args['CustomFields'] = custom_fields
+    return ticket_args
+
+
+def deliver_ticket(ticket_args, tracker=None):
+    """
+    Creates a ticket in RT from build_ticket_args output, returns its ID. Uses
+    tracker if given, otherwise a new connection to RT.
+    """
+    if tracker is None:
+        # Creates connection to REST
+        tracker = rt.rest2.Rt(conf.URL, token=conf.RT_TOKEN)
+    ticket_args = dict(ticket_args)
+    ticket_args.pop('idempotency_key', None)
+    # Create ticket and send to RT
+    return tracker.create_ticket(**ticket_args)
+
+
+class ConcurrencyLimiter:
+    """
+    Adaptive limit on the tickets a worker has in flight to one RT, raised
+    and cut by how fast RT answers (additive increase, multiplicative
+    decrease)
+
+    A ticket created within latency_target seconds while at least half the
+    limit is in use raises the limit by 1 / limit, so by about one for each
+    limit's worth of tickets. A slower or failed one cuts it to backoff
+    times itself, at most once every latency_target seconds so a burst of
+    slow tickets counts once. The limit stays from min_limit to max_limit;
+    None lifts it, still tracking the tickets. Form posts that arrive while
+    the limit is in use are shed (see Admission) and told to retry after
+    about as long as RT has been taking.
+
+    With an InFlightTable (shared), the tickets held to the limit are those
+    every worker on the host has in flight, so sync workers, which have one
+    at most each, shed too. Each worker still adapts the limit from the
+    tickets it creates itself.
+    """
+    # Weight of the newest ticket in the smoothed latency
+    SMOOTHING = 0.2
+
+    def __init__(self, limit=50, min_limit=1, max_limit=200,
+                 latency_target=2, backoff=0.9, clock=time.monotonic,
+                 shared=None):
+        self.limit = None if limit is None else float(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.clock = clock
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.latency = None
+        self.decreased = None
+        self.shed = 0
+
+    def is_full(self):
+        """
+        Returns True, counting the post as shed, if the limit is in use
+        """
+        if self.limit is None:
+            return False
+        in_flight = (self.in_flight if self.shared is None
+                     else self.shared.total())
+        with self.lock:
+            if in_flight < int(self.limit):
+                return False
+            self.shed += 1
+            return True
+
+    def retry_after(self):
+        """Returns the seconds a shed post is asked to wait"""
+        return max(1, math.ceil(self.latency or 0))
+
+    @contextlib.contextmanager
+    def track(self):
+        """
+        Context manager that counts a ticket in flight while it runs and
+        adjusts the limit by how long it took and whether it raised
+        """
+        with self.lock:
+            self.in_flight += 1
+        if self.shared is not None:
+            self.shared.add(1)
+        started = self.clock()
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            self.release(self.clock() - started, succeeded)
+
+    def release(self, latency, succeeded):
+        """Counts a ticket that took latency seconds as no longer in flight"""
+        in_use = None if self.shared is None else self.shared.add(-1)
+        with self.lock:
+            if in_use is None:
+                in_use = self.in_flight
+            self.in_flight -= 1
+            self.latency = latency if self.latency is None else (
+                self.latency + self.SMOOTHING * (latency - self.latency))
+            if self.limit is None:
+                return
+            now = self.clock()
+            if not succeeded or latency > self.latency_target:
+                if (self.decreased is None or
+                        now - self.decreased >= self.latency_target):
+                    self.limit = max(self.min_limit,
+                                     self.limit * self.backoff)
+                    self.decreased = now
+            elif in_use * 2 >= self.limit:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def stats(self):
+        """Returns the limit, the tickets in flight and the posts shed"""
+        with self.lock:
+            stats = {
+                'in_flight': self.in_flight,
+                'shed': self.shed,
+                'latency_seconds': self.latency or 0,
+            }
+            if self.limit is not None:
+                stats['limit'] = self.limit
+        return stats
+
+
+class InFlightTable:
+    """
+    Tickets each worker on the host has in flight to one RT, kept in a file
+    the workers share
+
+    Each worker counts its tickets in a slot of its own, claimed the first
+    time it adds to the table, so the tickets of a worker that died while
+    delivering stop counting once its process is gone (and its slot is
+    claimed again). The file is small enough to be read whole: every
+    operation reads it under a POSIX lock (shared between processes) and a
+    thread lock (shared between threads). Past max_workers workers, the
+    tickets of those without a slot go uncounted.
+    """
+    # process ID, tickets in flight
+    SLOT = struct.Struct('<qq')
+
+    def __init__(self, path, max_workers=256):
+        self.path = path
+        self.max_workers = max_workers
+        self.thread_lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # Process ID -> its slot, so a process that reuses the ID of a
+        # dead one claims a slot of its own
+        self.own_slots = {}
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Holds the table lock across threads and processes"""
+        with self.thread_lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                data = os.pread(self.fd,
+                                self.max_workers * self.SLOT.size, 0)
+                yield list(self.SLOT.iter_unpack(
+                    data[:len(data) - len(data) % self.SLOT.size]))
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def add(self, change):
+        """
+        Adds change to this worker's tickets, returns how many tickets every
+        worker had in flight before
+        """
+        pid = os.getpid()
+        with self.locked() as slots:
+            live = self.live_slots(slots)
+            index = self.own_slots.get(pid)
+            if index is None:
+                index = next((index for index, slot in enumerate(slots)
+                              if index not in live), len(slots))
+                if index >= self.max_workers:
+                    return self.count(slots, live)
+                self.own_slots[pid] = index
+                tickets = 0
+            else:
+                tickets = slots[index][1]
+            os.pwrite(self.fd, self.SLOT.pack(pid, tickets + change),
+                      index * self.SLOT.size)
+        return self.count(slots, live)
+
+    def total(self):
+        """Returns how many tickets every worker has in flight"""
+        with self.locked() as slots:
+            return self.count(slots, self.live_slots(slots))
+
+    def live_slots(self, slots):
+        """
+        Returns the indexes of the slots claimed by processes still running,
+        this one's included
+        """
+        pid = os.getpid()
+        return {index for index, (slot_pid, _) in enumerate(slots)
+                if self.own_slots.get(pid) == index or (
+                    0 < slot_pid != pid and pid_exists(slot_pid))}
+
+    def count(self, slots, live):
+        """Returns the tickets of the live slots"""
+        return sum(slots[index][1] for index in live)
+
+
+def create_concurrency_limiter(tenant=None):
+    """
+    Returns a ConcurrencyLimiter configured from conf.py, for the app's RT
+    or the RT of the tenant called tenant. With the shared STATE_BACKEND,
+    it counts the tickets of every worker in an InFlightTable next to the
+    state file.
+    """
+    shared = None
+    if getattr(conf, 'STATE_BACKEND', 'local') == 'shared':
+        shared = InFlightTable(shared_state_path(tenant) + '.inflight')
+    return ConcurrencyLimiter(getattr(conf, 'RT_CONCURRENCY_LIMIT', 50),
+                              getattr(conf, 'RT_CONCURRENCY_MIN', 1),
+                              getattr(conf, 'RT_CONCURRENCY_MAX', 200),
+                              getattr(conf, 'RT_LATENCY_TARGET', 2),
+                              shared=shared)
+
+
+# RT errors that answer for the ticket rather than for RT's health: they
+# don't count against its CircuitBreaker
+RT_REFUSALS = (rt.exceptions.BadRequestError, rt.exceptions.NotFoundError,
+               rt.exceptions.InvalidUseError, rt.exceptions.NotAllowedError,
+               rt.exceptions.AuthorizationError)
+
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream (RT, reCAPTCHA) after it fails failures times
+    in a row
+
+    While closed, calls go through and count their failures. Once the
+    breaker opens, calls are refused at once for probe_interval seconds;
+    then it is half-open and lets a single call through as a probe. A probe
+    that succeeds closes the breaker again, one that fails reopens it for
+    another probe_interval. With metrics, the times it opens and the calls
+    it refuses are counted in formsender_circuit_opens_total and
+    formsender_circuit_rejections_total.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failures=5, probe_interval=30,
+                 clock=time.monotonic, metrics=None):
+        self.name = name
+        self.failures = failures
+        self.probe_interval = probe_interval
+        self.clock = clock
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failed_calls = 0
+        self.opened = None
+
+    def probe_due(self):
+        """Returns True if an open breaker has waited out probe_interval"""
+        return self.clock() - self.opened >= self.probe_interval
+
+    def is_open(self):
+        """
+        Returns True if a call would be refused now: the breaker is open and
+        not due a probe, or is half-open with its probe still running
+        """
+        with self.lock:
+            if self.state == self.OPEN:
+                return not self.probe_due()
+            return self.state == self.HALF_OPEN
+
+    def allow(self):
+        """
+        Returns True if a call may go through, letting the first one after
+        probe_interval through as the probe. Counts refused calls.
+        """
+        with self.lock:
+            if self.state == self.OPEN and self.probe_due():
+                self.state = self.HALF_OPEN
+                return True
+            if self.state == self.CLOSED:
+                return True
+        self.count('formsender_circuit_rejections_total')
+        return False
 
-    # Otherwise mail_subject if it has something or the default
-    return mail_subject if mail_subject else 'Form Submission'
+    def succeeded(self):
+        """Records a call that succeeded, closing the breaker"""
+        with self.lock:
+            self.state = self.CLOSED
+            self.failed_calls = 0
 
+    def failed(self):
+        """Records a call that failed, opening the breaker if need be"""
+        with self.lock:
+            self.failed_calls += 1
+            opens = False
+            if (self.state == self.HALF_OPEN or
+                    self.failed_calls >= self.failures):
+                opens = self.state != self.OPEN
+                self.state = self.OPEN
+                self.opened = self.clock()
+        if opens:
+            self.count('formsender_circuit_opens_total')
 
-def send_to_address(message):
+    def abandoned(self):
+        """
+        Records a call that was cancelled before it finished: a probe's
+        turn goes to the next call
+        """
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def count(self, name):
+        """Adds one to the breaker's counter called name"""
+        if self.metrics is not None:
+            self.metrics.inc(name, circuit=self.name)
+
+    def retry_after(self):
+        """Returns the seconds until the breaker lets a probe through"""
+        with self.lock:
+            if self.opened is None:
+                return 1
+            return max(1, math.ceil(
+                self.opened + self.probe_interval - self.clock()))
+
+    @contextlib.contextmanager
+    def call(self, refusals=()):
+        """
+        Context manager that raises CircuitOpen if the call isn't allowed,
+        and records whether it raised. refusals are exceptions that mean the
+        upstream answered, so count as a success, and are re-raised.
+        """
+        if not self.allow():
+            raise CircuitOpen(self)
+        try:
+            yield
+        except refusals:
+            self.succeeded()
+            raise
+        except Exception:
+            self.failed()
+            raise
+        except BaseException:
+            self.abandoned()
+            raise
+        self.succeeded()
+
+    def stats(self):
+        """Returns whether the breaker is open and its failures in a row"""
+        with self.lock:
+            return {
+                'open': int(self.state != self.CLOSED),
+                'failures': self.failed_calls,
+            }
+
+
+class CircuitOpen(ServiceUnavailable):
+    """503, with Retry-After, for a call refused by an open CircuitBreaker"""
+    def __init__(self, breaker):
+        super().__init__('{} is unavailable.'.format(breaker.name),
+                         retry_after=breaker.retry_after())
+        self.breaker = breaker
+
+
+def retry_kind(error):
     """
-    Returns a string to be used as the address the email is being sent to
+    Returns how a create that raised error may be retried: 'unsent' if it
+    can't have reached RT, 'unknown' if RT may have created the ticket all
+    the same, or None if retrying won't help. rt raises the builtin
+    ConnectionError for httpx2's transport errors, so pass its __cause__.
+    """
+    if isinstance(error, (rt.exceptions.ConnectionError, httpx2.ConnectError,
+                          httpx2.ConnectTimeout, httpx2.PoolTimeout)):
+        return 'unsent'
+    if isinstance(error, rt.exceptions.UnexpectedResponseError):
+        if error.status_code == 429:
+            return 'unsent'
+        if error.status_code is not None and error.status_code >= 500:
+            return 'unknown'
+        return None
+    if isinstance(error, (httpx2.TimeoutException, httpx2.NetworkError,
+                          httpx2.RemoteProtocolError)):
+        return 'unknown'
+    return None
 
-    Default is 'support@osuosl.org'
+
+def idempotency_key(submission):
     """
-    # If a send to address is included in html form, return its assoc. string
-    if 'send_to' in message and message['send_to']:
-        return message['send_to']
-    # Otherwise, return default
-    return 'OSLSupport'
+    Returns the key a submission's ticket is created under: the fingerprint
+    of its canonical content and the time it was received, so every attempt
+    to create it shares the key while the same form submitted again later
+    gets a new one
+    """
+    return '{}-{:x}'.format(submission.fingerprint.hex(), time.time_ns())
 
 
-def extract_attachments(request):
+class RetryPolicy:
     """
-    Turn any uploaded files in the request into rt.rest2.Attachment objects so
-    they can be attached to the RT ticket. Files only arrive when the form is
-    submitted as multipart/form-data; empty file inputs are skipped.
+    How often and how long to retry a failed call: exponential backoff with
+    full jitter, within a total time budget
+
+    The nth retry waits a random time from 0 to base_delay * 2 ** (n - 1)
+    seconds, capped at max_delay, so workers that failed together don't
+    retry together. There are at most attempts - 1 retries, and none that
+    would start more than budget seconds after the first attempt.
     """
-    attachments = []
-    for _, file_storage in request.files.items(multi=True):
-        if not file_storage or not file_storage.filename:
-            continue
-        content = file_storage.read()
-        if not content:
-            continue
-        file_type = file_storage.mimetype or 'application/octet-stream'
-        attachments.append(rt.rest2.Attachment(file_storage.filename,
-                                               file_type, content))
-    return attachments
+    def __init__(self, attempts=3, base_delay=0.5, max_delay=5, budget=10,
+                 clock=time.monotonic, jitter=random.uniform):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.clock = clock
+        self.jitter = jitter
 
+    def delays(self, started):
+        """
+        Yields the delay before each retry of a call first attempted at
+        started (by clock)
+        """
+        for retry in range(self.attempts - 1):
+            delay = self.jitter(0, min(self.max_delay,
+                                       self.base_delay * 2 ** retry))
+            if self.clock() + delay - started > self.budget:
+                return
+            yield delay
 
-def extract_custom_fields(request):
+
+class TicketLedger:
     """
-    Build an RT CustomFields dict from a declarative form mapping.
+    IDs of the tickets this worker created, by idempotency key, so a ticket
+    delivered twice (e.g. from the spool) is only created once
 
-    A hidden ``custom_fields`` field lists ``CFName:form_field`` pairs separated
-    by commas, e.g. ``CompanyName:companyname,WorkingGroups:workgroups``. Each
-    form field's value(s) are sent to the matching RT custom field; a field with
-    multiple values (e.g. a checkbox group) is sent as a list for multi-value
-    custom fields.
+    Holds the newest max_entries keys in an insertion-ordered dict.
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
 
-    Returns a tuple of (custom_fields_dict, set_of_consumed_form_field_names) so
-    the consumed fields can be omitted from the ticket body.
+    def get(self, key):
+        """Returns the ID of the ticket created under key, or None"""
+        with self.lock:
+            return self.entries.get(key)
+
+    def record(self, key, ticket_id):
+        """Remembers that the ticket created under key is ticket_id"""
+        if key is None:
+            return
+        with self.lock:
+            self.entries[key] = ticket_id
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+def create_circuit_breaker(name, prefix, metrics=None):
     """
-    custom_fields = {}
-    consumed = set()
-    spec = request.form.get('custom_fields', '')
-    for item in spec.split(','):
-        item = item.strip()
-        if not item or ':' not in item:
-            continue
-        cf_name, field = (part.strip() for part in item.split(':', 1))
-        if not cf_name or not field:
-            continue
-        # The form field is claimed by the mapping, so keep it out of the
-        # ticket body even when empty (an unfilled optional field should not
-        # show up as a blank line).
-        consumed.add(field)
-        values = [v for v in request.form.getlist(field) if v != '']
-        if not values:
-            continue
-        custom_fields[cf_name] = values[0] if len(values) == 1 else values
-    return custom_fields, consumed
+    Returns a CircuitBreaker named name configured from conf.py's
+    <prefix>_BREAKER_* settings, counting its trips in metrics
+    """
+    return CircuitBreaker(
+        name, getattr(conf, prefix + '_BREAKER_FAILURES', 5),
+        getattr(conf, prefix + '_BREAKER_PROBE_INTERVAL', 30),
+        metrics=metrics)
 
 
-def send_ticket(msg, subject, send_to_queue='General',
-                mail_from='noreply@osuosl.org', attachments=None,
-                custom_fields=None):
-    """Creates ticket and sends to RT"""
-    # Creates connection to REST
-    tracker = rt.rest2.Rt(conf.URL, token=conf.RT_TOKEN)
-    ticket_args = {
-        'queue': send_to_queue,
-        'subject': subject,
-        'content': msg,
-        'Requestor': mail_from,
+# What an RT client raises when its connection to RT fails: rt wraps the
+# HTTP client's transport errors in the builtin ConnectionError
+RT_CONNECTION_ERRORS = (ConnectionError, rt.exceptions.ConnectionError)
+
+
+class RTClientPool:
+    """
+    Long-lived RT REST2 clients shared by the requests of one worker
+
+    Each client keeps its HTTP session, so consecutive tickets reuse an open
+    keep-alive connection (and its TLS session) instead of handshaking with RT
+    every time. At most `size` clients exist at once; callers beyond that wait
+    for one to be returned. A client that hits a connection error is thrown
+    away and replaced on demand, and the whole pool is rebuilt when it is used
+    from a forked child, since sockets must not be shared across processes.
+    The clients connect to url with token, by default URL and RT_TOKEN.
+    """
+    preconnect_timeout = 2
+
+    def __init__(self, size=2, timeout=20, url=None, token=None):
+        self.size = size
+        self.timeout = timeout
+        self.url = url
+        self.token = token
+        self.reset()
+
+    def reset(self):
+        """Forgets every client, e.g. after a fork"""
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(self.size)
+        self.idle = []
+
+    def create(self):
+        """Returns a new RT client"""
+        return rt.rest2.Rt(self.url or conf.URL,
+                           token=self.token or conf.RT_TOKEN,
+                           http_timeout=self.timeout)
+
+    def preconnect(self, logger=None):
+        """
+        Opens a connection to RT for every client in the pool, so the first
+        tickets after a worker boots don't pay for the handshakes. Each
+        connection gets preconnect_timeout seconds; failures are logged.
+        """
+        if self.pid != os.getpid():
+            self.reset()
+        warmed = []
+        for _ in range(self.size - len(self.idle)):
+            tracker = self.create()
+            try:
+                tracker.session.get(tracker.url + 'rt',
+                                    timeout=self.preconnect_timeout)
+            except Exception as error:
+                if logger:
+                    logger.warning('formsender: could not pre-connect to RT: '
+                                   '%s', error)
+                continue
+            warmed.append(tracker)
+        for tracker in warmed:
+            self.checkin(tracker)
+        return len(self.idle)
+
+    def preconnect_in_background(self, logger=None):
+        """
+        Runs preconnect in a daemon thread and returns the thread, so a
+        worker boots at once even when RT is down
+        """
+        thread = threading.Thread(target=self.preconnect, args=(logger,),
+                                  name='formsender-preconnect', daemon=True)
+        thread.start()
+        return thread
+
+    @contextlib.contextmanager
+    def client(self):
+        """Context manager that checks a client out of the pool"""
+        if self.pid != os.getpid():
+            self.reset()
+        with self.slots:
+            with self.lock:
+                tracker = self.idle.pop() if self.idle else None
+            if tracker is None:
+                tracker = self.create()
+            healthy = True
+            try:
+                yield tracker
+            except RT_CONNECTION_ERRORS:
+                # The connection is in an unknown state, start over with a
+                # fresh client next time
+                healthy = False
+                tracker.session.close()
+                raise
+            finally:
+                if healthy:
+                    self.checkin(tracker)
+
+    def checkin(self, tracker):
+        """Returns a client to the pool"""
+        with self.lock:
+            self.idle.append(tracker)
+
+
+class AsyncRTClientPool(RTClientPool):
+    """
+    RTClientPool of rt.rest2.AsyncRt clients, for the ASGI app
+
+    Used from a single event loop, so waiting for a client suspends only the
+    request that waits. size bounds the tickets being created in RT at once.
+    """
+    def reset(self):
+        """Forgets every client, e.g. after a fork"""
+        self.pid = os.getpid()
+        self.slots = asyncio.Semaphore(self.size)
+        self.idle = []
+
+    def create(self):
+        """Returns a new RT client"""
+        return rt.rest2.AsyncRt(self.url or conf.URL,
+                                token=self.token or conf.RT_TOKEN,
+                                http_timeout=self.timeout)
+
+    async def preconnect(self, logger=None):
+        """
+        Opens a connection to RT for every client in the pool, so the first
+        tickets after a worker boots don't pay for the handshakes
+        """
+        if self.pid != os.getpid():
+            self.reset()
+        for _ in range(self.size - len(self.idle)):
+            tracker = self.create()
+            try:
+                await tracker.session.get(tracker.url + 'rt',
+                                          timeout=self.preconnect_timeout)
+            except Exception as error:
+                if logger:
+                    logger.warning('formsender: could not pre-connect to RT: '
+                                   '%s', error)
+                continue
+            self.idle.append(tracker)
+        return len(self.idle)
+
+    @contextlib.asynccontextmanager
+    async def client(self):
+        """Async context manager that checks a client out of the pool"""
+        if self.pid != os.getpid():
+            self.reset()
+        async with self.slots:
+            tracker = self.idle.pop() if self.idle else self.create()
+            healthy = True
+            try:
+                yield tracker
+            except RT_CONNECTION_ERRORS:
+                # The connection is in an unknown state, start over with a
+                # fresh client next time
+                healthy = False
+                await tracker.session.aclose()
+                raise
+            finally:
+                if healthy:
+                    self.idle.append(tracker)
+
+    async def aclose(self):
+        """Closes the idle clients"""
+        while self.idle:
+            await self.idle.pop().session.aclose()
+
+
+class Tenant:
+    """
+    An RT instance served by the app besides its own, and the forms that go
+    to it
+
+    Forms are routed to a tenant by the host they are posted to, a path
+    prefix they are posted under, or their form ID (see TenantTable). A
+    tenant's tickets are created at url with token, in queue when the form
+    doesn't name one, and its submissions have their own rate limits and
+    duplicates (controller) apart from other tenants', and its own
+    ConcurrencyLimiter and CircuitBreaker (counting its trips in metrics).
+    """
+    def __init__(self, name, url, token, queue=None, hosts=(), prefixes=(),
+                 forms=(), controller=None, rt_clients=None,
+                 async_rt_clients=None, metrics=None):
+        for setting, value in (('url', url), ('token', token),
+                               ('queue', queue or '')):
+            if not isinstance(value, str):
+                raise ValueError('tenant {}: {} must be a string'.format(
+                    name, setting))
+        if any(not prefix.startswith('/') or prefix == '/'
+               for prefix in prefixes):
+            raise ValueError('tenant {}: prefixes must start with / and '
+                             'name a path'.format(name))
+        self.name = name
+        self.url = url
+        self.queue = queue
+        self.hosts = tuple(host.lower() for host in hosts)
+        self.prefixes = tuple(prefix.rstrip('/') for prefix in prefixes)
+        self.forms = tuple(forms)
+        self.controller = controller or create_controller(name)
+        self.rt_clients = rt_clients or RTClientPool(
+            getattr(conf, 'RT_POOL_SIZE', 2), getattr(conf, 'RT_TIMEOUT', 20),
+            url, token)
+        self.async_rt_clients = async_rt_clients or AsyncRTClientPool(
+            getattr(conf, 'ASGI_RT_POOL_SIZE', 50),
+            getattr(conf, 'RT_TIMEOUT', 20), url, token)
+        self.limiter = create_concurrency_limiter(name)
+        self.rt_breaker = create_circuit_breaker('rt:' + name, 'RT', metrics)
+
+
+class TenantTable:
+    """
+    Tenants by name, and the tables routing forms to them
+
+    A form goes to the tenant of its form ID, else of the path prefix it is
+    posted under, else of the host it is posted to; forms none of them
+    claim stay with the app's own RT. Two tenants can't claim the same form
+    ID, prefix or host.
+    """
+    # Key of the environ of a request under a tenant's prefix
+    ENVIRON_KEY = 'formsender.tenant'
+
+    def __init__(self, tenants=()):
+        self.tenants = {}
+        self.by_form = {}
+        self.by_host = {}
+        self.by_prefix = {}
+        for tenant in tenants:
+            for table, keys in ((self.tenants, [tenant.name]),
+                                (self.by_form, tenant.forms),
+                                (self.by_host, tenant.hosts),
+                                (self.by_prefix, tenant.prefixes)):
+                for key in keys:
+                    if key in table:
+                        raise ValueError('tenant {}: {} is taken by '
+                                         'another tenant'.format(tenant.name,
+                                                                 key))
+                    table[key] = tenant
+        # Longest first, so a prefix is matched before its parents
+        self.prefixes = sorted(self.by_prefix, key=len, reverse=True)
+
+    @classmethod
+    def from_settings(cls, settings, previous=(), metrics=None):
+        """
+        Returns the TenantTable of settings, a mapping of tenant names to
+        the keyword arguments of their Tenant. Tenants named like one of
+        previous keep its Controller, and so its rate limits and duplicates.
+        Their breakers count their trips in metrics.
+        """
+        controllers = {tenant.name: tenant.controller for tenant in previous}
+        tenants = []
+        for name, options in settings.items():
+            try:
+                tenants.append(Tenant(name, controller=controllers.get(name),
+                                      metrics=metrics, **options))
+            except TypeError as error:
+                raise ValueError('tenant {}: {}'.format(name, error))
+        return cls(tenants)
+
+    def mount(self, environ):
+        """
+        Moves the tenant prefix at the start of environ's path, if there is
+        one, to its script name, so the app's routes match beneath it
+        """
+        path = environ.get('PATH_INFO', '')
+        for prefix in self.prefixes:
+            if path == prefix or path.startswith(prefix + '/'):
+                environ['SCRIPT_NAME'] = (environ.get('SCRIPT_NAME', '') +
+                                          prefix)
+                environ['PATH_INFO'] = path[len(prefix):] or '/'
+                environ[self.ENVIRON_KEY] = self.by_prefix[prefix]
+                return
+
+    def route(self, request, form_id=None):
+        """Returns the Tenant that request goes to, or None"""
+        if form_id in self.by_form:
+            return self.by_form[form_id]
+        if self.ENVIRON_KEY in request.environ:
+            return request.environ[self.ENVIRON_KEY]
+        host = request.host.lower()
+        return self.by_host.get(host) or self.by_host.get(
+            host.rsplit(':', 1)[0])
+
+    def get(self, name):
+        """Returns the tenant called name, raises ValueError if unknown"""
+        try:
+            return self.tenants[name]
+        except KeyError:
+            raise ValueError('No tenant {}'.format(name))
+
+    def __iter__(self):
+        return iter(self.tenants.values())
+
+    def __len__(self):
+        return len(self.tenants)
+
+
+class TicketSpool:
+    """
+    Durable on-disk queue of tickets waiting to be created in RT
+
+    Items live in a SQLite database in WAL mode, so every gunicorn worker on
+    the host can share one spool and an enqueued ticket survives a crash as
+    soon as enqueue returns. Each item records its delivery status:
+
+    pending   waiting to be sent (possibly after a failed attempt)
+    sending   claimed by a SpoolWorker; reclaimed if the lease expires
+    sent      created in RT, ticket_id holds the new ticket number
+    failed    gave up after SPOOL_MAX_ATTEMPTS, last_error holds the reason
+    """
+    def __init__(self, path, lease=300):
+        self.path = path
+        # Seconds before a 'sending' item is presumed lost with its worker
+        self.lease = lease
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # fsync on every commit so a queued ticket is never lost
+        self.conn.execute('PRAGMA synchronous=FULL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS tickets (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ticket TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                created REAL NOT NULL,
+                updated REAL NOT NULL,
+                ticket_id INTEGER,
+                last_error TEXT
+            )""")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS attachments (
+                item_id INTEGER NOT NULL REFERENCES tickets(id),
+                file_name TEXT NOT NULL,
+                file_type TEXT NOT NULL,
+                content BLOB NOT NULL
+            )""")
+        self.conn.execute('CREATE INDEX IF NOT EXISTS tickets_ready '
+                          'ON tickets (status, next_attempt)')
+
+    def enqueue(self, ticket_args):
+        """Durably stores ticket_args for delivery, returns the item id"""
+        args = dict(ticket_args)
+        attachments = args.pop('attachments', None) or []
+        now = time.time()
+        # The connection context manager commits, or rolls back on error
+        with self.lock, self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            cursor = self.conn.execute(
+                'INSERT INTO tickets (ticket, next_attempt, created, '
+                'updated) VALUES (?, ?, ?, ?)',
+                (json.dumps(args), now, now, now))
+            item_id = cursor.lastrowid
+            for attachment in attachments:
+                if not isinstance(attachment, SpooledAttachment):
+                    attachment = SpooledAttachment.from_bytes(
+                        attachment.file_name, attachment.file_type,
+                        attachment.file_content)
+                # Reserve the blob, then copy the file into it in chunks
+                cursor = self.conn.execute(
+                    'INSERT INTO attachments VALUES (?, ?, ?, zeroblob(?))',
+                    (item_id, attachment.file_name, attachment.file_type,
+                     attachment.size))
+                with self.conn.blobopen('attachments', 'content',
+                                        cursor.lastrowid) as blob:
+                    for chunk in attachment.chunks():
+                        blob.write(chunk)
+        return item_id
+
+    def claim(self):
+        """
+        Marks the oldest item that is due as 'sending' and returns
+        (item_id, attempts, ticket_args), or None when nothing is due
+        """
+        now = time.time()
+        with self.lock, self.conn:
+            # BEGIN IMMEDIATE takes the write lock up front so two workers
+            # (possibly in different processes) can never claim the same item
+            self.conn.execute('BEGIN IMMEDIATE')
+            row = self.conn.execute(
+                "SELECT id, attempts, ticket FROM tickets "
+                "WHERE (status = 'pending' AND next_attempt <= ?) "
+                "OR (status = 'sending' AND updated <= ?) "
+                "ORDER BY id LIMIT 1", (now, now - self.lease)).fetchone()
+            if row is None:
+                return None
+            item_id, attempts, ticket = row
+            self.conn.execute(
+                "UPDATE tickets SET status = 'sending', updated = ? "
+                "WHERE id = ?", (now, item_id))
+            attachments = []
+            for rowid, name, file_type, size in self.conn.execute(
+                    'SELECT rowid, file_name, file_type, length(content) '
+                    'FROM attachments WHERE item_id = ? ORDER BY rowid',
+                    (item_id,)).fetchall():
+                # Copy the blob out in chunks rather than loading it whole
+                stream = tempfile.TemporaryFile('rb+')
+                with self.conn.blobopen('attachments', 'content', rowid,
+                                        readonly=True) as blob:
+                    chunk = blob.read(SpooledAttachment.CHUNK_SIZE)
+                    while chunk:
+                        stream.write(chunk)
+                        chunk = blob.read(SpooledAttachment.CHUNK_SIZE)
+                attachments.append(SpooledAttachment(name, file_type, stream,
+                                                     size))
+        ticket_args = json.loads(ticket)
+        if attachments:
+            ticket_args['attachments'] = attachments
+        return item_id, attempts, ticket_args
+
+    def mark_sent(self, item_id, ticket_id):
+        """Records a successful delivery and drops the stored attachments"""
+        with self.lock, self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.execute(
+                "UPDATE tickets SET status = 'sent', ticket_id = ?, "
+                "attempts = attempts + 1, updated = ?, last_error = NULL "
+                "WHERE id = ?", (ticket_id, time.time(), item_id))
+            self.conn.execute('DELETE FROM attachments WHERE item_id = ?',
+                              (item_id,))
+
+    def mark_failed(self, item_id, error, retry_at=None):
+        """
+        Records a failed attempt; the item is retried at retry_at, or marked
+        'failed' for good when retry_at is None
+        """
+        status = 'failed' if retry_at is None else 'pending'
+        with self.lock:
+            self.conn.execute(
+                "UPDATE tickets SET status = ?, attempts = attempts + 1, "
+                "next_attempt = ?, updated = ?, last_error = ? WHERE id = ?",
+                (status, retry_at or 0, time.time(), error, item_id))
+
+    def status(self, item_id):
+        """Returns (status, attempts, ticket_id, last_error) for an item"""
+        with self.lock:
+            return self.conn.execute(
+                'SELECT status, attempts, ticket_id, last_error FROM tickets '
+                'WHERE id = ?', (item_id,)).fetchone()
+
+    def counts(self):
+        """Returns a dict of item counts keyed by status"""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT status, COUNT(*) FROM tickets GROUP BY status')
+            return dict(rows.fetchall())
+
+
+class SpoolWorker(threading.Thread):
+    """
+    Background thread that drains a TicketSpool into RT
+
+    Failed deliveries are retried with exponential backoff starting at
+    SPOOL_RETRY_DELAY seconds, up to SPOOL_MAX_ATTEMPTS attempts.
+    """
+    def __init__(self, spool, logger, deliver=None):
+        super().__init__(name='formsender-spool', daemon=True)
+        self.spool = spool
+        self.logger = logger
+        self.deliver = deliver or deliver_ticket
+        self.max_attempts = getattr(conf, 'SPOOL_MAX_ATTEMPTS', 8)
+        self.retry_delay = getattr(conf, 'SPOOL_RETRY_DELAY', 30)
+        self.poll_interval = getattr(conf, 'SPOOL_POLL_INTERVAL', 5)
+        self.stopping = threading.Event()
+
+    def run(self):
+        """Delivers due items until stop() is called"""
+        while not self.stopping.is_set():
+            if not self.deliver_one():
+                self.stopping.wait(self.poll_interval)
+
+    def stop(self):
+        """Asks the worker to exit after the current delivery"""
+        self.stopping.set()
+
+    def deliver_one(self):
+        """Delivers the next due item, returns False if nothing was due"""
+        claimed = self.spool.claim()
+        if claimed is None:
+            return False
+        item_id, attempts, ticket_args = claimed
+        try:
+            ticket_id = self.deliver(ticket_args)
+        except Exception as error:
+            attempts += 1
+            if attempts >= self.max_attempts:
+                self.logger.error('formsender: giving up on spooled item %s '
+                                  'after %s attempts: %s', item_id, attempts,
+                                  error)
+                self.spool.mark_failed(item_id, str(error))
+            else:
+                delay = self.retry_delay * 2 ** (attempts - 1)
+                self.logger.warning('formsender: spooled item %s failed, '
+                                    'retrying in %ss: %s', item_id, delay,
+                                    error)
+                self.spool.mark_failed(item_id, str(error),
+                                       time.time() + delay)
+        else:
+            self.logger.debug('formsender: spooled item %s created ticket %s',
+                              item_id, ticket_id)
+            self.spool.mark_sent(item_id, ticket_id)
+        finally:
+            for attachment in ticket_args.get('attachments', ()):
+                attachment.stream.close()
+        return True
+
+
+class Tracer:
+    """
+    Samples requests for tracing and exports their spans
+
+    start returns a Trace for sample_rate of the requests and NULL_TRACE for
+    the rest, whose spans cost next to nothing. Finished traces are handed to
+    exporter (if any) on a background thread, so exporting never delays a
+    request. At most max_queued traces wait for the exporter; while it lags
+    behind further traces are dropped, and counted in
+    formsender_traces_dropped_total with metrics.
+    """
+    def __init__(self, sample_rate=0.0, exporter=None, max_queued=1000,
+                 metrics=None):
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+        self.metrics = metrics
+        self.queue = None
+        if exporter is not None:
+            self.queue = queue.Queue(maxsize=max_queued)
+            threading.Thread(target=self.export_traces, daemon=True,
+                             name='formsender-tracer').start()
+
+    def start(self):
+        """Returns a Trace if this request is sampled, NULL_TRACE if not"""
+        if self.sample_rate and random.random() < self.sample_rate:
+            return Trace(self)
+        return NULL_TRACE
+
+    def export(self, trace):
+        """Queues a finished trace for the exporter"""
+        if self.queue is None:
+            return
+        try:
+            self.queue.put_nowait(trace.to_dict())
+        except queue.Full:
+            if self.metrics is not None:
+                self.metrics.inc('formsender_traces_dropped_total')
+
+    def export_traces(self):
+        """Hands queued traces to the exporter, forever"""
+        while True:
+            trace = self.queue.get()
+            try:
+                self.exporter(trace)
+            except Exception as error:
+                logging.getLogger('formsender').warning(
+                    'formsender: could not export trace %s: %s',
+                    trace['trace_id'], error)
+
+
+class Trace:
+    """
+    The spans of one sampled request, identified by a random trace ID
+
+    Each span is recorded as (name, start, duration) with times in seconds,
+    start being relative to the start of the trace.
+    """
+    sampled = True
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+        self.trace_id = os.urandom(16).hex()
+        self.start_time = time.time()
+        self.started = time.perf_counter()
+        self.spans = []
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """Context manager that records its duration as a span"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            ended = time.perf_counter()
+            self.spans.append((name, started - self.started, ended - started))
+
+    def finish(self):
+        """Ends the trace and exports it"""
+        self.duration = time.perf_counter() - self.started
+        self.tracer.export(self)
+
+    def server_timing(self):
+        """Returns the spans as a Server-Timing header value"""
+        return ', '.join('{};dur={:.3f}'.format(name, duration * 1000)
+                         for name, _, duration in self.spans)
+
+    def to_dict(self):
+        """Returns the trace as a JSON-serializable dict"""
+        return {
+            'trace_id': self.trace_id,
+            'start': self.start_time,
+            'duration': self.duration,
+            'spans': [{'name': name, 'start': start, 'duration': duration}
+                      for name, start, duration in self.spans],
+        }
+
+
+class NullTrace:
+    """Stands in for the Trace of a request that isn't sampled"""
+    sampled = False
+    trace_id = None
+
+    def span(self, name):
+        """Does nothing"""
+        return contextlib.nullcontext()
+
+    def finish(self):
+        """Does nothing"""
+
+
+NULL_TRACE = NullTrace()
+
+
+class JSONLinesExporter:
+    """Trace exporter that appends each trace as a line of JSON to a file"""
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, trace):
+        with open(self.path, 'a') as trace_file:
+            trace_file.write(json.dumps(trace) + '\n')
+
+
+class OTLPExporter:
+    """
+    Trace exporter that posts each trace to an OTLP/HTTP collector, in the
+    OTLP JSON encoding
+    """
+    def __init__(self, endpoint, timeout=2, transport=None):
+        self.endpoint = endpoint
+        self.session = httpx.Client(timeout=timeout, transport=transport)
+
+    def __call__(self, trace):
+        start = int(trace['start'] * 1e9)
+        spans = [{
+            'traceId': trace['trace_id'],
+            'spanId': os.urandom(8).hex(),
+            'name': span['name'],
+            'kind': 1,
+            'startTimeUnixNano': str(start + int(span['start'] * 1e9)),
+            'endTimeUnixNano': str(start + int((span['start'] +
+                                                span['duration']) * 1e9)),
+        } for span in trace['spans']]
+        self.session.post(self.endpoint, json={'resourceSpans': [{
+            'resource': {'attributes': [{
+                'key': 'service.name',
+                'value': {'stringValue': 'formsender'}}]},
+            'scopeSpans': [{'scope': {'name': 'formsender'},
+                            'spans': spans}],
+        }]}).raise_for_status()
+
+
+def create_tracer(metrics=None):
+    """Returns a Tracer configured from conf.py, counting in metrics"""
+    export = getattr(conf, 'TRACE_EXPORT', None)
+    exporter = None
+    if export == 'jsonl':
+        exporter = JSONLinesExporter(getattr(conf, 'TRACE_PATH',
+                                             '/tmp/formsender-traces.jsonl'))
+    elif export == 'otlp':
+        exporter = OTLPExporter(getattr(conf, 'TRACE_ENDPOINT',
+                                        'http://localhost:4318/v1/traces'))
+    return Tracer(getattr(conf, 'TRACE_SAMPLE_RATE', 0.0), exporter,
+                  getattr(conf, 'TRACE_QUEUE_SIZE', 1000), metrics)
+
+
+class Metrics:
+    """
+    Per-worker registry of counters and histograms, rendered in the
+    Prometheus text format
+
+    Metrics are kept in plain dicts keyed by (name, labels) and updated under
+    a lock, so recording one costs a dict lookup and an addition. Gauges are
+    not stored but read at scrape time from the callables passed to collect.
+
+    Gunicorn runs several workers and a scrape reaches only one of them, so
+    when directory is set every worker writes a snapshot of its metrics to
+    <directory>/<pid>.json at most every flush_interval seconds, and render
+    adds up the snapshots of all workers. The snapshot of a worker that has
+    exited is removed and its counters and histograms added to
+    <directory>/retired.json (counters never go down); its gauges are
+    dropped. So is a snapshot left under this worker's pid by an earlier
+    process, when this worker first flushes.
+    """
+    RETIRED = 'retired.json'
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    HELP = {
+        'formsender_request_duration_seconds':
+            ('histogram', 'Time spent handling a request'),
+        'formsender_validation_duration_seconds':
+            ('histogram', 'Time spent validating a submission'),
+        'formsender_validator_duration_seconds':
+            ('histogram', 'Time spent in each validator'),
+        'formsender_validator_rejections_total':
+            ('counter', 'Submissions rejected, by validator'),
+        'formsender_recaptcha_duration_seconds':
+            ('histogram', 'Time spent verifying a reCAPTCHA response'),
+        'formsender_send_ticket_duration_seconds':
+            ('histogram', 'Time spent creating a ticket in RT'),
+        'formsender_rejections_total':
+            ('counter', 'Submissions rejected, by error number'),
+        'formsender_http_errors_total':
+            ('counter', 'Requests answered with an HTTP error, by status'),
+        'formsender_admission_rejections_total':
+            ('counter', 'Requests turned away before reading their body, '
+                        'by status'),
+        'formsender_attachment_bytes_total':
+            ('counter', 'Bytes of uploaded files attached to tickets'),
+        'formsender_rt_concurrency_limit':
+            ('gauge', 'Tickets a worker may have in flight to RT'),
+        'formsender_rt_concurrency_in_flight':
+            ('gauge', 'Tickets a worker has in flight to RT'),
+        'formsender_rt_concurrency_shed':
+            ('gauge', 'Form posts a worker turned away over the RT limit'),
+        'formsender_rt_concurrency_latency_seconds':
+            ('gauge', 'Smoothed time RT takes to create a ticket'),
+        'formsender_rt_retries_total':
+            ('counter', 'Retried ticket creates, by kind of failure'),
+        'formsender_rt_idempotent_hits_total':
+            ('counter', 'Tickets found already created under their '
+                        'idempotency key, by source'),
+        'formsender_circuit_open':
+            ('gauge', 'Whether a circuit breaker is open or half-open'),
+        'formsender_circuit_failures':
+            ('gauge', 'Calls that failed in a row, by circuit'),
+        'formsender_circuit_opens_total':
+            ('counter', 'Times a circuit breaker opened, by circuit'),
+        'formsender_circuit_rejections_total':
+            ('counter', 'Calls refused while a circuit breaker was open'),
+        'formsender_traces_dropped_total':
+            ('counter', 'Traces dropped while the exporter lagged behind'),
+        'formsender_settings_reloads_total':
+            ('counter', 'Settings reloads, by result'),
+        'formsender_settings_version':
+            ('gauge', 'Version of the settings a worker runs with'),
     }
-    # Only pass attachments/custom fields when present, so the call is unchanged
-    # for forms that submit no files or custom fields.
-    if attachments:
-        ticket_args['attachments'] = attachments
-    if custom_fields:
-        ticket_args['CustomFields'] = custom_fields
-    # Create ticket and send to RT
-    tracker.create_ticket(**ticket_args)
+
+    def __init__(self, directory=None, flush_interval=5):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> [count per bucket..., +Inf count, sum]
+        self.histograms = {}
+        self.collectors = []
+        self.flushed = None
+        # The pid this worker last flushed its snapshot as
+        self.flushed_pid = None
+
+    @staticmethod
+    def key(name, labels):
+        """Returns the registry key for a metric name and label dict"""
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        """Adds amount to a counter"""
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """Records value in a histogram"""
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    break
+            else:
+                i = len(self.BUCKETS)
+            histogram[i] += 1
+            histogram[-1] += value
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Context manager that records its duration in a histogram"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def collect(self, collector):
+        """
+        Registers a callable returning a list of (name, labels, value) gauges
+        """
+        self.collectors.append(collector)
+
+    def snapshot(self):
+        """Returns this worker's metrics as a JSON-serializable dict"""
+        with self.lock:
+            counters = [[name, labels, value] for (name, labels), value
+                        in self.counters.items()]
+            histograms = [[name, labels, list(values)] for (name, labels),
+                          values in self.histograms.items()]
+        gauges = [[name, sorted(labels.items()), value]
+                  for collector in self.collectors
+                  for name, labels, value in collector()]
+        return {'pid': os.getpid(), 'counters': counters,
+                'histograms': histograms, 'gauges': gauges}
+
+    def maybe_flush(self):
+        """Writes this worker's snapshot if flush_interval has passed"""
+        if self.directory and (self.flushed is None or
+                               time.monotonic() - self.flushed >=
+                               self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Writes this worker's snapshot to the metrics directory"""
+        self.flushed = time.monotonic()
+        path = os.path.join(self.directory, '{}.json'.format(os.getpid()))
+        if self.flushed_pid != os.getpid():
+            # A snapshot already there is an earlier process's
+            self.flushed_pid = os.getpid()
+            snapshot = self.read_snapshot(path)
+            if snapshot is not None:
+                self.retire(path, snapshot)
+        with open(path + '.tmp', 'w') as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file)
+        # Replace atomically so a scrape never reads half a snapshot
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def read_snapshot(path):
+        """Returns the snapshot in the file at path, or None"""
+        try:
+            with open(path) as snapshot:
+                return json.load(snapshot)
+        except (OSError, ValueError):
+            return None
+
+    def snapshots(self):
+        """
+        Returns this worker's snapshot, those of the other workers and the
+        retired one, retiring the snapshots of workers that have exited
+        """
+        snapshots = [self.snapshot()]
+        if not self.directory:
+            return snapshots
+        for name in os.listdir(self.directory):
+            pid, ext = os.path.splitext(name)
+            if (ext != '.json' or name == self.RETIRED or
+                    pid == str(os.getpid())):
+                continue
+            path = os.path.join(self.directory, name)
+            snapshot = self.read_snapshot(path)
+            if snapshot is None:
+                continue
+            if pid_exists(snapshot['pid']):
+                snapshots.append(snapshot)
+            else:
+                self.retire(path, snapshot)
+        retired = self.read_snapshot(os.path.join(self.directory,
+                                                  self.RETIRED))
+        if retired is not None:
+            snapshots.append(retired)
+        return snapshots
+
+    def retire(self, path, snapshot):
+        """
+        Removes the snapshot at path, of a process that has exited, adding
+        its counters and histograms to the retired snapshot. Of the workers
+        retiring it at once, the one that renames it first does.
+        """
+        claimed = '{}.{}'.format(path, os.getpid())
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return
+        retired_path = os.path.join(self.directory, self.RETIRED)
+        with open(retired_path + '.lock', 'a') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            retired = self.read_snapshot(retired_path) or {
+                'pid': None, 'counters': [], 'histograms': [], 'gauges': []}
+            counters, histograms = self.add_up([retired, snapshot])
+            retired['counters'] = [[name, labels, value] for (name, labels),
+                                   value in counters.items()]
+            retired['histograms'] = [[name, labels, values] for
+                                     (name, labels), values
+                                     in histograms.items()]
+            with open(retired_path + '.tmp', 'w') as retired_file:
+                json.dump(retired, retired_file)
+            os.replace(retired_path + '.tmp', retired_path)
+        os.unlink(claimed)
+
+    @staticmethod
+    def add_up(snapshots):
+        """
+        Returns the counters and histograms of snapshots added up, keyed by
+        (name, labels)
+        """
+        counters = {}
+        histograms = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot['counters']:
+                key = name, tuple(map(tuple, labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in snapshot['histograms']:
+                key = name, tuple(map(tuple, labels))
+                total = histograms.setdefault(key, [0] * len(values))
+                histograms[key] = [a + b for a, b in zip(total, values)]
+        return counters, histograms
+
+    def render(self):
+        """Returns every worker's metrics in the Prometheus text format"""
+        snapshots = self.snapshots()
+        counters, histograms = self.add_up(snapshots)
+        gauges = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot['gauges']:
+                labels = tuple(map(tuple, labels)) + (
+                    ('pid', str(snapshot['pid'])),)
+                gauges[name, labels] = value
+
+        lines = []
+        described = set()
+
+        def describe(name, default_type):
+            if name not in described:
+                described.add(name)
+                metric_type, text = self.HELP.get(name, (default_type, None))
+                if text:
+                    lines.append('# HELP {} {}'.format(name, text))
+                lines.append('# TYPE {} {}'.format(name, metric_type))
+
+        for (name, labels), value in sorted(counters.items()):
+            describe(name, 'counter')
+            lines.append(format_sample(name, labels, value))
+        for (name, labels), values in sorted(histograms.items()):
+            describe(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), values):
+                cumulative += count
+                lines.append(format_sample(name + '_bucket',
+                                           labels + (('le', str(bound)),),
+                                           cumulative))
+            lines.append(format_sample(name + '_sum', labels, values[-1]))
+            lines.append(format_sample(name + '_count', labels, cumulative))
+        for (name, labels), value in sorted(gauges.items()):
+            describe(name, 'gauge')
+            lines.append(format_sample(name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+def format_sample(name, labels, value):
+    """Formats one sample line of the Prometheus text format"""
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+    return '{} {}'.format(name, value)
+
+
+def pid_exists(pid):
+    """Returns True if a process with this pid is running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
 
 
 # Start application
@@ -9,7 +9,7 @@ dependencies = [
     'pydns==2.3.6',
     'redis==2.10.3',
     'validate-email==1.3',
-    'werkzeug>=3.0.6',
+    'werkzeug>=3.1.4,<3.2',
     'wheel>=0.38.1'
 ]
 
@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import unittest
 import werkzeug
 from io import BytesIO
@@ -5,11 +8,30 @@ from datetime import datetime, timedelta
 from werkzeug.wrappers import Request
 from werkzeug.test import EnvironBuilder, Client
 from werkzeug.datastructures import MultiDict
-from mock import Mock, patch
+from werkzeug.utils import redirect
+from mock import AsyncMock, MagicMock, Mock, patch
 import conf
+import asyncio
+import httpx
+import httpx2
+import json
+import re
+import io
+import sys
+import types
+import socket
+import signal
+import struct
+import subprocess
+import logging
+import threading
 import time
 import request_handler as handler
 import rt
+from validate_email import VALID_ADDRESS_REGEXP
+
+# The real RT client: some tests replace rt.rest2.Rt with a Mock for good
+RT_CLIENT = rt.rest2.Rt
 
 
 class TestFormsender(unittest.TestCase):
@@ -162,9 +184,7 @@ class TestFormsender(unittest.TestCase):
         self.assertIn('hello', body)
 
     @patch('request_handler.is_valid_recaptcha')
-    @patch('request_handler.validate_email')
-    def test_validations_valid_data(self, mock_validate_email,
-                                    mock_recaptcha):
+    def test_validations_valid_data(self, mock_recaptcha):
         """
         Tests the form validation with valid data.
 
@@ -181,7 +201,6 @@ class TestFormsender(unittest.TestCase):
         env = builder.get_environ()
         req = Request(env)
         # Mock external services so they return valid in CI
-        mock_validate_email.return_value = True
         mock_recaptcha.return_value = True
         app = handler.create_app()
         # Mock create_ticket function so it doesn't send an actual ticket
@@ -189,8 +208,7 @@ class TestFormsender(unittest.TestCase):
         app.on_form_page(req)
         self.assertEqual(app.error, None)
 
-    @patch('request_handler.validate_email')
-    def test_validations_invalid_name(self, mock_validate_email):
+    def test_validations_invalid_name(self):
         """
         Tests the form validation with an invalid name.
 
@@ -206,16 +224,13 @@ class TestFormsender(unittest.TestCase):
                                        'redirect': 'http://www.example.com'})
         env = builder.get_environ()
         req = Request(env)
-        # Mock external validate_email so returns true in Travis
-        mock_validate_email.return_value = True
         app = handler.create_app()
         # Mock create_ticket function so it doesn't send an actual ticket
         rt.rest2.Rt = Mock('rt.rest2.Rt')
         app.on_form_page(req)
         self.assertEqual(app.error, 'Invalid Name')
 
-    @patch('request_handler.validate_email')
-    def test_validations_invalid_email(self, mock_validate_email):
+    def test_validations_invalid_email(self):
         """
         Tests the form validation with an invalid email.
 
@@ -225,22 +240,19 @@ class TestFormsender(unittest.TestCase):
         """
         builder = EnvironBuilder(method='POST',
                                  data={'name': 'Valid Guy',
-                                       'email': 'invalid@example.com',
+                                       'email': 'invalid@example..com',
                                        'last_name': '',
                                        'token': conf.TOKEN,
                                        'redirect': 'http://www.example.com'})
         env = builder.get_environ()
         req = Request(env)
-        # Mock external validate_email so returns false in Travis
-        mock_validate_email.return_value = False
         app = handler.create_app()
         # Mock create_ticket function so it doesn't send an actual ticket
         rt.rest2.Rt = Mock('rt.rest2.Rt')
         app.on_form_page(req)
         self.assertEqual(app.error, 'Invalid Email')
 
-    @patch('request_handler.validate_email')
-    def test_validations_invalid_hidden(self, mock_validate_email):
+    def test_validations_invalid_hidden(self):
         """
         Tests the form validation with content in the hidden last_name field.
 
@@ -257,16 +269,13 @@ class TestFormsender(unittest.TestCase):
                                        'redirect': 'http://www.example.com'})
         env = builder.get_environ()
         req = Request(env)
-        # Mock external validate_email so returns true in Travis
-        mock_validate_email.return_value = True
         app = handler.create_app()
         # Mock create_ticket function so it doesn't send an actual ticket
         rt.rest2.Rt = Mock('rt.rest2.Rt')
         app.on_form_page(req)
         self.assertEqual(app.error, 'Improper Form Submission')
 
-    @patch('request_handler.validate_email')
-    def test_validations_invalid_token(self, mock_validate_email):
+    def test_validations_invalid_token(self):
         """
         Tests the form validation with an invalid token.
 
@@ -282,16 +291,13 @@ class TestFormsender(unittest.TestCase):
                                        'redirect': 'http://www.example.com'})
         env = builder.get_environ()
         req = Request(env)
-        # Mock external validate_email so returns true in Travis
-        mock_validate_email.return_value = True
         app = handler.create_app()
         # Mock create_ticket function so it doesn't send an actual ticket
         rt.rest2.Rt = Mock('rt.rest2.Rt')
         app.on_form_page(req)
         self.assertEqual(app.error, 'Improper Form Submission')
 
-    @patch('request_handler.validate_email')
-    def test_validations_invalid_fields_to_join(self, mock_validate_email):
+    def test_validations_invalid_fields_to_join(self):
         """
         Tests the form validation with an invalid 'fields_to_join' field.
 
@@ -308,16 +314,13 @@ class TestFormsender(unittest.TestCase):
                                        'fields_to_join': 'name,missing,email'})
         env = builder.get_environ()
         req = Request(env)
-        # Mock external validate_email so returns true in Travis
-        mock_validate_email.return_value = True
         app = handler.create_app()
         # Mock create_ticket function so it doesn't send an actual ticket
         rt.rest2.Rt = Mock('rt.rest2.Rt')
         app.on_form_page(req)
         self.assertEqual(app.error, 'Improper Form Submission')
 
-    @patch('request_handler.validate_email')
-    def test_is_valid_email_with_valid(self, mock_validate_email):
+    def test_is_valid_email_with_valid(self):
         """
         Tests is_valid_email with a valid email
 
@@ -328,11 +331,54 @@ class TestFormsender(unittest.TestCase):
                                  data={'email': 'example@osuosl.org'})
         env = builder.get_environ()
         req = Request(env)
-        # Mock external validate_email so returns true in Travis
-        mock_validate_email.return_value = True
 
         self.assertTrue(handler.is_valid_email(req))
 
+    def test_email_validator_matches_validate_email(self):
+        """
+        EmailValidator accepts exactly the addresses validate_email's
+        grammar does, and pathological ones are still rejected quickly.
+        """
+        validator = handler.EmailValidator()
+        addresses = ['example@osuosl.org', 'first.last+tag@osuosl.org',
+                     'ünï@osuosl.org', 'example@osuosl.org\n',
+                     '"quoted name"@osuosl.org', '(comment) x@[10.0.0.1]',
+                     ' example @ osuosl.org ', 'a@b(x)\r\n x',
+                     'example@@osuosl.org', 'example.@osuosl.org',
+                     '.example@osuosl.org', 'example@osuosl..org',
+                     'example@', '"unterminated@osuosl.org', '(x@y',
+                     'example@osuosl.org\n\n', '']
+        for address in addresses:
+            self.assertEqual(validator.is_valid(address),
+                             re.match(VALID_ADDRESS_REGEXP, address)
+                             is not None, address)
+        started = time.monotonic()
+        for address in ['(' * 50 + 'x@y', ' ' * 50 + '!',
+                        'x@y' + ' \t' * 50 + '!']:
+            self.assertFalse(validator.is_valid(address))
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_email_validator_caches_verdicts(self):
+        """
+        Verdicts are cached up to max_entries, except for overlong
+        addresses, and the cache is reported in /metrics.
+        """
+        validator = handler.EmailValidator(max_entries=2)
+        self.assertTrue(validator.is_valid('a@osuosl.org'))
+        self.assertFalse(validator.is_valid('b@'))
+        self.assertTrue(validator.is_valid('a@osuosl.org'))
+        self.assertTrue(validator.is_valid('c@osuosl.org'))
+        self.assertFalse(validator.is_valid('x' * 400))
+        self.assertEqual(validator.stats(), {
+            'entries': 2, 'max_entries': 2, 'hits': 1, 'misses': 3,
+            'evictions': 1})
+        self.assertNotIn('b@', validator.verdicts)
+        app = handler.create_app(with_static=False)
+        app.emails = validator
+        body = Client(app).get('/metrics').get_data(as_text=True)
+        self.assertIn('formsender_table_hits{table="emails",pid="%d"} 1'
+                      % os.getpid(), body)
+
     def test_validate_name_with_valid(self):
         """
         Tests validate_name with a valid name
@@ -410,9 +456,7 @@ class TestFormsender(unittest.TestCase):
         self.assertFalse(handler.is_valid_token(req))
 
     @patch('request_handler.is_valid_recaptcha')
-    @patch('request_handler.validate_email')
-    def test_rate_limiter_valid_rate(self, mock_validate_email,
-                                     mock_recaptcha):
+    def test_rate_limiter_valid_rate(self, mock_recaptcha):
         """
         Tests rate limiter with a valid rate
         """
@@ -424,7 +468,6 @@ class TestFormsender(unittest.TestCase):
                                        'redirect': 'http://www.example.com',
                                        'g-recaptcha-response': ''})
         # Mock external services so they return valid in CI
-        mock_validate_email.return_value = True
         mock_recaptcha.return_value = True
         # Mock create_ticket function so it doesn't send an actual ticket
         rt.rest2.Rt = Mock('rt.rest2.Rt')
@@ -439,8 +482,7 @@ class TestFormsender(unittest.TestCase):
         self.assertEqual(resp.status_code, 302)
         self.assertEqual(app.error, None)
 
-    @patch('request_handler.validate_email')
-    def test_rate_limiter_invalid_rate(self, mock_validate_email):
+    def test_rate_limiter_invalid_rate(self):
         """
         Tests rate limiter with an invalid rate
         """
@@ -451,8 +493,6 @@ class TestFormsender(unittest.TestCase):
                                        'token': conf.TOKEN,
                                        'redirect': 'http://www.example.com',
                                        'g-recaptcha-response': ''})
-        # Mock validate email so returns true in Travis
-        mock_validate_email.return_value = True
         env = builder.get_environ()
         req = Request(env)
         app = handler.create_app()
@@ -466,9 +506,7 @@ class TestFormsender(unittest.TestCase):
         self.assertEqual(app.error, 'Too Many Requests')
 
     @patch('request_handler.is_valid_recaptcha')
-    @patch('request_handler.validate_email')
-    def test_redirect_url_valid_data(self, mock_validate_email,
-                                     mock_recaptcha):
+    def test_redirect_url_valid_data(self, mock_recaptcha):
         """
         Tests the user is redirected to appropriate location
         """
@@ -485,7 +523,6 @@ class TestFormsender(unittest.TestCase):
         req = Request(env)
 
         # Mock external services so they return valid in CI
-        mock_validate_email.return_value = True
         mock_recaptcha.return_value = True
 
         # Create app and mock redirect
@@ -498,8 +535,7 @@ class TestFormsender(unittest.TestCase):
         werkzeug.utils.redirect.assert_called_with('http://www.example.com',
                                                    code=302)
 
-    @patch('request_handler.validate_email')
-    def test_redirect_url_error_1(self, mock_validate_email):
+    def test_redirect_url_error_1(self):
         """
         Tests the user is redirected to appropriate location
         """
@@ -507,19 +543,13 @@ class TestFormsender(unittest.TestCase):
         # Build test environment
         builder = EnvironBuilder(method='POST',
                                  data={'name': 'Valid Guy',
-                                       'email': 'nope@example.com',
+                                       'email': 'nope.example.com',
                                        'redirect': 'http://www.example.com',
                                        'last_name': '',
                                        'token': conf.TOKEN})
         env = builder.get_environ()
         req = Request(env)
 
-        # Mock validate email so returns false in Travis
-        # Not technically necessary because this will return false in Travis
-        # regardless since it can't find the SMTP server, but kept here for
-        # consistency
-        mock_validate_email.return_value = False
-
         # Create app and mock redirect
         app = handler.create_app()
         werkzeug.utils.redirect = Mock('werkzeug.utils.redirect')
@@ -531,8 +561,7 @@ class TestFormsender(unittest.TestCase):
             'http://www.example.com?error=1&message=Invalid+Email',
             code=302)
 
-    @patch('request_handler.validate_email')
-    def test_redirect_url_error_2(self, mock_validate_email):
+    def test_redirect_url_error_2(self):
         """
         Tests the user is redirected to appropriate location
         """
@@ -547,9 +576,6 @@ class TestFormsender(unittest.TestCase):
         env = builder.get_environ()
         req = Request(env)
 
-        # Mock validate email so returns true in Travis
-        mock_validate_email.return_value = True
-
         # Create app and mock redirect
         app = handler.create_app()
         werkzeug.utils.redirect = Mock('werkzeug.utils.redirect')
@@ -561,8 +587,7 @@ class TestFormsender(unittest.TestCase):
             'http://www.example.com?error=2&message=Invalid+Name',
             code=302)
 
-    @patch('request_handler.validate_email')
-    def test_redirect_url_error_3(self, mock_validate_email):
+    def test_redirect_url_error_3(self):
         """
         Tests the user is redirected to appropriate location
         """
@@ -577,9 +602,6 @@ class TestFormsender(unittest.TestCase):
         env = builder.get_environ()
         req = Request(env)
 
-        # Mock validate email so returns true in Travis
-        mock_validate_email.return_value = True
-
         # Create app and mock redirect
         app = handler.create_app()
         werkzeug.utils.redirect = Mock('werkzeug.utils.redirect')
@@ -591,8 +613,7 @@ class TestFormsender(unittest.TestCase):
             'http://www.example.com?error=3&message=Improper+Form+Submission',
             code=302)
 
-    @patch('request_handler.validate_email')
-    def test_redirect_url_error_4(self, mock_validate_email):
+    def test_redirect_url_error_4(self):
         """
         Tests the user is redirected to appropriate location
         """
@@ -608,8 +629,6 @@ class TestFormsender(unittest.TestCase):
         env = builder.get_environ()
         req = Request(env)
 
-        # Mock validate email so returns true in Travis
-        mock_validate_email.return_value = True
         app = handler.create_app()
         werkzeug.utils.redirect = Mock('werkzeug.utils.redirect')
         # Mock create_ticket function so it doesn't send an actual ticket
@@ -864,8 +883,7 @@ class TestFormsender(unittest.TestCase):
         self.assertEqual(address, 'OSLSupport')
 
     @patch('request_handler.is_valid_recaptcha')
-    @patch('request_handler.validate_email')
-    def test_same_submission(self, mock_validate_email, mock_recaptcha):
+    def test_same_submission(self, mock_recaptcha):
         """
         Tests that the same form is not sent twice.
         """
@@ -881,7 +899,6 @@ class TestFormsender(unittest.TestCase):
 
         # Mock create_ticket function so it doesn't send an actual ticket
         rt.rest2.Rt.create_ticket = Mock('rt.rest2.Rt.create_ticket')
-        mock_validate_email.return_value = True
         mock_recaptcha.return_value = True
 
         # Create apps
@@ -916,8 +933,7 @@ class TestFormsender(unittest.TestCase):
 
         self.assertEqual(app.error, 'Duplicate Request')
 
-    @patch('request_handler.validate_email')
-    def test_send_email_default(self, mock_validate_email):
+    def test_send_email_default(self):
         """
         Tests that the form is sent to the correct default address when
         the 'send_to' field is set to an empty string.
@@ -1098,7 +1114,7 @@ class TestFormsender(unittest.TestCase):
         app = handler.create_app()
         req = Request(EnvironBuilder(method='POST', data={}).get_environ())
         with patch('request_handler.create_msg', return_value=None):
-            resp = app.handle_no_error(req)
+            resp = app.handle_no_error(handler.Submission.from_request(req))
         self.assertEqual(resp.status_code, 400)
 
     def test_handle_no_error_forwards_attachment_and_custom_fields(self):
@@ -1119,7 +1135,7 @@ class TestFormsender(unittest.TestCase):
         app = handler.create_app()
         with patch('rt.rest2.Rt') as mock_rt:
             instance = mock_rt.return_value
-            resp = app.handle_no_error(req)
+            resp = app.handle_no_error(handler.Submission.from_request(req))
 
         self.assertEqual(resp.status_code, 302)
         _, kwargs = instance.create_ticket.call_args
@@ -1165,18 +1181,3041 @@ class TestFormsender(unittest.TestCase):
         self.assertFalse(controller.is_rate_violation())
         self.assertEqual(controller.rate, 0)
 
-    def test_controller_duplicate_resets_after_timeout(self):
+    def test_controller_duplicate_expires_after_timeout(self):
         """
-        Once DUPLICATE_CHECK_TIME has passed, the hash list is reset and the
-        submission is no longer considered a duplicate.
+        A submission is a duplicate until DUPLICATE_CHECK_TIME has passed
+        since it was first seen, then it is forgotten.
         """
         controller = handler.Controller()
-        controller.hash_list = ['oldhash']
-        controller.start_time_hash = (
-            datetime.now()
-            - timedelta(seconds=conf.DUPLICATE_CHECK_TIME + 1))
+        now = [1000.0]
+        controller.duplicates.clock = lambda: now[0]
         self.assertFalse(controller.is_duplicate('whatever'))
-        self.assertEqual(controller.hash_list, [])
+        now[0] += conf.DUPLICATE_CHECK_TIME - 1
+        self.assertTrue(controller.is_duplicate('whatever'))
+        now[0] += 1
+        self.assertFalse(controller.is_duplicate('whatever'))
+        self.assertEqual(controller.duplicates.expirations, 1)
+
+    def test_duplicate_index_expires_entries_individually(self):
+        """
+        Entries expire on their own schedule, so a duplicate of a recent
+        submission is still caught after older entries have expired.
+        """
+        now = [0.0]
+        index = handler.DuplicateIndex(10, clock=lambda: now[0])
+        index.seen(b'old')
+        now[0] = 8
+        index.seen(b'new')
+        now[0] = 12
+        self.assertTrue(index.seen(b'new'))
+        self.assertFalse(index.seen(b'old'))
+        self.assertEqual(index.stats()['expirations'], 1)
+
+    def test_duplicate_index_ttl_change_keeps_expiry_order(self):
+        """
+        A new ttl applies to the entries already held, counted from when
+        they were first seen, so entries still expire oldest first.
+        """
+        now = [0.0]
+        for index, keys in (
+                (handler.DuplicateIndex(100, clock=lambda: now[0]),
+                 (b'a', b'b', b'c')),
+                (handler.NearDuplicateIndex(100, distance=0,
+                                            clock=lambda: now[0]),
+                 (1, 2, 4))):
+            now[0] = 0
+            first, second, third = keys
+            index.seen(first)
+            now[0] = 10
+            index.seen(second)
+            index.set_ttl(20)
+            index.set_ttl(20)
+            now[0] = 15
+            index.seen(third)
+            now[0] = 25
+            self.assertFalse(index.seen(first))
+            self.assertTrue(index.seen(second))
+            now[0] = 31
+            self.assertTrue(index.seen(third))
+            self.assertFalse(index.seen(second))
+            self.assertEqual(index.stats()['expirations'], 2)
+
+    def test_duplicate_index_ttl_change_races_submissions(self):
+        """
+        Changing the ttl while other threads add entries neither fails nor
+        loses them.
+        """
+        for index, key in (
+                (handler.DuplicateIndex(3600), lambda i: b'%d' % i),
+                (handler.NearDuplicateIndex(3600, distance=0),
+                 lambda i: i)):
+            errors = []
+
+            def submit(start):
+                try:
+                    for i in range(start, start + 2000):
+                        index.seen(key(i))
+                except Exception as error:
+                    errors.append(error)
+
+            threads = [threading.Thread(target=submit, args=(n * 2000,))
+                       for n in range(4)]
+            for thread in threads:
+                thread.start()
+            for ttl in range(200):
+                index.set_ttl(3600 + ttl % 2)
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(index.stats()['entries'], 8000)
+
+    def test_duplicate_index_evicts_oldest_when_full(self):
+        """
+        Past max_entries the oldest digest is evicted, and the counters
+        report the table size.
+        """
+        index = handler.DuplicateIndex(3600, max_entries=2)
+        for digest in (b'a', b'b', b'c'):
+            self.assertFalse(index.seen(digest))
+        self.assertFalse(index.seen(b'a'))
+        self.assertTrue(index.seen(b'c'))
+        stats = index.stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['max_entries'], 2)
+        self.assertEqual(stats['evictions'], 2)
+        self.assertGreater(stats['bytes'], 0)
+
+    def test_duplicate_tables_forget_submissions(self):
+        """
+        forget drops a submission from every duplicate table, so it isn't
+        a duplicate when sent again, and leaves other submissions alone.
+        """
+        message = {'name': 'Valid Guy', 'message': 'hello'}
+        for controller in (handler.Controller(), handler.SharedController(
+                handler.SharedState(self.make_state_path(), 64))):
+            self.assertFalse(controller.is_duplicate(message))
+            self.assertFalse(controller.is_duplicate({'name': 'Other'}))
+            controller.forget(message)
+            controller.forget({'name': 'Never Seen'})
+            self.assertFalse(controller.is_duplicate(message))
+            self.assertTrue(controller.is_duplicate(message))
+            self.assertTrue(controller.is_duplicate({'name': 'Other'}))
+        # A forgotten slot is probed past, so later entries are still found
+        state = handler.SharedState(self.make_state_path(), 1)
+        self.assertFalse(state.seen(b'a' * 16))
+        state.forget(b'a' * 16)
+        state.forget(b'b' * 16)
+        self.assertEqual(state.stats()['entries'], 0)
+        self.assertFalse(state.seen(b'b' * 16))
+        self.assertEqual(state.stats()['entries'], 1)
+        with patch.object(conf, 'NEAR_DUPLICATE_DISTANCE', 3, create=True):
+            controller = handler.Controller()
+        self.assertFalse(controller.is_duplicate(message))
+        controller.forget(message)
+        self.assertEqual(controller.stats()['near_duplicates'], dict(
+            controller.near_duplicates.stats(), entries=0, buckets=0))
+        self.assertFalse(controller.is_duplicate(message))
+
+    # Submission fingerprints
+
+    def test_fingerprint_is_canonical(self):
+        """
+        Resubmissions fingerprint alike whatever their field order, spacing,
+        case or reCAPTCHA response; the digest is keyed by TOKEN.
+        """
+        message = {'name': 'Valid Guy', 'email': 'example@osuosl.org',
+                   'message': 'Please  help', 'g-recaptcha-response': 'a'}
+        resubmitted = {'g-recaptcha-response': 'b', 'message': 'please help ',
+                       'email': 'EXAMPLE@osuosl.org', 'name': 'Valid Guy'}
+        self.assertEqual(handler.fingerprint(message),
+                         handler.fingerprint(resubmitted))
+        self.assertNotEqual(handler.fingerprint(message), handler.fingerprint(
+            dict(message, message='Please help me')))
+        self.assertEqual(len(handler.fingerprint(None)),
+                         handler.DuplicateIndex.DIGEST_SIZE)
+        digest = handler.fingerprint(message)
+        with patch.object(conf, 'TOKEN', 'another token'):
+            self.assertNotEqual(handler.fingerprint(message), digest)
+
+    def test_near_duplicate_index_compares_within_bands(self):
+        """
+        SimHashes within distance bits are near-duplicates; a lookup only
+        compares those sharing a band, and expired or evicted SimHashes leave
+        the band tables.
+        """
+        now = [0.0]
+        index = handler.NearDuplicateIndex(10, distance=3, max_entries=3,
+                                           clock=lambda: now[0])
+        self.assertEqual(len(index.bands), 4)
+        self.assertFalse(index.seen(0))
+        self.assertTrue(index.seen(0b10101))
+        self.assertFalse(index.seen(0b1111))
+        self.assertFalse(index.seen(0xffff << 16))
+        self.assertEqual(index.stats()['comparisons'], 4)
+        # Sharing no band with the others, it is compared with none
+        self.assertFalse(index.seen(0x0001000100010001))
+        self.assertEqual(index.stats()['comparisons'], 4)
+        stats = index.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['entries'], 3)
+        now[0] = 10
+        self.assertFalse(index.seen(0b1111))
+        stats = index.stats()
+        self.assertEqual(stats['expirations'], 3)
+        self.assertEqual(stats['buckets'], 4)
+        for distance in (-1, 64):
+            with self.assertRaises(ValueError):
+                handler.NearDuplicateIndex(10, distance)
+
+    @patch.object(conf, 'NEAR_DUPLICATE_DISTANCE', 3, create=True)
+    def test_controller_catches_near_duplicates(self):
+        """
+        With NEAR_DUPLICATE_DISTANCE, a submission that changes one word of
+        an earlier one is a duplicate, and one with other content isn't.
+        """
+        words = ['word%d' % number for number in range(60)]
+        message = {'name': 'Valid Guy', 'email': 'example@osuosl.org',
+                   'message': ' '.join(words),
+                   'redirect': 'http://www.example.com'}
+        varied = dict(message, message=' '.join(words[1:] + ['spam']),
+                      redirect='http://www.example.com/other')
+        controller = handler.Controller()
+        self.assertLessEqual(
+            (handler.simhash(message) ^ handler.simhash(varied)).bit_count(),
+            3)
+        self.assertFalse(controller.is_duplicate(message))
+        self.assertTrue(controller.is_duplicate(varied))
+        self.assertFalse(controller.is_duplicate(
+            {'name': 'Another Guy', 'message': 'something else entirely'}))
+        self.assertEqual(controller.stats()['near_duplicates']['entries'], 2)
+        self.assertEqual(handler.simhash(None), 0)
+        shared = handler.SharedController(
+            handler.SharedState(self.make_state_path(), 64))
+        self.assertIsNotNone(shared.near_duplicates)
+
+    # Ticket spool
+
+    def make_spool(self):
+        """Returns a TicketSpool in a temporary directory removed after test"""
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        return handler.TicketSpool(os.path.join(spool_dir, 'spool.sqlite3'))
+
+    def test_spool_round_trip(self):
+        """
+        A spooled ticket is claimed back with its arguments and attachments
+        intact, and is not claimed a second time while it is being sent.
+        """
+        spool = self.make_spool()
+        attachment = rt.rest2.Attachment('doc.txt', 'text/plain', b'data')
+        ticket_args = handler.build_ticket_args('body', 'subj', 'General',
+                                                'example@osuosl.org',
+                                                [attachment], {'CF': 'x'})
+        item_id = spool.enqueue(ticket_args)
+
+        claimed_id, attempts, claimed_args = spool.claim()
+        self.assertEqual(claimed_id, item_id)
+        self.assertEqual(attempts, 0)
+        claimed_attachments = claimed_args.pop('attachments')
+        ticket_args.pop('attachments')
+        self.assertEqual(claimed_args, ticket_args)
+        self.assertEqual([(a.file_name, a.file_type, a.file_content)
+                          for a in claimed_attachments],
+                         [('doc.txt', 'text/plain', b'data')])
+        self.assertIsNone(spool.claim())
+        self.assertEqual(spool.counts(), {'sending': 1})
+
+        spool.mark_sent(item_id, 42)
+        self.assertEqual(spool.status(item_id), ('sent', 1, 42, None))
+
+    def test_spool_reclaims_expired_lease(self):
+        """An item left 'sending' past its lease is handed out again."""
+        spool = self.make_spool()
+        item_id = spool.enqueue(handler.build_ticket_args('body', 'subj'))
+        spool.claim()
+        spool.lease = -1
+        self.assertEqual(spool.claim()[0], item_id)
+
+    def test_spool_worker_retries_then_gives_up(self):
+        """
+        A failed delivery is rescheduled with backoff, and marked failed once
+        SPOOL_MAX_ATTEMPTS is reached.
+        """
+        spool = self.make_spool()
+        item_id = spool.enqueue(handler.build_ticket_args('body', 'subj'))
+        deliver = Mock(side_effect=ConnectionError('down'))
+        worker = handler.SpoolWorker(spool, Mock(), deliver=deliver)
+        worker.max_attempts = 2
+
+        self.assertTrue(worker.deliver_one())
+        status, attempts, _, error = spool.status(item_id)
+        self.assertEqual((status, attempts, error), ('pending', 1, 'down'))
+        # Not due again until the retry delay has passed
+        self.assertFalse(worker.deliver_one())
+
+        with patch('request_handler.time.time',
+                   return_value=time.time() + worker.retry_delay + 1):
+            self.assertTrue(worker.deliver_one())
+        self.assertEqual(spool.status(item_id)[:2], ('failed', 2))
+
+    def test_spool_worker_thread_drains_spool(self):
+        """A running SpoolWorker creates queued tickets and then stops."""
+        spool = self.make_spool()
+        item_id = spool.enqueue(handler.build_ticket_args('body', 'subj'))
+        deliver = Mock(return_value=7)
+        worker = handler.SpoolWorker(spool, Mock(), deliver=deliver)
+        worker.poll_interval = 0.01
+        worker.start()
+        deadline = time.time() + 5
+        while spool.status(item_id)[0] != 'sent' and time.time() < deadline:
+            time.sleep(0.01)
+        worker.stop()
+        worker.join(5)
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(spool.status(item_id)[2], 7)
+        deliver.assert_called_once_with({'queue': 'General',
+                                         'subject': 'subj',
+                                         'content': 'body',
+                                         'Requestor': 'noreply@osuosl.org'})
+
+    def test_handle_no_error_spools_ticket(self):
+        """
+        With a spool configured, handle_no_error queues the ticket instead of
+        calling RT and still redirects.
+        """
+        builder = EnvironBuilder(method='POST', data={
+            'name': 'Valid Guy',
+            'email': 'example@osuosl.org',
+            'redirect': 'http://www.example.com',
+            'attachment': (BytesIO(b'file data'), 'doc.txt'),
+        })
+        req = Request(builder.get_environ())
+        spool = self.make_spool()
+        app = handler.Forms(handler.Controller(), Mock(), spool=spool)
+        with patch('rt.rest2.Rt') as mock_rt:
+            resp = app.handle_no_error(handler.Submission.from_request(req))
+
+        self.assertEqual(resp.status_code, 302)
+        mock_rt.assert_not_called()
+        _, _, ticket_args = spool.claim()
+        self.assertEqual(ticket_args['Requestor'], 'example@osuosl.org')
+        self.assertEqual(ticket_args['attachments'][0].file_content,
+                         b'file data')
+
+    def test_create_app_spool_mode_starts_worker(self):
+        """DELIVERY_MODE = 'spool' gives the app a spool and a worker."""
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        with patch.object(conf, 'DELIVERY_MODE', 'spool', create=True), \
+                patch.object(conf, 'SPOOL_PATH',
+                             os.path.join(spool_dir, 'spool.sqlite3'),
+                             create=True), \
+                patch('request_handler.SpoolWorker') as mock_worker:
+            app = handler.create_app(with_static=False)
+        self.assertIsInstance(app.spool, handler.TicketSpool)
+        mock_worker.return_value.start.assert_called_once_with()
+
+    # RT client pool
+
+    def test_rt_client_pool_reuses_client(self):
+        """Consecutive checkouts get the same long-lived RT client."""
+        pool = handler.RTClientPool(size=2)
+        with patch('rt.rest2.Rt') as mock_rt:
+            mock_rt.side_effect = lambda *args, **kwargs: Mock()
+            with pool.client() as first:
+                pass
+            with pool.client() as second:
+                pass
+        self.assertIs(first, second)
+        self.assertEqual(mock_rt.call_count, 1)
+
+    def dead_rt_url(self):
+        """Returns the URL of an RT that refuses every connection"""
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        return 'http://127.0.0.1:%s/REST/2.0/' % port
+
+    def test_rt_client_pool_discards_broken_client(self):
+        """A client that raised a connection error is not handed out again."""
+        pool = handler.RTClientPool(size=1, url=self.dead_rt_url(),
+                                    token='token')
+        with patch.object(rt.rest2, 'Rt', RT_CLIENT):
+            with self.assertRaises(ConnectionError):
+                with pool.client() as broken:
+                    broken.create_ticket('General', subject='Hello')
+            self.assertTrue(broken.session.is_closed)
+            with pool.client() as tracker:
+                pass
+        self.assertIsNot(tracker, broken)
+
+    def test_rt_client_pool_resets_after_fork(self):
+        """Clients created in another process are never reused."""
+        pool = handler.RTClientPool(size=1)
+        with patch('rt.rest2.Rt') as mock_rt:
+            mock_rt.side_effect = lambda *args, **kwargs: Mock()
+            with pool.client() as parent_client:
+                pass
+            pool.pid = -1
+            with pool.client() as child_client:
+                pass
+        self.assertIsNot(child_client, parent_client)
+
+    def test_rt_client_pool_preconnect(self):
+        """
+        preconnect warms one client per pool slot and skips clients that
+        cannot reach RT.
+        """
+        pool = handler.RTClientPool(size=2)
+        logger = Mock()
+        good = Mock(url='https://rt.example.org/REST/2.0/')
+        bad = Mock()
+        bad.session.get.side_effect = ConnectionError('refused')
+        pool.pid = -1
+        with patch.object(pool, 'create', side_effect=[good, bad]):
+            self.assertEqual(pool.preconnect(logger), 1)
+        good.session.get.assert_called_once_with(
+            'https://rt.example.org/REST/2.0/rt', timeout=2)
+        self.assertEqual(logger.warning.call_count, 1)
+        self.assertEqual(pool.idle, [good])
+
+    def test_rt_client_pool_preconnects_in_background(self):
+        """
+        preconnect_in_background doesn't wait for RT, and logs a failure to
+        reach it instead of raising.
+        """
+        pool = handler.RTClientPool(size=1, url=self.dead_rt_url(),
+                                    token='token')
+        logger = Mock()
+        with patch.object(rt.rest2, 'Rt', RT_CLIENT):
+            thread = pool.preconnect_in_background(logger)
+            self.assertTrue(thread.daemon)
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(logger.warning.call_count, 1)
+        self.assertEqual(pool.idle, [])
+
+    def test_forms_deliver_uses_pool(self):
+        """Forms.deliver creates the ticket with a pooled client."""
+        tracker = Mock()
+        tracker.create_ticket.return_value = 12
+        pool = handler.RTClientPool()
+        pool.idle.append(tracker)
+        app = handler.Forms(handler.Controller(), Mock(), rt_clients=pool)
+        self.assertEqual(app.deliver({'queue': 'General'}), 12)
+        tracker.create_ticket.assert_called_once_with(queue='General')
+        self.assertEqual(pool.idle, [tracker])
+
+    # reCAPTCHA verification
+
+    def test_recaptcha_verifier_posts_to_endpoint(self):
+        """
+        The verifier sends the secret, response and client address to the
+        configured endpoint and returns its verdict.
+        """
+        seen = []
+
+        def siteverify(request):
+            seen.append((str(request.url), request.content))
+            return httpx.Response(200, json={'success': True})
+
+        verifier = handler.RecaptchaVerifier(
+            'secret', 'http://verifier.test/siteverify',
+            transport=httpx.MockTransport(siteverify))
+        self.assertTrue(verifier.verify('token', '192.0.2.1'))
+        self.assertEqual(seen, [('http://verifier.test/siteverify',
+                                 b'secret=secret&response=token'
+                                 b'&remoteip=192.0.2.1')])
+
+    def test_recaptcha_verifier_rejects_failed_verification(self):
+        """An unsuccessful verdict from the endpoint is a failure."""
+        verifier = handler.RecaptchaVerifier(
+            'secret', transport=httpx.MockTransport(
+                lambda request: httpx.Response(200, json={'success': False})))
+        self.assertFalse(verifier.verify('token'))
+
+    def test_recaptcha_verifier_fail_policy(self):
+        """
+        Timeouts, HTTP errors and garbage responses return the configured
+        fail-open/fail-closed verdict.
+        """
+        def timeout(request):
+            raise httpx.ConnectTimeout('timed out', request=request)
+
+        for handler_fn in (timeout,
+                           lambda request: httpx.Response(503),
+                           lambda request: httpx.Response(200,
+                                                          text='not json')):
+            for fail_open in (False, True):
+                verifier = handler.RecaptchaVerifier(
+                    'secret', fail_open=fail_open, logger=Mock(),
+                    transport=httpx.MockTransport(handler_fn))
+                self.assertIs(verifier.verify('token'), fail_open)
+
+    def test_is_valid_recaptcha_uses_verifier(self):
+        """is_valid_recaptcha passes the form's response to the verifier."""
+        req = Request(EnvironBuilder(method='POST', data={
+            'g-recaptcha-response': 'token'}).get_environ())
+        verifier = Mock()
+        self.assertIs(handler.is_valid_recaptcha(req, verifier),
+                      verifier.verify.return_value)
+        verifier.verify.assert_called_once_with('token', req.remote_addr)
+        sessions, posted = [], []
+
+        def client(**kwargs):
+            kwargs['transport'] = httpx.MockTransport(
+                lambda request: posted.append(request.content) or
+                httpx.Response(200, json={'success': True}))
+            sessions.append(httpx.Client(**kwargs))
+            return sessions[-1]
+
+        with patch.object(handler.RecaptchaVerifier, 'client_class',
+                          staticmethod(client)):
+            self.assertTrue(handler.is_valid_recaptcha(req))
+        self.assertIn(('secret=%s' % conf.RECAPTCHA_SECRET).encode(),
+                      posted[0])
+        # The one-off verifier doesn't leave its connection open
+        self.assertTrue(sessions[0].is_closed)
+
+    # Shared rate/duplicate state
+
+    def make_state_path(self):
+        """Returns a path for a SharedState file removed after the test"""
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        return os.path.join(state_dir, 'state')
+
+    def test_shared_state_is_shared_between_instances(self):
+        """
+        Two SharedState objects on the same file (as in two workers) see the
+        same rate and the same duplicates.
+        """
+        path = self.make_state_path()
+        first = handler.SharedController(handler.SharedState(path, 64))
+        second = handler.SharedController(handler.SharedState(path, 64))
+
+        self.assertFalse(first.is_duplicate({'name': 'Valid Guy'}))
+        self.assertTrue(second.is_duplicate({'name': 'Valid Guy'}))
+        self.assertFalse(second.is_duplicate({'name': 'Another Guy'}))
+
+        for _ in range(conf.CEILING):
+            first.increment_rate()
+        second.increment_rate()
+        self.assertEqual(first.rate, conf.CEILING + 1)
+        self.assertTrue(second.is_rate_violation())
+        first.reset_rate()
+        self.assertEqual(second.rate, 0)
+        self.assertFalse(second.is_rate_violation())
+
+    def test_shared_state_rate_window_resets(self):
+        """Once the window is over, the shared rate starts again from 0."""
+        now = [1000.0]
+        state = handler.SharedState(self.make_state_path(), 8,
+                                    clock=lambda: now[0])
+        state.increment_rate()
+        now[0] += 1.5
+        self.assertFalse(state.is_rate_violation(0))
+        self.assertEqual(state.read_rate(), (1000.0, 1))
+        now[0] += 1
+        self.assertFalse(state.is_rate_violation(0))
+        self.assertEqual(state.read_rate(), (now[0], 0))
+
+    def test_shared_state_expires_and_evicts(self):
+        """
+        Expired slots are reused, and a full probe sequence evicts the entry
+        closest to expiry.
+        """
+        now = [1000.0]
+        state = handler.SharedState(self.make_state_path(), 2, ttl=10,
+                                    clock=lambda: now[0])
+        digests = [bytes([i]) * 16 for i in range(3)]
+        self.assertFalse(state.seen(digests[0]))
+        now[0] += 1
+        self.assertFalse(state.seen(digests[1]))
+        # Table is full: the oldest entry is evicted to make room
+        self.assertFalse(state.seen(digests[2]))
+        self.assertEqual(state.stats()['evictions'], 1)
+        self.assertFalse(state.seen(digests[0]))
+        self.assertTrue(state.seen(digests[0]))
+        # Everything expires, and the expired slots are reused; they count
+        # as entries until then
+        now[0] += 20
+        self.assertEqual(state.stats()['entries'], 2)
+        self.assertFalse(state.seen(digests[1]))
+        stats = state.stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['max_entries'], 2)
+        self.assertEqual(stats['inserts'], 5)
+        self.assertEqual(stats['bytes'], os.path.getsize(state.path))
+
+    def test_shared_state_never_rebuilt_in_place(self):
+        """
+        A state file laid out for another table size (or not a state file)
+        is refused rather than truncated under the workers mapping it; the
+        app names its files by size, so a new size gets a new file.
+        """
+        path = self.make_state_path()
+        old = handler.SharedState(path, 8)
+        old.seen(b'x' * 16)
+        with self.assertRaises(ValueError):
+            handler.SharedState(path, 16)
+        self.assertEqual(os.path.getsize(path), old.size)
+        self.assertTrue(old.seen(b'x' * 16))
+        with open(path, 'r+b') as state_file:
+            state_file.write(b'NOTSTATE')
+        with self.assertRaises(ValueError):
+            handler.SharedState(path, 8)
+        with patch.object(conf, 'STATE_BACKEND', 'shared', create=True), \
+                patch.object(conf, 'SHARED_STATE_PATH', path, create=True):
+            for slots in (8, 16):
+                with patch.object(conf, 'DUPLICATE_MAX_ENTRIES', slots,
+                                  create=True):
+                    controller = handler.create_controller()
+                self.assertEqual(controller.state.path,
+                                 '{}.{}'.format(path, slots))
+
+    def test_create_app_shared_state_backend(self):
+        """STATE_BACKEND = 'shared' gives the app a SharedController."""
+        with patch.object(conf, 'STATE_BACKEND', 'shared', create=True), \
+                patch.object(conf, 'SHARED_STATE_PATH',
+                             self.make_state_path(), create=True):
+            app = handler.create_app(with_static=False)
+        self.assertIsInstance(app.controller, handler.SharedController)
+
+    # Per-client rate limiting
+
+    def test_client_rate_limiter_token_bucket(self):
+        """
+        A client may send burst requests at once, then is limited until its
+        bucket refills; other clients are unaffected.
+        """
+        now = [0.0]
+        limiter = handler.ClientRateLimiter(rate=0.5, burst=2,
+                                            clock=lambda: now[0])
+        self.assertTrue(limiter.hit('192.0.2.1'))
+        self.assertTrue(limiter.hit('192.0.2.1'))
+        self.assertFalse(limiter.hit('192.0.2.1'))
+        self.assertTrue(limiter.is_limited('192.0.2.1'))
+        self.assertTrue(limiter.hit('192.0.2.2'))
+        self.assertFalse(limiter.is_limited('192.0.2.2'))
+        self.assertFalse(limiter.is_limited('192.0.2.3'))
+        now[0] += 2
+        self.assertTrue(limiter.hit('192.0.2.1'))
+        self.assertFalse(limiter.is_limited('192.0.2.1'))
+
+    def test_client_rate_limiter_lru_bound(self):
+        """The least recently seen client is forgotten past max_clients."""
+        limiter = handler.ClientRateLimiter(max_clients=2)
+        limiter.hit('a')
+        limiter.hit('b')
+        limiter.hit('a')
+        limiter.hit('c')
+        self.assertEqual(list(limiter.buckets), ['a', 'c'])
+        self.assertEqual(limiter.stats(), {'entries': 2, 'max_entries': 2,
+                                           'evictions': 1})
+
+    def test_client_address_trusts_only_configured_proxies(self):
+        """
+        X-Forwarded-For is used only behind a trusted proxy, and only up to
+        the first untrusted hop.
+        """
+        def address(remote_addr, forwarded=None):
+            headers = {'X-Forwarded-For': forwarded} if forwarded else {}
+            return handler.client_address(Request(EnvironBuilder(
+                environ_base={'REMOTE_ADDR': remote_addr},
+                headers=headers).get_environ()))
+
+        with patch.object(conf, 'TRUSTED_PROXIES', ['10.0.0.1', '10.0.0.2'],
+                          create=True):
+            self.assertEqual(address('192.0.2.9', '198.51.100.1'),
+                             '192.0.2.9')
+            self.assertEqual(address('10.0.0.1'), '10.0.0.1')
+            self.assertEqual(address('10.0.0.1', '198.51.100.1, 192.0.2.5, '
+                                                 '10.0.0.2'), '192.0.2.5')
+            self.assertEqual(address('10.0.0.1', '10.0.0.2'), '10.0.0.2')
+
+    @patch('request_handler.is_valid_recaptcha')
+    def test_client_rate_limit_only_blocks_abusive_client(self,
+                                                          mock_recaptcha):
+        """
+        A client over its own limit gets 'Too Many Requests' while another
+        client is still accepted.
+        """
+        mock_recaptcha.return_value = True
+        app = handler.create_app(with_static=False)
+        app.controller.clients = handler.ClientRateLimiter(rate=0, burst=2)
+
+        def submit(remote_addr, name):
+            builder = EnvironBuilder(method='POST',
+                                     environ_base={'REMOTE_ADDR': remote_addr},
+                                     data={'name': name,
+                                           'email': 'example@osuosl.org',
+                                           'last_name': '',
+                                           'token': conf.TOKEN,
+                                           'redirect': 'http://www.example.com',
+                                           'g-recaptcha-response': ''})
+            with patch('rt.rest2.Rt'):
+                app.on_form_page(Request(builder.get_environ()))
+            return app.error
+
+        self.assertIsNone(submit('192.0.2.1', 'One'))
+        self.assertIsNone(submit('192.0.2.1', 'Two'))
+        self.assertEqual(submit('192.0.2.1', 'Three'), 'Too Many Requests')
+        self.assertIsNone(submit('192.0.2.2', 'Four'))
+
+    def test_shared_controller_client_rate_limit(self):
+        """SharedController applies the per-client limit as well."""
+        controller = handler.SharedController(
+            handler.SharedState(self.make_state_path(), 8))
+        controller.clients = handler.ClientRateLimiter(rate=0, burst=1)
+        controller.increment_rate('192.0.2.1')
+        self.assertFalse(controller.is_rate_violation('192.0.2.1'))
+        controller.increment_rate('192.0.2.1')
+        self.assertTrue(controller.is_rate_violation('192.0.2.1'))
+        self.assertFalse(controller.is_rate_violation())
+
+    # Streaming attachments
+
+    def test_spooled_attachment_streams_content(self):
+        """
+        A SpooledAttachment reads its file in chunks and hands RT's client
+        the open file rather than its bytes.
+        """
+        attachment = handler.SpooledAttachment.from_bytes(
+            'doc.txt', 'text/plain', b'abcdefg')
+        attachment.CHUNK_SIZE = 3
+        self.assertEqual(list(attachment.chunks()), [b'abc', b'def', b'g'])
+        name, stream, file_type = attachment.multipart_form_element()
+        self.assertEqual((name, file_type), ('doc.txt', 'text/plain'))
+        self.assertEqual(stream.read(), b'abcdefg')
+        self.assertEqual(attachment.file_content, b'abcdefg')
+        self.assertEqual(attachment.to_dict(),
+                         rt.rest2.Attachment('doc.txt', 'text/plain',
+                                             b'abcdefg').to_dict())
+
+    def test_upload_budget_spills_to_disk(self):
+        """
+        Uploads stay in memory only within the budget; the reservation is
+        returned when the file is closed.
+        """
+        budget = handler.UploadBudget(limit=100)
+        first = budget.open(60)
+        self.assertIsInstance(first, handler.BudgetedFile)
+        self.assertEqual(budget.reserved, 60)
+        second = budget.open(60)
+        self.assertEqual(second.budget_size, 40)
+        third = budget.open(60)
+        self.assertNotIsInstance(third, tempfile.SpooledTemporaryFile)
+        third.close()
+        # Writing past the reservation rolls the file over to disk
+        second.write(b'x' * 41)
+        self.assertTrue(second._rolled)
+        for upload in (first, second, second):
+            upload.close()
+        self.assertEqual(budget.reserved, 0)
+
+    def test_wsgi_upload_uses_budget_and_streams_to_rt(self):
+        """
+        A multipart POST through the WSGI stack spools its file within the
+        app's budget, gives RT a file to stream, and frees the budget after
+        the request.
+        """
+        app = handler.create_app(with_static=False)
+        app.uploads = handler.UploadBudget(limit=4)
+        seen = []
+
+        def deliver(ticket_args):
+            attachment = ticket_args['attachments'][0]
+            _, stream, _ = attachment.multipart_form_element()
+            seen.append((app.uploads.reserved, stream.read()))
+
+        # Other tests replace werkzeug.utils.redirect with a Mock
+        with patch.object(app, 'are_fields_invalid', return_value=False), \
+                patch.object(app, 'deliver', side_effect=deliver), \
+                patch('werkzeug.utils.redirect', redirect):
+            resp = Client(app).post('/', data={
+                'name': 'Valid Guy',
+                'email': 'example@osuosl.org',
+                'redirect': 'http://www.example.com',
+                'attachment': (BytesIO(b'file data'), 'doc.txt')})
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(seen, [(4, b'file data')])
+        self.assertEqual(app.uploads.reserved, 0)
+
+    def test_form_request_without_budget_uses_default_stream(self):
+        """A FormRequest with no budget spools uploads like werkzeug does."""
+        req = handler.FormRequest(EnvironBuilder(method='POST', data={
+            'f': (BytesIO(b'data'), 'a.txt')}).get_environ())
+        self.assertEqual(req.files['f'].read(), b'data')
+
+    def test_spool_worker_closes_attachment_files(self):
+        """Spool files handed to RT are closed once delivery is done."""
+        spool = self.make_spool()
+        spool.enqueue(handler.build_ticket_args(
+            'body', 'subj', attachments=[rt.rest2.Attachment(
+                'doc.txt', 'text/plain', b'data')]))
+        delivered = []
+        worker = handler.SpoolWorker(spool, Mock(),
+                                     deliver=delivered.append)
+        worker.deliver_one()
+        self.assertTrue(delivered[0]['attachments'][0].stream.closed)
+
+    # Metrics
+
+    def test_metrics_render_prometheus_text(self):
+        """Counters, histograms and gauges render in the text format."""
+        metrics = handler.Metrics()
+        metrics.inc('formsender_rejections_total', error=4)
+        metrics.inc('formsender_rejections_total', error=4)
+        metrics.observe('formsender_request_duration_seconds', 0.003)
+        metrics.observe('formsender_request_duration_seconds', 20)
+        metrics.collect(lambda: [('custom_gauge', {'table': 'x'}, 3)])
+        text = metrics.render()
+        pid = os.getpid()
+        self.assertIn('# TYPE formsender_rejections_total counter\n'
+                      'formsender_rejections_total{error="4"} 2\n', text)
+        self.assertIn('formsender_request_duration_seconds_bucket'
+                      '{le="0.005"} 1\n', text)
+        self.assertIn('formsender_request_duration_seconds_bucket'
+                      '{le="10"} 1\n', text)
+        self.assertIn('formsender_request_duration_seconds_bucket'
+                      '{le="+Inf"} 2\n', text)
+        self.assertIn('formsender_request_duration_seconds_sum 20.003\n', text)
+        self.assertIn('formsender_request_duration_seconds_count 2\n', text)
+        self.assertIn('# TYPE custom_gauge gauge\n'
+                      'custom_gauge{table="x",pid="%s"} 3\n' % pid, text)
+
+    def test_metrics_aggregate_worker_snapshots(self):
+        """
+        render adds up the snapshots other workers flushed to the metrics
+        directory and skips bad files. Snapshots of exited processes are
+        removed, their counters and histograms kept in the retired snapshot
+        and their gauges dropped.
+        """
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        other = {'pid': 2 ** 22 + 1,
+                 'counters': [['c_total', [], 5]],
+                 'histograms': [['h', [], [1] + [0] * 12 + [0.001]]],
+                 'gauges': [['g', [], 9]]}
+        with open(os.path.join(metrics_dir, '1.json'), 'w') as snapshot:
+            json.dump(other, snapshot)
+        with open(os.path.join(metrics_dir, '2.json'), 'w') as snapshot:
+            snapshot.write('{half a snapsh')
+        with open(os.path.join(metrics_dir, 'README'), 'w') as snapshot:
+            snapshot.write('not a snapshot')
+        # Left by an earlier process with this worker's pid
+        with open(os.path.join(metrics_dir, '%s.json' % os.getpid()),
+                  'w') as snapshot:
+            json.dump(dict(other, pid=os.getpid(),
+                           counters=[['c_total', [], 100]]), snapshot)
+
+        metrics = handler.Metrics(metrics_dir, flush_interval=3600)
+        metrics.inc('c_total', 2)
+        metrics.observe('h', 0.001)
+        metrics.maybe_flush()
+        self.assertTrue(os.path.exists(
+            os.path.join(metrics_dir, '%s.json' % os.getpid())))
+        metrics.inc('c_total')
+        # Throttled: the snapshot on disk is not rewritten yet
+        metrics.maybe_flush()
+        text = metrics.render()
+        self.assertIn('c_total 108\n', text)
+        self.assertIn('h_count 3\n', text)
+        self.assertNotIn('\ng{', text)
+        self.assertEqual(sorted(os.listdir(metrics_dir)), sorted([
+            '%s.json' % os.getpid(), '2.json', 'README', 'retired.json',
+            'retired.json.lock']))
+        # Retired counters are counted once, by every worker
+        self.assertEqual(metrics.render(), text)
+        metrics.flush()
+        with patch.object(handler.os, 'getpid', return_value=1):
+            self.assertIn('c_total 108\n', handler.Metrics(
+                metrics_dir).render())
+        # A snapshot another worker retired first is left to it
+        metrics.retire(os.path.join(metrics_dir, '1.json'), other)
+        self.assertIn('c_total 108\n', metrics.render())
+
+    def test_pid_exists(self):
+        """pid_exists tells running processes from exited ones."""
+        self.assertTrue(handler.pid_exists(os.getpid()))
+        with patch('os.kill', side_effect=ProcessLookupError):
+            self.assertFalse(handler.pid_exists(1))
+        with patch('os.kill', side_effect=PermissionError):
+            self.assertTrue(handler.pid_exists(1))
+
+    @patch('request_handler.is_valid_recaptcha')
+    def test_metrics_endpoint_reports_requests(self, mock_recaptcha):
+        """
+        /metrics reports rejections, HTTP errors, attachment bytes, stage
+        latencies and table sizes recorded by the app.
+        """
+        mock_recaptcha.return_value = True
+        app = handler.create_app(with_static=False)
+        client = Client(app)
+        data = {'name': 'Valid Guy', 'email': 'example@osuosl.org',
+                'last_name': '', 'token': conf.TOKEN,
+                'redirect': 'http://www.example.com',
+                'g-recaptcha-response': ''}
+        with patch('werkzeug.utils.redirect', redirect), \
+                patch('rt.rest2.Rt'):
+            client.post('/', data=dict(data, attachment=(
+                BytesIO(b'file data'), 'doc.txt')))
+            data['token'] = 'wrong'
+            client.post('/', data=data)
+        client.get('/')
+        self.assertEqual(client.post('/metrics').status_code, 400)
+
+        text = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('formsender_rejections_total{error="3"} 1\n', text)
+        self.assertIn('formsender_http_errors_total{status="400"} 2\n', text)
+        self.assertIn('formsender_attachment_bytes_total 9\n', text)
+        self.assertIn('formsender_send_ticket_duration_seconds_count 1\n',
+                      text)
+        self.assertIn('formsender_recaptcha_duration_seconds_count 1\n', text)
+        self.assertIn('formsender_validation_duration_seconds_count 3\n',
+                      text)
+        self.assertIn('formsender_table_entries{table="duplicates",pid=', text)
+        self.assertIn('formsender_table_entries{table="clients",pid=', text)
+
+    # Tracing
+
+    @patch('request_handler.is_valid_recaptcha')
+    def test_traced_request_has_server_timing(self, mock_recaptcha):
+        """
+        Sampled requests time every phase in a Server-Timing header and
+        hand the trace to the exporter; unsampled requests get neither.
+        """
+        mock_recaptcha.return_value = True
+        exported = []
+        tracer = handler.Tracer(1.0)
+        tracer.export = lambda trace: exported.append(trace.to_dict())
+        app = handler.Forms(handler.Controller(), logging.getLogger('test'),
+                            rt_clients=MagicMock(), tracer=tracer)
+        client = Client(app)
+        data = {'name': 'Valid Guy', 'email': 'example@osuosl.org',
+                'last_name': '', 'token': conf.TOKEN,
+                'redirect': 'http://www.example.com',
+                'g-recaptcha-response': ''}
+        with patch('werkzeug.utils.redirect', redirect), \
+                patch('request_handler.deliver_ticket'):
+            response = client.post('/', data=data)
+            data['token'] = 'wrong'
+            rejected = client.post('/', data=data)
+            tracer.sample_rate = 0
+            untraced = client.post('/', data=data)
+
+        names = [timing.split(';')[0] for timing in
+                 response.headers['Server-Timing'].split(', ')]
+        self.assertEqual(names, ['parse', 'email', 'name', 'form', 'rate',
+                                 'duplicate', 'recaptcha', 'format_message',
+                                 'rt', 'redirect'])
+        self.assertEqual(response.headers['X-Request-ID'],
+                         exported[0]['trace_id'])
+        self.assertEqual([span['name'] for span in exported[0]['spans']],
+                         names)
+        names = [timing.split(';')[0] for timing in
+                 rejected.headers['Server-Timing'].split(', ')]
+        self.assertEqual(names, ['parse', 'email', 'name', 'form',
+                                 'redirect'])
+        self.assertNotIn('Server-Timing', untraced.headers)
+        self.assertEqual(len(exported), 2)
+
+    def test_tracer_exports_in_background(self):
+        """
+        Traces are exported on a background thread; exporter errors are
+        logged and do not stop later exports.
+        """
+        exported = []
+        done = threading.Event()
+
+        def exporter(trace):
+            if not exported:
+                exported.append(None)
+                raise OSError('collector down')
+            exported.append(trace)
+            done.set()
+
+        tracer = handler.Tracer(1.0, exporter)
+        with self.assertLogs('formsender', level='WARNING') as logs:
+            for _ in range(2):
+                trace = tracer.start()
+                with trace.span('parse'):
+                    pass
+                trace.finish()
+            self.assertTrue(done.wait(5))
+        self.assertIn('collector down', logs.output[0])
+        self.assertEqual(exported[1]['trace_id'], trace.trace_id)
+        self.assertEqual(exported[1]['spans'][0]['name'], 'parse')
+        self.assertIs(handler.Tracer().start(), handler.NULL_TRACE)
+
+    def test_tracer_drops_traces_while_exporter_lags(self):
+        """
+        Past max_queued traces waiting for the exporter, traces are dropped
+        and counted instead of queued.
+        """
+        exporting = threading.Event()
+        resume = threading.Event()
+        exported = []
+
+        def exporter(trace):
+            exporting.set()
+            resume.wait(5)
+            exported.append(trace)
+
+        metrics = handler.Metrics()
+        tracer = handler.Tracer(1.0, exporter, max_queued=1, metrics=metrics)
+        tracer.start().finish()
+        self.assertTrue(exporting.wait(5))
+        for _ in range(3):
+            tracer.start().finish()
+        self.assertIn('formsender_traces_dropped_total 2', metrics.render())
+        resume.set()
+        deadline = time.monotonic() + 5
+        while len(exported) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(exported), 2)
+
+    def test_trace_exporters(self):
+        """
+        The JSON lines exporter appends traces to a file and the OTLP
+        exporter posts them to the collector as OTLP JSON.
+        """
+        trace = {'trace_id': 'ab' * 16, 'start': 1000.0, 'duration': 0.5,
+                 'spans': [{'name': 'rt', 'start': 0.25, 'duration': 0.125}]}
+        trace_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, trace_dir)
+        path = os.path.join(trace_dir, 'traces.jsonl')
+        exporter = handler.JSONLinesExporter(path)
+        exporter(trace)
+        exporter(trace)
+        with open(path) as trace_file:
+            self.assertEqual([json.loads(line) for line in trace_file],
+                             [trace, trace])
+
+        posted = []
+
+        def collector(request):
+            posted.append(json.loads(request.content))
+            return httpx.Response(200, json={})
+
+        exporter = handler.OTLPExporter(
+            'http://collector/v1/traces',
+            transport=httpx.MockTransport(collector))
+        exporter(trace)
+        scope = posted[0]['resourceSpans'][0]['scopeSpans'][0]
+        span = scope['spans'][0]
+        self.assertEqual(span['traceId'], trace['trace_id'])
+        self.assertEqual(span['name'], 'rt')
+        self.assertEqual(span['startTimeUnixNano'], '1000250000000')
+        self.assertEqual(span['endTimeUnixNano'], '1000375000000')
+
+    def test_create_tracer(self):
+        """create_tracer picks the exporter named by TRACE_EXPORT."""
+        with patch.object(conf, 'TRACE_EXPORT', None, create=True):
+            self.assertIsNone(handler.create_tracer().exporter)
+        with patch.object(conf, 'TRACE_EXPORT', 'jsonl', create=True), \
+                patch.object(conf, 'TRACE_SAMPLE_RATE', 0.5, create=True):
+            tracer = handler.create_tracer()
+        self.assertIsInstance(tracer.exporter, handler.JSONLinesExporter)
+        self.assertEqual(tracer.sample_rate, 0.5)
+        with patch.object(conf, 'TRACE_EXPORT', 'otlp', create=True):
+            self.assertIsInstance(handler.create_tracer().exporter,
+                                  handler.OTLPExporter)
+
+    # ASGI app
+
+    def make_async_app(self, rt_latency=0, **kwargs):
+        """
+        Returns an AsyncForms whose RT and reCAPTCHA are httpx mock
+        transports, and a dict counting the tickets created in RT
+        """
+        tickets = {'created': 0, 'in_flight': 0, 'max_in_flight': 0,
+                   'content_types': []}
+
+        async def create_ticket(request):
+            if request.method == 'GET':
+                return httpx2.Response(200, json={})
+            tickets['in_flight'] += 1
+            tickets['max_in_flight'] = max(tickets['max_in_flight'],
+                                           tickets['in_flight'])
+            await asyncio.sleep(rt_latency)
+            tickets['in_flight'] -= 1
+            tickets['created'] += 1
+            tickets['content_types'].append(
+                request.headers['content-type'].split(';')[0])
+            return httpx2.Response(201, json={'id': str(tickets['created'])})
+
+        class Pool(handler.AsyncRTClientPool):
+            def create(self):
+                tracker = super().create()
+                tracker.session = httpx2.AsyncClient(
+                    transport=httpx2.MockTransport(create_ticket))
+                return tracker
+
+        verifier = handler.AsyncRecaptchaVerifier(
+            'secret', transport=httpx.MockTransport(
+                lambda request: httpx.Response(200, json={'success': True})))
+        app = handler.AsyncForms(handler.Controller(),
+                                 logging.getLogger('test'),
+                                 recaptcha=verifier,
+                                 async_rt_clients=Pool(50), **kwargs)
+        return app, tickets
+
+    def asgi_post(self, app, *requests):
+        """Posts each (data, files) in requests to app at once"""
+        async def post():
+            async with httpx.AsyncClient(
+                    transport=httpx.ASGITransport(app),
+                    base_url='http://formsender') as client:
+                return await asyncio.gather(*[
+                    client.post('/', data=data, files=files)
+                    for data, files in requests])
+        return asyncio.run(post())
+
+    def valid_form(self, number):
+        return {'name': 'Valid Guy', 'email': 'example@osuosl.org',
+                'last_name': '', 'token': conf.TOKEN,
+                'redirect': 'http://www.example.com',
+                'g-recaptcha-response': 'response',
+                'message': 'submission %d' % number}
+
+    @patch.object(conf, 'CEILING', 1000)
+    @patch.object(conf, 'CLIENT_BURST', 1000)
+    def test_asgi_submissions_wait_on_rt_concurrently(self):
+        """
+        The ASGI app creates tickets for concurrent submissions while
+        earlier ones still wait on RT, attachments included.
+        """
+        app, tickets = self.make_async_app(rt_latency=0.05)
+        requests = [(self.valid_form(number), None) for number in range(20)]
+        requests.append((self.valid_form(20),
+                         {'attachment': ('doc.txt', b'file data')}))
+        with patch('werkzeug.utils.redirect', redirect):
+            responses = self.asgi_post(app, *requests)
+        self.assertEqual([response.headers['location']
+                          for response in responses],
+                         ['http://www.example.com'] * 21)
+        self.assertEqual(tickets['created'], 21)
+        self.assertGreater(tickets['max_in_flight'], 10)
+        self.assertEqual(tickets['content_types'].count('multipart/form-data'),
+                         1)
+
+    def test_asgi_rejections_keep_their_own_error(self):
+        """
+        Concurrent rejections each redirect with their own error, and
+        traced requests carry Server-Timing.
+        """
+        app, tickets = self.make_async_app(tracer=handler.Tracer(1.0))
+        spam = dict(self.valid_form(0), last_name='Cheap watches')
+        with patch('werkzeug.utils.redirect', redirect):
+            responses = self.asgi_post(
+                app, (spam, None),
+                (dict(self.valid_form(1), email='not an email'), None),
+                (self.valid_form(2), None))
+        self.assertEqual([response.headers['location'].split('&')[0]
+                          for response in responses],
+                         ['http://www.example.com?error=3',
+                          'http://www.example.com?error=1',
+                          'http://www.example.com'])
+        self.assertIn('recaptcha;dur=', responses[2].headers['Server-Timing'])
+        self.assertEqual(tickets['created'], 1)
+
+    def test_asgi_recaptcha_and_spool(self):
+        """
+        A failed reCAPTCHA rejects the submission with error 6; in spool
+        mode valid tickets are queued instead of created.
+        """
+        spool = self.make_spool()
+        app, tickets = self.make_async_app(spool=spool)
+        app.recaptcha = handler.AsyncRecaptchaVerifier(
+            'secret', transport=httpx.MockTransport(
+                lambda request: httpx.Response(200, json={'success': False})))
+        with patch('werkzeug.utils.redirect', redirect):
+            rejected, = self.asgi_post(app, (self.valid_form(0), None))
+            app.recaptcha.session = httpx.AsyncClient(
+                transport=httpx.MockTransport(
+                    lambda request: httpx.Response(503)))
+            failed, = self.asgi_post(app, (self.valid_form(1), None))
+            app.recaptcha.fail_open = True
+            spooled, = self.asgi_post(app, (self.valid_form(2), None))
+        self.assertIn('error=6', rejected.headers['location'])
+        self.assertIn('error=6', failed.headers['location'])
+        self.assertEqual(spooled.headers['location'], 'http://www.example.com')
+        self.assertEqual(spool.counts(), {'pending': 1})
+        self.assertEqual(tickets['created'], 0)
+
+    def asgi_call(self, app, scope, messages):
+        """Calls app with scope, returns what it sent"""
+        sent = []
+        messages = list(messages)
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = dict({'type': 'http', 'method': 'POST', 'path': '/',
+                      'headers': []}, **scope)
+        asyncio.run(app(scope, receive, send))
+        return sent
+
+    @patch.object(conf, 'MAX_CONTENT_LENGTH', 1000)
+    def test_asgi_request_bodies(self):
+        """
+        Bodies over MAX_CONTENT_LENGTH get a 413, with or without a
+        Content-Length; a client that disconnects gets no answer; other
+        endpoints answer as in the WSGI app.
+        """
+        app, _ = self.make_async_app()
+        sent = self.asgi_call(
+            app, {'headers': [(b'content-length', b'5000')]}, [])
+        self.assertEqual(sent[0]['status'], 413)
+        chunk = {'type': 'http.request', 'body': b'x' * 600,
+                 'more_body': True}
+        sent = self.asgi_call(app, {}, [chunk, chunk])
+        self.assertEqual(sent[0]['status'], 413)
+        sent = self.asgi_call(app, {}, [chunk, {'type': 'http.disconnect'}])
+        self.assertEqual(sent, [])
+
+        sent = self.asgi_call(app, {'method': 'GET', 'path': '/server-status',
+                                    'server': ('formsender', 5000),
+                                    'client': ('192.0.2.1', 1234)},
+                              [{'type': 'http.request'}])
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(sent[1]['body'].splitlines()[0], b'OK')
+        sent = self.asgi_call(app, {'path': '/nowhere'},
+                              [{'type': 'http.request'}])
+        self.assertEqual(sent[0]['status'], 404)
+        text = app.metrics.render()
+        self.assertIn('formsender_http_errors_total{status="413"} 2', text)
+
+    def test_asgi_environ(self):
+        """asgi_environ maps an ASGI scope onto a WSGI environ."""
+        environ = handler.asgi_environ({
+            'method': 'POST', 'path': '/caf\u00e9', 'query_string': b'a=1',
+            'headers': [(b'content-type', b'text/plain'),
+                        (b'x-forwarded-for', b'192.0.2.1'),
+                        (b'x-forwarded-for', b'192.0.2.2')]}, BytesIO())
+        self.assertEqual(environ['PATH_INFO'], '/caf\u00c3\u00a9')
+        self.assertEqual(environ['QUERY_STRING'], 'a=1')
+        self.assertEqual(environ['CONTENT_TYPE'], 'text/plain')
+        self.assertEqual(environ['HTTP_X_FORWARDED_FOR'],
+                         '192.0.2.1,192.0.2.2')
+        self.assertEqual(environ['SERVER_NAME'], 'localhost')
+        self.assertEqual(environ['REMOTE_ADDR'], '')
+
+    def test_asgi_form_page_get_and_empty_message(self):
+        """
+        The async form page falls back to the local error page for GETs
+        and empty messages, like the WSGI one.
+        """
+        app, _ = self.make_async_app()
+        get = Request(EnvironBuilder(method='GET').get_environ())
+        post = Request(EnvironBuilder(method='POST', data={}).get_environ())
+
+        async def false(request):
+            return False
+
+        with patch.object(app, 'are_fields_invalid', false):
+            self.assertEqual(
+                asyncio.run(app.on_form_page(get)).status_code, 400)
+        with patch('request_handler.create_msg', return_value=None):
+            self.assertEqual(
+                asyncio.run(app.handle_no_error(
+                    handler.Submission.from_request(post))).status_code, 400)
+
+    def test_asgi_lifespan(self):
+        """
+        Lifespan startup pre-connects to RT in the background when
+        RT_PRECONNECT is set and shutdown closes the connections.
+        """
+        app, _ = self.make_async_app()
+        app.async_rt_clients.size = 2
+        app.async_rt_clients.reset()
+        sent = []
+        warmed = []
+        messages = [{'type': 'lifespan.startup'},
+                    {'type': 'lifespan.shutdown'}]
+
+        async def receive():
+            if not messages[0]['type'].endswith('startup'):
+                await asyncio.sleep(0.1)
+                warmed.append(len(app.async_rt_clients.idle))
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        with patch.object(conf, 'RT_PRECONNECT', True, create=True):
+            asyncio.run(app({'type': 'lifespan'}, receive, send))
+        self.assertEqual([message['type'] for message in sent],
+                         ['lifespan.startup.complete',
+                          'lifespan.shutdown.complete'])
+        self.assertEqual(warmed, [2])
+        self.assertEqual(app.async_rt_clients.idle, [])
+        self.assertTrue(app.recaptcha.session.is_closed)
+
+    def test_async_rt_client_pool(self):
+        """
+        The async pool reuses clients, drops one after a connection error,
+        logs failed pre-connects and starts over in a forked child.
+        """
+        pool = handler.AsyncRTClientPool(2)
+        pool.create = MagicMock(side_effect=lambda: MagicMock(
+            session=MagicMock(get=AsyncMock(side_effect=OSError('down')),
+                              aclose=AsyncMock())))
+        logger = MagicMock()
+
+        async def use():
+            self.assertEqual(await pool.preconnect(logger), 0)
+            async with pool.client() as first:
+                pass
+            async with pool.client() as second:
+                self.assertIs(first, second)
+            with self.assertRaises(rt.exceptions.ConnectionError):
+                async with pool.client():
+                    raise rt.exceptions.ConnectionError('down', None)
+            self.assertEqual(pool.idle, [])
+            first.session.aclose.assert_awaited_once_with()
+            dead = handler.AsyncRTClientPool(1, url=self.dead_rt_url(),
+                                             token='token')
+            with self.assertRaises(ConnectionError):
+                async with dead.client() as broken:
+                    await broken.create_ticket('General', subject='Hello')
+            self.assertTrue(broken.session.is_closed)
+            self.assertEqual(dead.idle, [])
+
+        asyncio.run(use())
+        self.assertEqual(logger.warning.call_count, 2)
+        pool.pid = -1
+        self.assertEqual(asyncio.run(pool.preconnect()), 0)
+        self.assertEqual(pool.pid, os.getpid())
+        pool.pid = -1
+
+        async def forked():
+            async with pool.client():
+                pass
+        asyncio.run(forked())
+        self.assertEqual(pool.pid, os.getpid())
+        self.assertIsInstance(handler.AsyncRTClientPool().create(),
+                              rt.rest2.AsyncRt)
+
+    def test_create_asgi_app(self):
+        """create_asgi_app builds an AsyncForms with async clients."""
+        app = handler.create_asgi_app()
+        self.assertIsInstance(app, handler.AsyncForms)
+        self.assertIsInstance(app.recaptcha, handler.AsyncRecaptchaVerifier)
+        self.assertIsInstance(app.async_rt_clients,
+                              handler.AsyncRTClientPool)
+        self.assertIsInstance(
+            handler.AsyncForms(handler.Controller(),
+                               logging.getLogger('test')).recaptcha,
+            handler.AsyncRecaptchaVerifier)
+
+    # Submission
+
+    def test_submission_is_immutable(self):
+        """
+        A Submission holds the parsed form read-only and fingerprints it like
+        the message it was built from.
+        """
+        builder = EnvironBuilder(method='POST', data={
+            'name': 'Valid Guy', 'email': 'example@osuosl.org',
+            'redirect': 'http://www.example.com?query=1',
+            'custom_fields': 'CompanyName:companyname',
+            'companyname': 'OPF',
+            'attachment': (BytesIO(b'file data'), 'doc.txt')})
+        req = Request(builder.get_environ())
+        submission = handler.Submission.from_request(req)
+        self.assertEqual(submission.fields['redirect'],
+                         'http://www.example.com')
+        self.assertEqual(submission.custom_fields, {'CompanyName': 'OPF'})
+        self.assertEqual(submission.cf_sources, {'companyname'})
+        self.assertEqual(submission.attachments[0].file_name, 'doc.txt')
+        self.assertEqual(submission.fingerprint,
+                         handler.fingerprint(handler.create_msg(req)))
+        with self.assertRaises(AttributeError):
+            submission.fields = {}
+        with self.assertRaises(TypeError):
+            submission.fields['name'] = 'Someone Else'
+        with self.assertRaises(AttributeError):
+            submission.extra = True
+
+        controller = handler.Controller()
+        self.assertFalse(controller.is_duplicate(submission))
+        self.assertTrue(controller.is_duplicate(
+            handler.create_msg(req)))
+
+    @patch('request_handler.is_valid_recaptcha')
+    def test_submission_built_once_per_request(self, mock_recaptcha):
+        """
+        A valid POST builds its message once and format_message leaves the
+        message it formats as it was.
+        """
+        mock_recaptcha.return_value = True
+        app = handler.Forms(handler.Controller(), logging.getLogger('test'),
+                            rt_clients=MagicMock())
+        data = {'name': 'Valid Guy', 'email': 'example@osuosl.org',
+                'last_name': '', 'token': conf.TOKEN,
+                'redirect': 'http://www.example.com',
+                'g-recaptcha-response': '', 'date': 'today',
+                'fields_to_join': 'name,date'}
+        with patch('werkzeug.utils.redirect', redirect), \
+                patch('request_handler.deliver_ticket'), \
+                patch('request_handler.create_msg',
+                      side_effect=handler.create_msg) as mock_create_msg:
+            response = Client(app).post('/', data=data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(mock_create_msg.call_count, 1)
+
+        message = dict(data)
+        handler.format_message(message)
+        self.assertEqual(message, data)
+
+    # Ticket body layouts
+
+    def test_body_layouts_compile_once_per_field_set(self):
+        """
+        Messages with the same fields share a compiled layout; the least
+        recently used layout is dropped when the cache is full.
+        """
+        layouts = handler.BodyLayouts(max_layouts=2)
+        first = {'name': 'A', 'email': 'a@osuosl.org', 'project': 'x'}
+        second = {'name': 'B', 'email': 'b@osuosl.org', 'project': 'y'}
+        handler.format_message(first, layouts=layouts)
+        self.assertEqual(handler.format_message(second, layouts=layouts),
+                         handler.format_message(second,
+                                                layouts=handler.BodyLayouts()))
+        self.assertIs(layouts.get(first), layouts.get(second))
+        layouts.get(first, exclude={'project'})
+        layouts.get(dict(first, Project='z'))
+        self.assertEqual(layouts.stats(), {'entries': 2, 'max_entries': 2,
+                                           'hits': 3, 'misses': 3,
+                                           'evictions': 1})
+
+    def test_body_layout_matches_fields_to_join_rules(self):
+        """
+        The compiled layout puts joined fields under fields_to_join_name,
+        unless that names an existing field, and sorts titles ignoring case.
+        """
+        message = {'name': 'A', 'email': 'a@osuosl.org', 'Zeta': 'z',
+                   'alpha': 'a', 'fields_to_join': 'alpha,Zeta',
+                   'fields_to_join_name': 'Joined'}
+        self.assertEqual(handler.format_message(message).split(
+            '------------\n')[1], 'Alpha:\na\n\nJoined:\na:z\n\n'
+            'Zeta:\nz\n\n')
+        message['fields_to_join_name'] = 'alpha'
+        self.assertIn('Fields To Join:\na:z\n\n',
+                      handler.format_message(message))
+        self.assertEqual(handler.BODY_LAYOUTS.get(message).items(message),
+                         [('Alpha', 'a'), ('Fields To Join', 'a:z'),
+                          ('Zeta', 'z')])
+
+    def test_body_template(self):
+        """
+        A form's body_template is rendered from templates/bodies; unknown
+        or invalid names fall back to the default layout.
+        """
+        app = handler.Forms(handler.Controller(), logging.getLogger('test'))
+        data = {'name': 'John Doe', 'email': 'example@email.com',
+                'redirect': 'http://www.example.com', 'distribution': 'Fedora', 'community_size': '15 <devs>',
+                'body_template': 'example'}
+        req = Request(EnvironBuilder(method='POST', data=data).get_environ())
+        self.assertEqual(
+            app.format_body(handler.Submission.from_request(req)),
+            'Submitted by John Doe <example@email.com>\n\n'
+            'Community Size: 15 <devs>\nDistribution: Fedora')
+        for name in ('missing', '../error'):
+            data['body_template'] = name
+            req = Request(EnvironBuilder(method='POST',
+                                         data=data).get_environ())
+            with self.assertLogs('test', level='WARNING'):
+                body = app.format_body(handler.Submission.from_request(req))
+            self.assertEqual(body, handler.format_message(data))
+        self.assertIn('formsender_table_misses{table="layouts"',
+                      app.metrics.render())
+
+    # Server-side form definitions
+
+    def make_forms_dir(self, **files):
+        """Returns a directory holding files (name: content)"""
+        forms_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, forms_dir)
+        for name, content in files.items():
+            with open(os.path.join(forms_dir, name), 'w') as definition:
+                definition.write(content)
+        return forms_dir
+
+    def test_form_registry_loads_json_toml_yaml(self):
+        """
+        Definitions load from JSON, TOML and YAML files named after the
+        form ID; other files are ignored.
+        """
+        forms_dir = self.make_forms_dir(**{
+            'hosting.json': json.dumps({
+                'send_to': 'Hosting', 'fields_to_join': ['email', 'date'],
+                'custom_fields': {'CompanyName': 'company'}}),
+            'support.toml': 'send_to = "Support"\nrequired = ["project"]\n',
+            'power.yaml': 'send_to: Power\nbody_template: example\n',
+            'README.md': 'not a definition'})
+        forms = handler.FormRegistry.load(forms_dir)
+        self.assertEqual(len(forms), 3)
+        hosting = forms.get('hosting')
+        self.assertEqual(hosting.required, {'email'})
+        self.assertEqual(hosting.custom_fields, (('CompanyName', 'company'),))
+        self.assertEqual(forms.get('support').required, {'project'})
+        self.assertEqual(forms.get('power').body_template, 'example')
+        with self.assertRaises(werkzeug.exceptions.NotFound):
+            forms.get('README')
+        with self.assertRaises(AttributeError):
+            hosting.send_to = 'General'
+        with patch.dict('sys.modules', {'yaml': None}), \
+                self.assertRaises(ValueError):
+            handler.FormRegistry.load(forms_dir)
+
+    def test_form_registry_rejects_bad_definitions(self):
+        """A mistake in any definition stops the registry from loading."""
+        for content in ('["not", "a", "mapping"]',
+                        '{"queue": "General"}',
+                        '{"send_to": 5}',
+                        '{"body_template": "../error"}',
+                        '{"fields_to_join_name": "Joined"}',
+                        '{"required": [""]}'):
+            forms_dir = self.make_forms_dir(**{'bad.json': content})
+            with self.assertRaises(ValueError):
+                handler.FormRegistry.load(forms_dir)
+
+    @patch('request_handler.is_valid_recaptcha')
+    def test_form_definition_overrides_hidden_fields(self, mock_recaptcha):
+        """
+        A form posted to /forms/<form_id> is routed, titled and mapped by
+        its definition, whatever hidden fields it sends; unknown forms get
+        a 404 and forms missing required fields error 3.
+        """
+        mock_recaptcha.return_value = True
+        forms_dir = self.make_forms_dir(**{'hosting.json': json.dumps({
+            'send_to': 'Hosting', 'mail_subject_prefix': 'Hosting Request',
+            'mail_subject_key': 'project',
+            'custom_fields': {'CompanyName': 'company'},
+            'fields_to_join': 'project,name',
+            'fields_to_join_name': 'Description'})})
+        with patch.object(conf, 'FORMS_DIR', forms_dir, create=True):
+            app = handler.create_app(with_static=False)
+        client = Client(app)
+        data = {'name': 'Valid Guy', 'email': 'example@osuosl.org',
+                'last_name': '', 'token': conf.TOKEN,
+                'redirect': 'http://www.example.com',
+                'g-recaptcha-response': '', 'project': 'Formsender',
+                'company': 'OSL', 'send_to': 'Elsewhere',
+                'custom_fields': 'Owner:name', 'mail_subject_prefix': 'Spam'}
+        with patch('werkzeug.utils.redirect', redirect), \
+                patch('request_handler.deliver_ticket') as mock_deliver:
+            response = client.post('/forms/hosting', data=data)
+            self.assertEqual(client.post('/forms/nowhere',
+                                         data=data).status_code, 404)
+            del data['project']
+            rejected = client.post('/forms/hosting', data=data)
+        self.assertEqual(response.headers['location'],
+                         'http://www.example.com')
+        self.assertIn('error=3', rejected.headers['location'])
+        ticket_args = mock_deliver.call_args[0][0]
+        self.assertEqual(ticket_args['queue'], 'Hosting')
+        self.assertEqual(ticket_args['subject'], 'Hosting Request: Formsender')
+        self.assertEqual(ticket_args['CustomFields'], {'CompanyName': 'OSL'})
+        self.assertIn('Description:\nFormsender:Valid Guy\n',
+                      ticket_args['content'])
+        self.assertNotIn('Company', ticket_args['content'])
+
+    def test_form_definition_subject(self):
+        """Definitions build subjects like set_mail_subject."""
+        message = {'project': 'Formsender', 'empty': ''}
+        for settings in ({}, {'mail_subject_prefix': 'Prefix'},
+                         {'mail_subject_key': 'project'},
+                         {'mail_subject_key': 'missing'},
+                         {'mail_subject_prefix': 'Prefix',
+                          'mail_subject_key': 'empty'},
+                         {'mail_subject_prefix': 'Prefix',
+                          'mail_subject_key': 'project'}):
+            definition = handler.FormDefinition('form', **settings)
+            self.assertEqual(definition.subject(message),
+                             handler.set_mail_subject(dict(message,
+                                                           **settings)))
+
+    # MX checks
+
+    def start_nameserver(self):
+        """
+        Starts a stub DNS server on localhost, returns its address and the
+        list of names it has been asked about
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        self.addCleanup(sock.close)
+        queries = []
+        soa = b'\xc0\x0c' * 2 + struct.pack('!IIIII', 1, 2, 3, 4, 60)
+        zones = {
+            'mail.test': (0, [(15, 300, b'\x00\x0a\xc0\x0c')]),
+            'nomail.test': (0, [(15, 300, b'\x00\x00\x00')]),
+            'web.test': (0, [(6, 3600, soa)]),
+            'missing.test': (3, [(6, 3600, soa)]),
+            'broken.test': (2, []),
+            'garbled.test': (0, None),
+        }
+
+        def serve():
+            while True:
+                try:
+                    query, client = sock.recvfrom(512)
+                except OSError:
+                    return
+                name = query[13:query.index(b'\x00', 12)]
+                name = re.sub(rb'[\x00-\x1f]', b'.', name).decode()
+                queries.append(name)
+                if name not in zones:
+                    continue  # never answers, like a slow resolver
+                rcode, records = zones[name]
+                query_id = int.from_bytes(query[:2], 'big')
+                # First another query's answer, which is ignored
+                sock.sendto(struct.pack('!HHHHHH', query_id ^ 1, 0x8180,
+                                        1, 0, 0, 0), client)
+                if records is None:
+                    response = query[:2] + struct.pack('!HHHHH', 0x8180, 1,
+                                                       1, 0, 0) + query[12:]
+                else:
+                    response = query[:2] + struct.pack(
+                        '!HHHHH', 0x8180 | rcode, 1, 0, len(records), 0)
+                    response += query[12:]
+                    for rtype, ttl, data in records:
+                        response += struct.pack('!HHHIH', 0xc00c, rtype, 1,
+                                                ttl, len(data)) + data
+                sock.sendto(response, client)
+
+        threading.Thread(target=serve, daemon=True).start()
+        return '127.0.0.1:%d' % sock.getsockname()[1], queries
+
+    def test_mx_resolver_caches_answers(self):
+        """
+        MXResolver answers from its cache until the TTL runs out, and fails
+        open when the nameserver errors or doesn't answer in time.
+        """
+        nameserver, queries = self.start_nameserver()
+        resolver = handler.MXResolver(nameserver, timeout=0.2,
+                                      negative_ttl=120)
+        self.assertTrue(resolver.is_deliverable('mail.test'))
+        self.assertTrue(resolver.is_deliverable('mail.test'))
+        self.assertFalse(resolver.is_deliverable('nomail.test'))
+        self.assertTrue(resolver.is_deliverable('web.test'))
+        self.assertFalse(resolver.is_deliverable('missing.test'))
+        # NXDOMAIN is cached for the SOA's MINIMUM, not negative_ttl
+        self.assertLessEqual(resolver.answers['missing.test'][1],
+                             time.monotonic() + 60)
+        started = time.monotonic()
+        self.assertTrue(resolver.is_deliverable('slow.test'))
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertTrue(resolver.is_deliverable('broken.test'))
+        self.assertTrue(resolver.is_deliverable('garbled.test'))
+        self.assertEqual(queries, ['mail.test', 'nomail.test', 'web.test',
+                                   'missing.test', 'slow.test',
+                                   'broken.test', 'garbled.test'])
+        self.assertEqual(resolver.stats(), {
+            'entries': 4, 'max_entries': 10000, 'hits': 1, 'misses': 7,
+            'evictions': 0, 'failures': 3})
+        resolver.max_entries = 1
+        resolver.fail_open = False
+        with patch('time.monotonic', return_value=started + 301):
+            self.assertFalse(resolver.is_deliverable('slow.test'))
+            # Expired, so asked again; the rest are evicted to make room
+            self.assertTrue(resolver.is_deliverable('mail.test'))
+        self.assertEqual(queries[-1], 'mail.test')
+        self.assertEqual(list(resolver.answers), ['mail.test'])
+        with self.assertRaises(ValueError):
+            resolver.answer('x', b'\x00', 0)
+
+    def test_async_mx_resolver(self):
+        """AsyncMXResolver gives the same answers without blocking."""
+        nameserver, queries = self.start_nameserver()
+        resolver = handler.AsyncMXResolver(nameserver, timeout=0.2)
+        closed = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        closed.bind(('127.0.0.1', 0))
+        refused = handler.AsyncMXResolver(
+            '127.0.0.1:%d' % closed.getsockname()[1], timeout=1)
+        closed.close()
+
+        async def lookups():
+            return await asyncio.gather(*[
+                resolver.is_deliverable(domain) for domain in (
+                    'mail.test', 'nomail.test', 'missing.test', 'slow.test',
+                    'garbled.test')], refused.is_deliverable('mail.test'))
+        self.assertEqual(asyncio.run(lookups()),
+                         [True, False, False, True, True, True])
+        self.assertTrue(asyncio.run(resolver.is_deliverable('mail.test')))
+        self.assertEqual(queries.count('mail.test'), 1)
+        self.assertEqual(resolver.stats()['failures'], 2)
+        self.assertEqual(refused.stats()['failures'], 1)
+
+    def test_mx_check_rejects_undeliverable_domains(self):
+        """
+        With CHECK_MX on, addresses at domains that don't accept mail get
+        'Invalid Email'; addresses without a plain domain aren't looked up.
+        """
+        nameserver, queries = self.start_nameserver()
+        data = {'name': 'Valid Guy', 'last_name': '', 'token': conf.TOKEN,
+                'redirect': 'http://www.example.com',
+                'g-recaptcha-response': 'response'}
+        with patch.object(conf, 'CHECK_MX', True, create=True), \
+                patch.object(conf, 'MX_NAMESERVER', nameserver,
+                             create=True), \
+                patch('request_handler.is_valid_recaptcha',
+                      return_value=True), \
+                patch.object(handler.Forms, 'deliver'), \
+                patch('werkzeug.utils.redirect', redirect):
+            app = handler.create_app(with_static=False)
+            client = Client(app)
+            for email, rejected in [('a@mail.test', False),
+                                    ('b@MISSING.test', True),
+                                    ('c@[10.0.0.1]', False)]:
+                response = client.post('/', data=dict(data, email=email,
+                                                      message=email))
+                self.assertEqual('error=1' in response.headers['location'],
+                                 rejected)
+            async_app = handler.create_asgi_app()
+            self.assertIsInstance(async_app.mx, handler.AsyncMXResolver)
+        self.assertEqual(queries, ['mail.test', 'missing.test'])
+        metrics = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('formsender_table_misses{table="mx",pid="%d"} 2'
+                      % os.getpid(), metrics)
+        async_app, tickets = self.make_async_app(
+            mx=handler.AsyncMXResolver(nameserver))
+        responses = self.asgi_post(
+            async_app, (dict(self.valid_form(1), email='a@nomail.test'), None),
+            (self.valid_form(2), None))
+        self.assertIn('error=1', responses[0].headers['location'])
+        self.assertEqual(tickets['created'], 1)
+
+    def test_mx_helpers(self):
+        """Domains and nameservers are read like the resolver needs them."""
+        self.assertEqual(handler.email_domain('a@Bücher.example.'),
+                         'xn--bcher-kva.example')
+        self.assertIsNone(handler.email_domain('a@' + 'x' * 64 + '.org'))
+        self.assertIsNone(handler.email_domain('a@localhost'))
+        for nameserver, address in [('10.0.0.1', ('10.0.0.1', 53)),
+                                    ('10.0.0.1:5353', ('10.0.0.1', 5353)),
+                                    ('[::1]', ('::1', 53)),
+                                    ('[::1]:5353', ('::1', 5353))]:
+            self.assertEqual(handler.parse_nameserver(nameserver), address)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'resolv.conf')
+        self.assertEqual(handler.system_nameserver(path), '127.0.0.1')
+        with open(path, 'w') as resolv_conf:
+            resolv_conf.write('search osuosl.org\nnameserver fe80::1\n')
+        self.assertEqual(handler.system_nameserver(path), '[fe80::1]')
+        self.assertEqual(handler.MXResolver().nameserver[1], 53)
+
+    # Logging
+
+    def test_logger_is_set_up_once(self):
+        """
+        create_logger queues records for a background listener, once no
+        matter how many apps are created; LOG_LEVEL is applied each time.
+        """
+        with patch.object(conf, 'LOG_LEVEL', 'WARNING', create=True):
+            handler.create_app(with_static=False)
+            logger = handler.create_logger()
+            self.assertEqual(logger.level, logging.WARNING)
+        logger = handler.create_logger()
+        self.assertEqual(logger.level, logging.getLevelName(conf.LOG_LEVEL))
+        queue_handlers = [log_handler for log_handler in logger.handlers
+                          if isinstance(log_handler, handler.LogQueueHandler)]
+        self.assertEqual(len(queue_handlers), 1)
+        listener = queue_handlers[0].listener
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            logger.info('formsender: %(greeting)s from %(token)s',
+                        {'greeting': 'hello', 'token': conf.TOKEN})
+            listener.stop()
+            listener.start()
+        self.assertEqual(stdout.getvalue(),
+                         'INFO formsender: hello from [redacted]\n')
+
+    def test_log_redaction_and_sampling(self):
+        """
+        Mapping arguments are redacted at any depth when formatted, as text
+        or JSON, and sampled events are only sometimes kept.
+        """
+        message = types.MappingProxyType({'name': 'Valid Guy',
+                                          'token': 'secret'})
+        record = logging.LogRecord('formsender', logging.DEBUG, __file__, 1,
+                                   'formsender message: %(message)s',
+                                   ({'message': message},), None)
+        record.event = 'message'
+        text = handler.RedactingFormatter('%(levelname)s %(message)s',
+                                          redact=['token'])
+        self.assertEqual(text.format(record),
+                         "DEBUG formsender message: {'name': 'Valid Guy', "
+                         "'token': '[redacted]'}")
+        self.assertIs(record.args['message'], message)
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            record.exc_info = sys.exc_info()
+        entry = json.loads(handler.JSONLogFormatter(
+            redact=['token']).format(record))
+        self.assertEqual(entry['fields'], {'message': {
+            'name': 'Valid Guy', 'token': '[redacted]'}})
+        self.assertEqual((entry['level'], entry['event']),
+                         ('DEBUG', 'message'))
+        self.assertIn('ValueError: boom', entry['exception'])
+        sampler = handler.LogSampler({'message': 0.5})
+        with patch('random.random', side_effect=[0.2, 0.7]):
+            self.assertTrue(sampler.filter(record))
+            self.assertFalse(sampler.filter(record))
+        self.assertTrue(sampler.filter(logging.makeLogRecord({})))
+        queue_handler = handler.LogQueueHandler(None)
+        self.assertIs(queue_handler.prepare(record), record)
+
+    # Validator pipeline
+
+    def test_validators_run_cheapest_first(self):
+        """
+        Validators run by cost class, then as listed; VALIDATOR_ORDER and
+        VALIDATORS_DISABLED change that per deployment.
+        """
+        calls = []
+
+        def validator(name, cost):
+            return handler.Validator(name, cost, 9, name,
+                                     lambda app, submission: calls.append(
+                                         name) or True)
+        validators = [validator('remote', 'remote'),
+                      validator('state', 'state'),
+                      validator('first', 'cpu'), validator('second', 'cpu')]
+        pipeline = handler.ValidatorPipeline(validators)
+        self.assertEqual([v.name for v in pipeline],
+                         ['first', 'second', 'state', 'remote'])
+        pipeline = handler.ValidatorPipeline(validators, order=['remote'],
+                                             disabled=['second'])
+        self.assertEqual([v.name for v in pipeline],
+                         ['remote', 'first', 'state'])
+        self.assertEqual(repr(pipeline.validators[0]),
+                         "Validator('remote', 'remote')")
+        with self.assertRaises(ValueError):
+            handler.ValidatorPipeline(validators, disabled=['missing'])
+        with self.assertRaises(ValueError):
+            validator('free', 'none')
+        app = handler.Forms(handler.Controller(), logging.getLogger('test'),
+                            validators=validators)
+        self.assertEqual([v.name for v in app.validators],
+                         ['first', 'second', 'state', 'remote'])
+        req = Request(EnvironBuilder(method='POST', data={
+            'name': 'Valid Guy', 'redirect': 'http://www.example.com'
+        }).get_environ())
+        self.assertFalse(app.find_invalid_field(
+            handler.Submission.from_request(req)))
+        self.assertEqual(calls, ['first', 'second', 'state', 'remote'])
+
+    @patch('request_handler.is_valid_recaptcha')
+    def test_validator_order_from_conf(self, mock_recaptcha):
+        """
+        Reordered checks reject with the first failing check's error, and
+        /metrics reports each validator's runs and rejections.
+        """
+        data = {'name': '  ', 'email': 'example@osuosl.org',
+                'last_name': '', 'token': 'wrong',
+                'redirect': 'http://www.example.com'}
+        with patch.object(conf, 'VALIDATOR_ORDER', ['form'], create=True), \
+                patch.object(conf, 'VALIDATORS_DISABLED', ['recaptcha'],
+                             create=True), \
+                patch.object(handler.Forms, 'deliver'), \
+                patch('werkzeug.utils.redirect', redirect):
+            app = handler.create_app(with_static=False)
+            client = Client(app)
+            self.assertIn('error=3',
+                          client.post('/', data=data).headers['location'])
+            data['token'] = conf.TOKEN
+            self.assertIn('error=2',
+                          client.post('/', data=data).headers['location'])
+            data['name'] = 'Valid Guy'
+            self.assertNotIn('error',
+                             client.post('/', data=data).headers['location'])
+        mock_recaptcha.assert_not_called()
+        metrics = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('formsender_validator_rejections_total'
+                      '{validator="form"} 1', metrics)
+        self.assertIn('formsender_validator_duration_seconds_count'
+                      '{validator="form"} 3', metrics)
+        self.assertIn('formsender_validator_duration_seconds_count'
+                      '{validator="email"} 2', metrics)
+        self.assertNotIn('validator="recaptcha"', metrics)
+
+    def test_rejected_or_undelivered_submission_can_be_resent(self):
+        """
+        A submission is only remembered as a duplicate once it passed every
+        check and was delivered: one that failed reCAPTCHA, or couldn't be
+        delivered, can be sent again.
+        """
+        app = handler.create_app(with_static=False)
+        client = Client(app)
+        breaker = handler.CircuitBreaker('rt')
+        with patch('werkzeug.utils.redirect', redirect), \
+                patch.object(handler.Forms, 'is_valid_recaptcha',
+                             side_effect=[False, True, True, True]), \
+                patch.object(handler.Forms, 'deliver',
+                             side_effect=[handler.CircuitOpen(breaker),
+                                          ValueError('RT said no'), 1]):
+            response = client.post('/', data=self.valid_form(1))
+            self.assertIn('error=6', response.headers['location'])
+            self.assertEqual(client.post('/', data=self.valid_form(1))
+                             .status_code, 503)
+            with self.assertRaises(ValueError):
+                client.post('/', data=self.valid_form(1))
+            response = client.post('/', data=self.valid_form(1))
+            self.assertEqual(response.headers['location'],
+                             'http://www.example.com')
+            response = client.post('/', data=self.valid_form(1))
+            self.assertIn('error=5', response.headers['location'])
+
+    def test_asgi_undelivered_submission_can_be_resent(self):
+        """The ASGI app forgets submissions it rejected or didn't deliver."""
+        app, tickets = self.make_async_app()
+        with patch('werkzeug.utils.redirect', redirect), \
+                patch.object(handler.AsyncForms, 'is_valid_recaptcha',
+                             side_effect=[False, True, True]), \
+                patch.object(handler.AsyncForms, 'deliver_async',
+                             side_effect=[handler.CircuitOpen(
+                                 handler.CircuitBreaker('rt')), 1]):
+            locations = [self.asgi_post(app, (self.valid_form(1), None))[0]
+                         .headers.get('location') for _ in range(3)]
+            response, = self.asgi_post(app, (self.valid_form(1), None))
+        self.assertIn('error=6', locations[0])
+        self.assertIsNone(locations[1])
+        self.assertEqual(locations[2], 'http://www.example.com')
+        self.assertIn('error=5', response.headers['location'])
+
+    # Admission control
+
+    def test_admission_turns_requests_away_before_parsing(self):
+        """
+        Form requests with a wrong method, size or content type, from a
+        blocked or rate-limited client, are answered from their headers.
+        """
+        app = handler.create_app(with_static=False)
+        now = [1000.0]
+        app.controller.clients = handler.ClientRateLimiter(
+            rate=0.5, burst=1, clock=lambda: now[0])
+        app.admission = handler.Admission(app.controller, ['192.0.2.0/24'],
+                                          max_content_length=1000,
+                                          drain_limit=100)
+        client = Client(app)
+        with patch.object(handler.Submission, 'from_request') as parse:
+            response = client.put('/', data={'name': 'x'})
+            self.assertEqual(response.status_code, 405)
+            self.assertEqual(response.headers['Allow'], 'GET, POST')
+            response = client.post('/', data={'message': 'x' * 2000})
+            self.assertEqual(response.status_code, 413)
+            self.assertEqual(response.headers['Connection'], 'close')
+            response = client.post('/forms/hosting', data='{}',
+                                   content_type='application/json')
+            self.assertEqual(response.status_code, 415)
+            self.assertNotIn('Connection', response.headers)
+            response = client.post('/', data='x' * 200,
+                                   content_type='text/plain')
+            self.assertEqual(response.headers['Connection'], 'close')
+            response = client.post('/', data={'name': 'x'},
+                                   environ_base={'REMOTE_ADDR': '192.0.2.7'})
+            self.assertEqual(response.status_code, 403)
+            app.controller.clients.hit('198.51.100.1')
+            response = client.post(
+                '/', data={'name': 'x'},
+                environ_base={'REMOTE_ADDR': '198.51.100.1'})
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.headers['Retry-After'], '2')
+            parse.assert_not_called()
+        now[0] += 2
+        # The bucket has refilled, so the form is parsed again
+        response = client.post('/', data={'name': 'x',
+                                          'redirect': 'http://example.com'},
+                               environ_base={'REMOTE_ADDR': '198.51.100.1'})
+        self.assertNotEqual(response.status_code, 429)
+        response = client.get('/server-status',
+                              environ_base={'REMOTE_ADDR': '192.0.2.7'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(client.get('/missing').status_code, 404)
+        metrics = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('formsender_admission_rejections_total{status="415"} 2',
+                      metrics)
+        self.assertIn('formsender_http_errors_total{status="429"} 1',
+                      metrics)
+
+    def test_admission_retry_after(self):
+        """
+        Retry-After covers CEILING's window and the client's bucket, and
+        chunked bodies that aren't read close the connection.
+        """
+        controller = handler.Controller()
+        controller.clients = handler.ClientRateLimiter(rate=0, burst=1)
+        admission = handler.Admission(controller, blocked_networks=[''])
+        self.assertFalse(admission.is_blocked('192.0.2.7'))
+        admission = handler.Admission(controller, ['2001:db8::/32'])
+        self.assertTrue(admission.is_blocked('2001:db8::1'))
+        self.assertFalse(admission.is_blocked('unix-socket'))
+        self.assertFalse(admission.is_blocked(''))
+        self.assertEqual(controller.retry_after(), 0)
+        self.assertEqual(controller.retry_after('192.0.2.7'), 0)
+        controller.clients.hit('192.0.2.7')
+        self.assertEqual(controller.retry_after('192.0.2.7'), float('inf'))
+        req = Request(EnvironBuilder(method='POST', data={'name': 'x'},
+                                     environ_base={'REMOTE_ADDR':
+                                                   '192.0.2.7'}
+                                     ).get_environ())
+        self.assertEqual(admission.check(req, '192.0.2.7').retry_after,
+                         handler.Admission.MAX_RETRY_AFTER)
+        controller.rate = conf.CEILING + 1
+        self.assertEqual(controller.retry_after(), 1)
+        app = handler.create_app(with_static=False)
+        req = Request(EnvironBuilder(method='POST', headers={
+            'Transfer-Encoding': 'chunked'}).get_environ())
+        response = app.turn_away(req, handler.TooManyRequests())
+        self.assertEqual(response.headers['Connection'], 'close')
+
+    def test_asgi_admission(self):
+        """The ASGI app turns requests away before reading their body."""
+        app, tickets = self.make_async_app()
+        app.admission = handler.Admission(app.controller, ['127.0.0.0/8'])
+        with patch.object(app, 'read_body') as read_body:
+            response, = self.asgi_post(app, (self.valid_form(1), None))
+        self.assertEqual(response.status_code, 403)
+        read_body.assert_not_called()
+        self.assertEqual(tickets['created'], 0)
+
+        # Other endpoints still have their body size checked
+        async def post_status():
+            async with httpx.AsyncClient(
+                    transport=httpx.ASGITransport(app),
+                    base_url='http://formsender') as client:
+                return await client.post('/server-status', content=b'x' * 20)
+        with patch.object(conf, 'MAX_CONTENT_LENGTH', 10):
+            self.assertEqual(asyncio.run(post_status()).status_code, 413)
+
+    # RT concurrency limits
+
+    def test_concurrency_limiter_adapts_to_rt_latency(self):
+        """
+        Fast tickets under load raise the limit, slow or failed ones cut it
+        at most once per latency target, within the limit's bounds.
+        """
+        now = [0.0]
+        limiter = handler.ConcurrencyLimiter(
+            4, min_limit=2, max_limit=5, latency_target=2,
+            clock=lambda: now[0])
+        limiter.in_flight = 2
+        limiter.release(0.5, True)
+        self.assertEqual(limiter.limit, 4.25)
+        limiter.release(0.5, True)  # 1 of 4.25 in use: no increase
+        self.assertEqual(limiter.limit, 4.25)
+        limiter.limit = 4.9
+        limiter.in_flight = 5
+        limiter.release(0.5, True)
+        self.assertEqual(limiter.limit, 5)
+        limiter.release(3, True)
+        self.assertEqual(limiter.limit, 4.5)
+        limiter.release(3, True)  # within the latency target of the cut
+        self.assertEqual(limiter.limit, 4.5)
+        now[0] = 2
+        with self.assertRaises(OSError):
+            with limiter.track():
+                self.assertEqual(limiter.in_flight, 3)
+                raise OSError('RT is down')
+        self.assertAlmostEqual(limiter.limit, 4.05)
+        self.assertEqual(limiter.in_flight, 2)
+        limiter.limit = 2.1
+        limiter.decreased = None
+        limiter.release(0, False)
+        self.assertEqual(limiter.limit, 2)
+        self.assertFalse(limiter.is_full())
+        limiter.in_flight = 2
+        self.assertTrue(limiter.is_full())
+        self.assertLess(limiter.latency, 1.4)  # smoothed over the tickets
+        limiter.latency = 1.5
+        self.assertEqual(limiter.retry_after(), 2)
+        self.assertEqual(limiter.stats()['shed'], 1)
+        unlimited = handler.ConcurrencyLimiter(None)
+        with unlimited.track():
+            self.assertFalse(unlimited.is_full())
+        self.assertEqual(unlimited.retry_after(), 1)
+        self.assertEqual(unlimited.stats(), {
+            'in_flight': 0, 'shed': 0,
+            'latency_seconds': unlimited.latency})
+
+    @patch('werkzeug.utils.redirect', redirect)
+    @patch.object(handler.Forms, 'is_valid_recaptcha', return_value=True)
+    @patch.object(handler.Forms, 'deliver')
+    def test_form_posts_are_shed_at_the_rt_limit(self, deliver, recaptcha):
+        """
+        While the RT limit is in use, form posts get a 503 with Retry-After
+        before their body is read; spooled and other posts aren't shed.
+        """
+        tenant = self.make_tenant('lab', hosts=['lab.example.org'])
+        app = handler.Forms(handler.Controller(), Mock(),
+                            tenants=handler.TenantTable([tenant]),
+                            limiter=handler.ConcurrencyLimiter(1))
+        client = Client(app, response_wrapper=werkzeug.wrappers.Response)
+        environ = {'REMOTE_ADDR': '192.0.2.7'}
+        with app.limiter.track():
+            with patch.object(handler.Submission, 'from_request') as parse:
+                response = client.post('/', data=self.valid_form(1),
+                                       environ_base=environ)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+            parse.assert_not_called()
+            self.assertEqual(client.get('/server-status').status_code, 200)
+            # The tenant's RT has a limit of its own
+            response = client.post('/', data=self.valid_form(2),
+                                   base_url='http://lab.example.org',
+                                   environ_base=environ)
+            self.assertEqual(response.status_code, 302)
+            app.spool = Mock()
+            response = client.post('/', data=self.valid_form(3),
+                                   environ_base=environ)
+            self.assertEqual(response.status_code, 302)
+            app.spool = None
+        response = client.post('/', data=self.valid_form(4),
+                               environ_base=environ)
+        self.assertEqual(response.status_code, 302)
+        metrics = app.metrics.render()
+        self.assertIn('formsender_admission_rejections_total{status="503"} 1',
+                      metrics)
+        self.assertIn('formsender_rt_concurrency_shed{pid="%s"} 1'
+                      % os.getpid(), metrics)
+        self.assertIn('formsender_rt_concurrency_limit{tenant="lab",'
+                      'pid="%s"} 50.0' % os.getpid(), metrics)
+
+    def test_concurrency_limit_counts_every_workers_tickets(self):
+        """
+        With an InFlightTable, the limit holds the tickets of every worker
+        on the host, and those of a worker that died stop counting.
+        """
+        path = self.make_state_path() + '.inflight'
+        first = handler.ConcurrencyLimiter(2,
+                                           shared=handler.InFlightTable(path))
+        second = handler.ConcurrencyLimiter(2,
+                                            shared=handler.InFlightTable(path))
+        # Another running process stands in for the other worker
+        other = os.getppid()
+        with first.track():
+            with patch.object(handler.os, 'getpid', return_value=other):
+                self.assertFalse(second.is_full())
+                with second.track():
+                    self.assertTrue(second.is_full())
+                    self.assertEqual(second.stats()['in_flight'], 1)
+            self.assertFalse(first.is_full())
+            dead = subprocess.Popen([sys.executable, '-c', ''])
+            dead.wait()
+            with patch.object(handler.os, 'getpid', return_value=dead.pid):
+                handler.InFlightTable(path).add(5)
+            self.assertEqual(first.shared.total(), 1)
+            self.assertEqual(os.path.getsize(path), 3 * 16)
+            # A new worker claims the dead one's slot
+            worker = subprocess.Popen([sys.executable, '-c',
+                                       'import time; time.sleep(60)'])
+            self.addCleanup(worker.wait)
+            self.addCleanup(worker.kill)
+            with patch.object(handler.os, 'getpid', return_value=worker.pid):
+                self.assertEqual(handler.InFlightTable(path).add(1), 1)
+            self.assertTrue(first.is_full())
+            self.assertEqual(os.path.getsize(path), 3 * 16)
+            # Past max_workers, tickets go uncounted
+            with patch.object(handler.os, 'getpid', return_value=dead.pid):
+                full = handler.InFlightTable(path, max_workers=3)
+                self.assertEqual(full.add(1), 2)
+                self.assertEqual(full.total(), 2)
+        self.assertEqual(first.shared.total(), 1)
+        self.assertEqual(second.stats()['shed'], 1)
+        with patch.object(conf, 'STATE_BACKEND', 'shared', create=True), \
+                patch.object(conf, 'SHARED_STATE_PATH',
+                             self.make_state_path(), create=True):
+            self.assertEqual(handler.create_concurrency_limiter().shared.path,
+                             conf.SHARED_STATE_PATH + '.inflight')
+            self.assertEqual(
+                handler.create_concurrency_limiter('lab').shared.path,
+                conf.SHARED_STATE_PATH + '-lab.inflight')
+        self.assertIsNone(handler.create_concurrency_limiter().shared)
+
+    # Circuit breakers
+
+    def test_circuit_breaker_opens_and_probes(self):
+        """
+        A breaker opens after its failures in a row, refuses calls until the
+        probe interval is up, then closes or reopens on the probe's result.
+        """
+        now = [0.0]
+        metrics = handler.Metrics()
+        breaker = handler.CircuitBreaker('rt', failures=2, probe_interval=10,
+                                         clock=lambda: now[0],
+                                         metrics=metrics)
+        self.assertEqual(breaker.retry_after(), 1)
+        with self.assertRaises(rt.exceptions.NotFoundError):
+            with breaker.call(handler.RT_REFUSALS):
+                raise rt.exceptions.NotFoundError('no such queue')
+        breaker.failed()
+        with self.assertRaises(OSError):
+            with breaker.call(handler.RT_REFUSALS):
+                raise OSError('RT is down')
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertTrue(breaker.is_open())
+        now[0] = 4
+        with self.assertRaises(handler.CircuitOpen) as refused:
+            with breaker.call():
+                pass  # pragma: no cover
+        self.assertEqual(refused.exception.code, 503)
+        self.assertEqual(refused.exception.retry_after, 6)
+        now[0] = 10
+        self.assertFalse(breaker.is_open())
+        self.assertTrue(breaker.allow())  # the probe
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.assertTrue(breaker.is_open())
+        self.assertFalse(breaker.allow())
+        breaker.failed()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertEqual(breaker.stats(), {'open': 1, 'failures': 3})
+        rendered = metrics.render()
+        self.assertIn('formsender_circuit_opens_total{circuit="rt"} 2',
+                      rendered)
+        self.assertIn('formsender_circuit_rejections_total{circuit="rt"} 2',
+                      rendered)
+        self.assertIn('# TYPE formsender_circuit_opens_total counter',
+                      rendered)
+        # A cancelled probe isn't a failure, and the next call probes
+        now[0] = 20
+        with self.assertRaises(asyncio.CancelledError):
+            with breaker.call():
+                raise asyncio.CancelledError()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertEqual(breaker.stats()['failures'], 3)
+        with breaker.call():
+            pass
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertEqual(breaker.stats()['failures'], 0)
+        with self.assertRaises(KeyboardInterrupt):
+            with breaker.call():
+                raise KeyboardInterrupt()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertIn('formsender_circuit_opens_total{circuit="rt"} 2',
+                      metrics.render())
+
+    @patch('werkzeug.utils.redirect', redirect)
+    @patch.object(handler.Forms, 'is_valid_recaptcha', return_value=True)
+    def test_rt_breaker_rejects_or_spools_form_posts(self, recaptcha):
+        """
+        While RT's breaker is open, form posts get a 503 before their body
+        is read, or are spooled with a fallback spool; /server-status and
+        the metrics show the breaker's state.
+        """
+        tracker = Mock()
+        tracker.create_ticket.side_effect = OSError('RT is down')
+        pool = handler.RTClientPool()
+        pool.idle.append(tracker)
+        app = handler.Forms(handler.Controller(), Mock(), rt_clients=pool,
+                            rt_breaker=handler.CircuitBreaker('rt', 1))
+        with self.assertRaises(OSError):
+            app.deliver({'Subject': 'Hello'})
+        client = Client(app, response_wrapper=werkzeug.wrappers.Response)
+        environ = {'REMOTE_ADDR': '192.0.2.8'}
+        with patch.object(handler.Submission, 'from_request') as parse:
+            response = client.post('/', data=self.valid_form(1),
+                                   environ_base=environ)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '30')
+        parse.assert_not_called()
+        status = client.get('/server-status')
+        self.assertEqual(status.status_code, 200)
+        self.assertEqual(status.get_data(as_text=True).splitlines(),
+                         ['OK', 'rt: open', 'recaptcha: closed'])
+        self.assertIn('formsender_circuit_open{circuit="rt",pid="%s"} 1'
+                      % os.getpid(), app.metrics.render())
+        app.fallback_spool = self.make_spool()
+        response = client.post('/', data=self.valid_form(2),
+                               environ_base=environ)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(app.fallback_spool.counts(), {'pending': 1})
+        self.assertEqual(tracker.create_ticket.call_count, 1)
+        # A breaker that opens after the post was admitted still answers 503
+        app.fallback_spool = None
+        with patch.object(app.admission, 'check', return_value=None):
+            response = client.post('/', data=self.valid_form(3),
+                                   environ_base=environ)
+        self.assertEqual(response.status_code, 503)
+
+    def test_create_app_spools_while_rt_breaker_is_open(self):
+        """RT_BREAKER_FALLBACK = 'spool' gives the app a fallback spool."""
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        with patch.object(conf, 'RT_BREAKER_FALLBACK', 'spool', create=True), \
+                patch.object(conf, 'SPOOL_PATH',
+                             os.path.join(spool_dir, 'spool.sqlite3'),
+                             create=True), \
+                patch('request_handler.SpoolWorker') as mock_worker:
+            app = handler.create_app(with_static=False)
+        self.assertIsNone(app.spool)
+        self.assertIsInstance(app.fallback_spool, handler.TicketSpool)
+        mock_worker.assert_called_once_with(app.fallback_spool, app.logger,
+                                            deliver=app.deliver)
+        # The breakers the app builds count their trips in its metrics
+        self.assertIs(app.rt_breaker.metrics, app.metrics)
+        self.assertIs(app.recaptcha.breaker.metrics, app.metrics)
+
+    def test_recaptcha_breaker_falls_back_to_fail_policy(self):
+        """
+        Once reCAPTCHA's breaker opens, verify returns the fail-open/closed
+        verdict without calling the endpoint until a probe is due.
+        """
+        calls = []
+
+        def siteverify(request):
+            calls.append(request)
+            return httpx.Response(503)
+
+        now = [0.0]
+        metrics = handler.Metrics()
+        breaker = handler.CircuitBreaker('recaptcha', 2, probe_interval=5,
+                                         clock=lambda: now[0],
+                                         metrics=metrics)
+        verifier = handler.RecaptchaVerifier(
+            'secret', fail_open=True, logger=Mock(), breaker=breaker,
+            transport=httpx.MockTransport(siteverify))
+        for _ in range(4):
+            self.assertTrue(verifier.verify('token'))
+        self.assertEqual(len(calls), 2)
+        self.assertIn('formsender_circuit_rejections_total'
+                      '{circuit="recaptcha"} 2', metrics.render())
+        now[0] = 5
+        verifier.session = httpx.Client(transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, json={'success': True})))
+        self.assertTrue(verifier.verify('token'))
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_recaptcha_probe_is_released_however_it_ends(self):
+        """
+        A half-open probe that is cancelled (the client went away) lets the
+        next call probe again, and one answered with something other than a
+        JSON object fails and reopens the breaker.
+        """
+        answers = []
+
+        async def siteverify(request):
+            if not answers:
+                await asyncio.sleep(60)
+            return httpx.Response(200, json=answers.pop())
+
+        now = [0.0]
+        breaker = handler.CircuitBreaker('recaptcha', 1, probe_interval=5,
+                                         clock=lambda: now[0])
+        verifier = handler.AsyncRecaptchaVerifier(
+            'secret', logger=Mock(), breaker=breaker,
+            transport=httpx.MockTransport(siteverify))
+        breaker.failed()
+        now[0] = 5
+
+        async def cancel_probe():
+            probe = asyncio.ensure_future(verifier.verify('token'))
+            await asyncio.sleep(0.01)
+            self.assertEqual(breaker.state, breaker.HALF_OPEN)
+            probe.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await probe
+
+        asyncio.run(cancel_probe())
+        self.assertEqual(breaker.state, breaker.OPEN)
+        answers.extend([{'success': True}, ['not', 'an', 'object']])
+        self.assertFalse(asyncio.run(verifier.verify('token')))
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertEqual(breaker.opened, 5)
+        now[0] = 10
+        self.assertTrue(asyncio.run(verifier.verify('token')))
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_async_breakers(self):
+        """
+        The ASGI app spools tickets while RT's breaker is open, and its
+        reCAPTCHA verifier skips the endpoint while its breaker is open.
+        """
+        spool = self.make_spool()
+        app, tickets = self.make_async_app(fallback_spool=spool)
+        app.recaptcha.breaker.metrics = app.metrics
+        for breaker in app.breakers():
+            breaker.failures = 1
+            breaker.failed()
+        app.recaptcha.fail_open = True
+        with patch('werkzeug.utils.redirect', redirect):
+            spooled, = self.asgi_post(app, (self.valid_form(1), None))
+        self.assertEqual(spooled.headers['location'], 'http://www.example.com')
+        self.assertEqual(spool.counts(), {'pending': 1})
+        self.assertEqual(tickets['created'], 0)
+        self.assertIn('formsender_circuit_rejections_total'
+                      '{circuit="recaptcha"} 1', app.metrics.render())
+        app.fallback_spool = None
+        with patch('werkzeug.utils.redirect', redirect), \
+                patch.object(app.admission, 'check', return_value=None):
+            rejected, = self.asgi_post(app, (self.valid_form(2), None))
+        self.assertEqual(rejected.status_code, 503)
+
+    # Ticket retries
+
+    def test_retry_policy_backs_off_with_full_jitter(self):
+        """
+        Retries wait a random time up to an exponentially growing, capped
+        delay, and stop after the attempts or the time budget are used up.
+        """
+        now = [0.0]
+        bounds = []
+
+        def jitter(low, high):
+            bounds.append((low, high))
+            return high
+
+        policy = handler.RetryPolicy(5, base_delay=1, max_delay=3, budget=20,
+                                     clock=lambda: now[0], jitter=jitter)
+        self.assertEqual(list(policy.delays(0)), [1, 2, 3, 3])
+        self.assertEqual(bounds, [(0, 1), (0, 2), (0, 3), (0, 3)])
+        now[0] = 18
+        self.assertEqual(list(policy.delays(0)), [1, 2])
+        self.assertEqual(list(handler.RetryPolicy(1).delays(0)), [])
+        for error, kind in (
+                (rt.exceptions.ConnectionError('down', cause=OSError()),
+                 'unsent'),
+                (httpx2.ConnectTimeout('timed out'), 'unsent'),
+                (rt.exceptions.UnexpectedResponseError('slow down', 429),
+                 'unsent'),
+                (rt.exceptions.UnexpectedResponseError('bad gateway', 502),
+                 'unknown'),
+                (httpx2.ReadTimeout('timed out'), 'unknown'),
+                (rt.exceptions.UnexpectedResponseError('moved', 302), None),
+                (rt.exceptions.NotFoundError('no such queue'), None),
+                (ValueError('bug'), None)):
+            self.assertEqual(handler.retry_kind(error), kind)
+
+    def make_retrying_app(self, app_class=None, **kwargs):
+        """
+        Returns a Forms (or app_class) app that retries at once, and the Mock
+        tracker its RT client pool holds
+        """
+        tracker = MagicMock(create_ticket=AsyncMock() if app_class else Mock())
+        pool_class = handler.AsyncRTClientPool if app_class else \
+            handler.RTClientPool
+        pool = pool_class()
+        pool.idle.append(tracker)
+        app = (app_class or handler.Forms)(
+            handler.Controller(), Mock(),
+            retry_policy=handler.RetryPolicy(jitter=lambda low, high: 0),
+            **{'async_rt_clients' if app_class else 'rt_clients': pool},
+            **kwargs)
+        return app, tracker
+
+    def test_deliver_retries_without_repeating_tickets(self):
+        """
+        Creates that can't have reached RT are retried; those that may have
+        are only retried when RT has no ticket under their key, and tickets
+        already created aren't created again.
+        """
+        app, tracker = self.make_retrying_app(ledger=handler.TicketLedger(1))
+        tracker.create_ticket.side_effect = [httpx2.ConnectTimeout('slow'), 7]
+        self.assertEqual(app.deliver({'subject': 'a',
+                                      'idempotency_key': 'k1'}), 7)
+        tracker.create_ticket.assert_called_with(subject='a')
+        self.assertEqual(app.deliver({'subject': 'a',
+                                      'idempotency_key': 'k1'}), 7)
+        self.assertEqual(tracker.create_ticket.call_count, 2)
+        bad_gateway = rt.exceptions.UnexpectedResponseError('bad gateway', 502)
+        tracker.create_ticket.side_effect = [bad_gateway, 8]
+        with self.assertRaises(rt.exceptions.UnexpectedResponseError):
+            app.deliver({'subject': 'b', 'idempotency_key': 'k2'})
+        with patch.object(conf, 'RT_IDEMPOTENCY_FIELD', 'Key', create=True):
+            tracker.create_ticket.side_effect = [bad_gateway]
+            tracker.search.return_value = iter([{'id': '9'}])
+            self.assertEqual(app.deliver({'subject': 'c',
+                                          'idempotency_key': 'k3'}), 9)
+            tracker.search.assert_called_once_with(
+                raw_query="'CF.{Key}' = 'k3'")
+            tracker.create_ticket.side_effect = [bad_gateway, 10]
+            tracker.search.return_value = iter([])
+            self.assertEqual(app.deliver({'subject': 'd',
+                                          'idempotency_key': 'k4'}), 10)
+            tracker.create_ticket.side_effect = [bad_gateway] * 3
+            tracker.search.return_value = iter([])
+            with self.assertRaises(rt.exceptions.UnexpectedResponseError):
+                app.deliver({'subject': 'e', 'idempotency_key': 'k5'})
+        self.assertEqual(list(app.ledger.entries), ['k4'])
+        metrics = app.metrics.render()
+        self.assertIn('formsender_rt_retries_total{kind="unsent"} 1',
+                      metrics)
+        self.assertIn('formsender_rt_retries_total{kind="unknown"} 4',
+                      metrics)
+        self.assertIn('formsender_rt_idempotent_hits_total{source="ledger"} 1',
+                      metrics)
+        self.assertIn('formsender_rt_idempotent_hits_total{source="rt"} 1',
+                      metrics)
+
+    def test_deliver_retries_real_rt_connection_errors(self):
+        """
+        rt's ConnectionError from an RT refusing connections is retried as
+        never having reached RT.
+        """
+        app = handler.Forms(
+            handler.Controller(), Mock(),
+            retry_policy=handler.RetryPolicy(jitter=lambda low, high: 0),
+            rt_clients=handler.RTClientPool(url=self.dead_rt_url(),
+                                            token='token'))
+        with patch.object(rt.rest2, 'Rt', RT_CLIENT):
+            with self.assertRaises(ConnectionError) as raised:
+                app.deliver({'queue': 'General', 'subject': 'a',
+                             'idempotency_key': 'k1'})
+        self.assertIsInstance(raised.exception.__cause__,
+                              httpx2.ConnectError)
+        self.assertIn('formsender_rt_retries_total{kind="unsent"} 2',
+                      app.metrics.render())
+
+    @patch('werkzeug.utils.redirect', redirect)
+    @patch.object(handler.Forms, 'is_valid_recaptcha', return_value=True)
+    @patch.object(handler.Forms, 'deliver')
+    def test_tickets_carry_an_idempotency_key(self, deliver, recaptcha):
+        """
+        Each submission's ticket gets its own key, also set in
+        RT_IDEMPOTENCY_FIELD when there is one; deliver_ticket leaves it out.
+        """
+        app = handler.Forms(handler.Controller(), Mock())
+        client = Client(app, response_wrapper=werkzeug.wrappers.Response)
+        client.post('/', data=self.valid_form(1))
+        with patch.object(conf, 'RT_IDEMPOTENCY_FIELD', 'Key', create=True):
+            client.post('/', data=self.valid_form(2))
+        first, second = [call.args[0] for call in deliver.call_args_list]
+        self.assertNotIn('CustomFields', first)
+        self.assertNotEqual(first['idempotency_key'],
+                            second['idempotency_key'])
+        self.assertEqual(second['CustomFields'],
+                         {'Key': second['idempotency_key']})
+        tracker = Mock()
+        handler.deliver_ticket(first, tracker)
+        self.assertNotIn('idempotency_key',
+                         tracker.create_ticket.call_args.kwargs)
+
+    def test_async_deliver_retries_without_repeating_tickets(self):
+        """The ASGI app retries and looks tickets up by key like Forms."""
+        app, tracker = self.make_retrying_app(handler.AsyncForms)
+        bad_gateway = rt.exceptions.UnexpectedResponseError('bad gateway', 502)
+        found = []
+
+        async def search(raw_query):
+            for ticket in found:
+                yield ticket
+
+        tracker.search = search
+        tracker.create_ticket.side_effect = [bad_gateway, 8]
+        with patch.object(conf, 'RT_IDEMPOTENCY_FIELD', 'Key', create=True):
+            self.assertEqual(asyncio.run(app.deliver_async(
+                {'subject': 'a', 'idempotency_key': 'k1'})), 8)
+            self.assertEqual(asyncio.run(app.deliver_async(
+                {'subject': 'a', 'idempotency_key': 'k1'})), 8)
+            found.append({'id': '9'})
+            tracker.create_ticket.side_effect = [bad_gateway]
+            self.assertEqual(asyncio.run(app.deliver_async(
+                {'subject': 'b', 'idempotency_key': 'k2'})), 9)
+        self.assertEqual(tracker.create_ticket.call_count, 3)
+
+    # Parsing budgets
+
+    def budgeted_request(self, budget, data=None, **kwargs):
+        """Returns a FormRequest posting data, parsed within budget"""
+        request = handler.FormRequest(EnvironBuilder(
+            method='POST', data=data, **kwargs).get_environ())
+        request.upload_budget = handler.UploadBudget(limit=1000)
+        request.parse_budget = budget
+        return request
+
+    def test_parse_budget_stops_parsing_at_first_limit(self):
+        """
+        A form over any limit of its ParseBudget stops being parsed, keeps
+        the fields read before it, and closes the files it opened.
+        """
+        def form():
+            return {'redirect': 'http://www.example.com',
+                    'message': 'x' * 40,
+                    'first': (BytesIO(b'file data'), 'a.txt'),
+                    'second': (BytesIO(b'file data'), 'b.txt')}
+        for limits, limit, fields in (
+                ({'max_parts': 3}, 'max_parts', ['redirect', 'message']),
+                ({'max_field_size': 30}, 'max_field_size', ['redirect']),
+                ({'max_files': 1}, 'max_files', ['redirect', 'message']),
+                ({'max_file_size': 4}, 'max_file_size',
+                 ['redirect', 'message'])):
+            request = self.budgeted_request(
+                handler.ParseBudget().replace(**limits), form())
+            with self.assertRaises(handler.FormTooLarge) as raised:
+                request.form
+            self.assertEqual(raised.exception.limit, limit)
+            self.assertEqual(list(request.form), fields)
+            self.assertEqual(len(request.files), 0)
+            self.assertEqual(request.upload_budget.reserved, 0)
+        # Within the budget, forms parse as they would without one
+        request = self.budgeted_request(handler.ParseBudget(
+            max_parts=4, max_field_size=40, max_files=2, max_file_size=9),
+            form())
+        self.assertEqual(request.form['message'], 'x' * 40)
+        self.assertEqual(request.files['second'].read(), b'file data')
+        # Urlencoded forms are held to the parts and field size limits
+        request = self.budgeted_request(handler.ParseBudget(max_parts=2),
+                                        'a=1&b=2&c=3')
+        request.environ['CONTENT_TYPE'] = ('application/'
+                                           'x-www-form-urlencoded')
+        with self.assertRaises(handler.FormTooLarge):
+            request.form
+        self.assertEqual(len(request.form), 0)
+        request = self.budgeted_request(
+            handler.ParseBudget(max_field_size=1), 'a=1&b=22&c=3',
+            content_type='application/x-www-form-urlencoded')
+        with self.assertRaises(handler.FormTooLarge):
+            request.form
+        self.assertEqual(list(request.form), ['a'])
+        request = self.budgeted_request(
+            handler.ParseBudget(max_field_size=1), 'a=1&b=2',
+            content_type='application/x-www-form-urlencoded')
+        self.assertEqual(request.form['b'], '2')
+        request = self.budgeted_request(
+            handler.ParseBudget(max_field_size=None), 'a=12',
+            content_type='application/x-www-form-urlencoded')
+        self.assertEqual(request.form['a'], '12')
+        # Read a few bytes at a time, an escape split across reads isn't
+        # measured as sent
+        stream = handler.BudgetedStream(
+            BytesIO(b'flag&a=%41%41&b=xxx'),
+            handler.ParseBudget(max_field_size=2),
+            'application/x-www-form-urlencoded', {}, MultiDict)
+        with self.assertRaises(handler.FormTooLarge) as raised:
+            while stream.read(3):
+                pass
+        self.assertEqual(raised.exception.limit, 'max_field_size')
+        self.assertEqual(list(raised.exception.form.items(multi=True)),
+                         [('flag', ''), ('a', 'AA')])
+        # Files werkzeug opened in earlier reads are closed
+        request = self.budgeted_request(
+            handler.ParseBudget(max_files=1),
+            {'first': (BytesIO(b'x' * 100000), 'a.txt'),
+             'second': (BytesIO(b'file data'), 'b.txt')})
+        with self.assertRaises(handler.FormTooLarge) as raised:
+            request.form
+        self.assertEqual(raised.exception.limit, 'max_files')
+        self.assertEqual(request.upload_budget.reserved, 0)
+        # Other bodies are left alone
+        request = self.budgeted_request(handler.ParseBudget(max_parts=0),
+                                        'a=1&b=2', content_type='text/plain')
+        self.assertEqual(len(request.form), 0)
+        self.assertEqual(request.get_data(), b'a=1&b=2')
+        # Part headers are held to the field size too
+        body = (b'--b\r\nContent-Disposition: form-data; name="a"\r\n'
+                b'X-Padding: ' + b'x' * 100000)
+        request = self.budgeted_request(
+            handler.ParseBudget(max_field_size=10), input_stream=BytesIO(body),
+            content_type='multipart/form-data; boundary=b',
+            content_length=len(body))
+        with self.assertRaises(handler.FormTooLarge) as raised:
+            request.form
+        self.assertEqual(raised.exception.limit, 'max_field_size')
+        request = self.budgeted_request(
+            handler.ParseBudget(), data=b'--b--\r\n',
+            content_type='multipart/form-data')
+        self.assertEqual(len(request.form), 0)
+
+    def test_parse_budget_settings(self):
+        """Limits are whole numbers or None, set globally or per form."""
+        for limits in ({'max_parts': -1}, {'max_files': 1.5},
+                       {'max_file_size': True}):
+            with self.assertRaises(ValueError):
+                handler.ParseBudget(**limits)
+        budget = handler.ParseBudget(max_file_size=None)
+        with self.assertRaises(AttributeError):
+            budget.max_files = 1
+        self.assertEqual(budget.replace(max_files=1).max_files, 1)
+        self.assertEqual(budget.max_files, 10)
+        for content in ('{"limits": {"max_forms": 1}}',
+                        '{"limits": {"max_files": -1}}'):
+            forms_dir = self.make_forms_dir(**{'bad.json': content})
+            with self.assertRaises(ValueError):
+                handler.FormRegistry.load(forms_dir)
+        with patch.object(conf, 'MAX_FILES', 3, create=True):
+            app = handler.create_app(with_static=False)
+        self.assertEqual(app.parse_budget.max_files, 3)
+
+    def test_form_too_large_redirects_with_error_7(self):
+        """
+        A form over its budget is redirected with error 7 once its redirect
+        field is read, and gets a 413 if it isn't; a form definition's
+        limits replace the app's.
+        """
+        app = handler.create_app(with_static=False)
+        app.forms = handler.FormRegistry([handler.FormDefinition(
+            'tiny', send_to='Support', limits={'max_files': 0})])
+        client = Client(app)
+
+        def form():
+            return dict(self.valid_form(1),
+                        attachment=(BytesIO(b'file data'), 'doc.txt'))
+        with patch('werkzeug.utils.redirect', redirect), \
+                patch.object(handler.Forms, 'is_valid_recaptcha',
+                             return_value=True), \
+                patch.object(handler.Forms, 'deliver') as deliver:
+            response = client.post('/forms/tiny', data=form())
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(response.headers['Location'],
+                             'http://www.example.com?error=7&'
+                             'message=Form+Too+Large')
+            deliver.assert_not_called()
+            response = client.post('/', data=form())
+            self.assertEqual(response.headers['Location'],
+                             'http://www.example.com')
+            deliver.assert_called_once()
+        app.parse_budget = handler.ParseBudget(max_field_size=3)
+        response = client.post('/', data={'message': 'too long',
+                                          'redirect': 'http://example.com'})
+        self.assertEqual(response.status_code, 413)
+        metrics = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('formsender_rejections_total{error="7"} 2', metrics)
+
+    def test_asgi_form_too_large(self):
+        """The ASGI app holds forms to the same budget."""
+        app, tickets = self.make_async_app()
+        app.parse_budget = handler.ParseBudget(max_files=1)
+        with patch('werkzeug.utils.redirect', redirect):
+            response, = self.asgi_post(app, (self.valid_form(1), [
+                ('attachment', ('a.txt', b'file data')),
+                ('attachment', ('b.txt', b'file data'))]))
+        self.assertEqual(response.headers['location'],
+                         'http://www.example.com?error=7&'
+                         'message=Form+Too+Large')
+        self.assertEqual(tickets['created'], 0)
+
+    # Tenants
+
+    def make_tenant(self, name, **kwargs):
+        """Returns a Tenant whose RT clients are a pool of one Mock"""
+        tracker = Mock()
+        tracker.create_ticket.return_value = 7
+        pool = handler.RTClientPool()
+        pool.idle.append(tracker)
+        async_tracker = MagicMock(create_ticket=AsyncMock(return_value=8))
+        async_pool = handler.AsyncRTClientPool()
+        async_pool.idle.append(async_tracker)
+        return handler.Tenant(name, 'https://%s.example.org/REST/2.0/' % name,
+                              'token', rt_clients=pool,
+                              async_rt_clients=async_pool, **kwargs)
+
+    def test_tenant_table_routes_forms(self):
+        """
+        Forms go to the tenant of their form ID, else of their path prefix,
+        else of their host; tenants can't claim the same keys.
+        """
+        tenants = handler.TenantTable.from_settings({
+            'docs': {'url': 'https://docs.example.org/REST/2.0/',
+                     'token': 'token', 'prefixes': ['/docs/'],
+                     'forms': ['manual']},
+            'lab': {'url': 'https://lab.example.org/REST/2.0/',
+                    'token': 'token', 'queue': 'Lab',
+                    'hosts': ['Forms.Lab.example.org'],
+                    'prefixes': ['/docs/lab']}})
+        self.assertEqual(len(tenants), 2)
+        self.assertEqual(tenants.get('docs').rt_clients.url,
+                         'https://docs.example.org/REST/2.0/')
+
+        def route(path, host='formsender.example.org', form_id=None):
+            environ = EnvironBuilder(path=path, base_url='http://' + host
+                                     ).get_environ()
+            tenants.mount(environ)
+            tenant = tenants.route(Request(environ), form_id)
+            return (tenant and tenant.name, environ['PATH_INFO'])
+        self.assertEqual(route('/'), (None, '/'))
+        self.assertEqual(route('/docs'), ('docs', '/'))
+        self.assertEqual(route('/docs/forms/x'), ('docs', '/forms/x'))
+        self.assertEqual(route('/docs/lab/'), ('lab', '/'))
+        self.assertEqual(route('/docsearch'), (None, '/docsearch'))
+        self.assertEqual(route('/', 'forms.lab.example.org:8080'),
+                         ('lab', '/'))
+        self.assertEqual(route('/docs/lab/forms/manual', form_id='manual'),
+                         ('docs', '/forms/manual'))
+        with self.assertRaises(ValueError):
+            tenants.get('missing')
+        for settings in ({'a': {'url': 'u', 'token': 't', 'hosts': ['h']},
+                          'b': {'url': 'u', 'token': 't', 'hosts': ['h']}},
+                         {'a': {'url': 'u', 'token': 't',
+                                'prefixes': ['docs']}},
+                         {'a': {'url': 'u', 'token': None}},
+                         {'a': {'url': 'u', 'token': 't', 'queue': 5}},
+                         {'a': {'url': 'u', 'token': 't', 'pool': 2}}):
+            with self.assertRaises(ValueError):
+                handler.TenantTable.from_settings(settings)
+
+    @patch.object(conf, 'CEILING', 1000)
+    def test_tenants_have_own_rt_rate_limits_and_duplicates(self):
+        """
+        A tenant's forms go to its RT and queue, and its rate limits and
+        duplicates are kept apart from the app's.
+        """
+        app = handler.create_app(with_static=False)
+        tenant = self.make_tenant('lab', queue='Lab',
+                                  hosts=['forms.lab.example.org'])
+        app.tenants = handler.TenantTable([tenant])
+        tenant.controller.clients = handler.ClientRateLimiter(rate=0,
+                                                              burst=2)
+        client = Client(app)
+
+        def post(host, number=1):
+            return client.post('/', data=self.valid_form(number),
+                               base_url='http://' + host,
+                               environ_base={'REMOTE_ADDR': '192.0.2.9'})
+        with patch('werkzeug.utils.redirect', redirect), \
+                patch.object(handler.Forms, 'is_valid_recaptcha',
+                             return_value=True), \
+                patch.object(app, 'rt_clients') as rt_clients:
+            for host in ('localhost', 'forms.lab.example.org'):
+                self.assertEqual(post(host).headers['Location'],
+                                 'http://www.example.com')
+            self.assertEqual(post('forms.lab.example.org').headers[
+                'Location'], 'http://www.example.com?error=5&'
+                'message=Duplicate+Request')
+            self.assertEqual(post('forms.lab.example.org', 2).status_code,
+                             429)
+            self.assertEqual(post('localhost', 2).status_code, 302)
+        tracker = rt_clients.client.return_value.__enter__.return_value
+        self.assertEqual(tracker.create_ticket.call_count, 2)
+        tenant_tracker = tenant.rt_clients.idle[0]
+        tenant_tracker.create_ticket.assert_called_once()
+        self.assertEqual(tenant_tracker.create_ticket.call_args[1]['queue'],
+                         'Lab')
+        self.assertNotIn('tenant', tenant_tracker.create_ticket.call_args[1])
+        metrics = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('formsender_table_entries{table="duplicates:lab",'
+                      'pid="%d"} 1' % os.getpid(), metrics)
+
+    def test_spooled_tickets_keep_their_tenant(self):
+        """
+        A tenant's ticket is spooled with the tenant's name and delivered
+        to its RT; the ASGI app delivers to the tenant's async clients.
+        """
+        tenant = self.make_tenant('lab')
+        app = handler.Forms(handler.Controller(), Mock(),
+                            tenants=handler.TenantTable([tenant]))
+        spool = self.make_spool()
+        spool.enqueue({'queue': 'General', 'tenant': 'lab'})
+        handler.SpoolWorker(spool, Mock(), deliver=app.deliver).deliver_one()
+        tenant.rt_clients.idle[0].create_ticket.assert_called_once_with(
+            queue='General')
+        spool.enqueue({'queue': 'General', 'tenant': 'gone'})
+        handler.SpoolWorker(spool, Mock(), deliver=app.deliver).deliver_one()
+        self.assertEqual(spool.status(2)[3], 'No tenant gone')
+        app, _ = self.make_async_app(tenants=handler.TenantTable([tenant]))
+        self.assertEqual(asyncio.run(app.deliver_async(
+            {'queue': 'General', 'tenant': 'lab'})), 8)
+        self.assertEqual(len(app.all_async_rt_clients()), 2)
+
+    @patch.object(conf, 'STATE_BACKEND', 'shared', create=True)
+    def test_tenants_share_state_per_tenant(self):
+        """With the shared backend each tenant has its own state file."""
+        path = self.make_state_path()
+        with patch.object(conf, 'SHARED_STATE_PATH', path, create=True):
+            controller = handler.create_controller('lab')
+        self.assertEqual(controller.state.path, path + '-lab.100000')
+
+    # Settings reloads
+
+    def make_settings(self, version=2, **values):
+        """
+        Returns Settings like conf.py's with values replaced, and puts the
+        module's conf back after the test
+        """
+        self.addCleanup(setattr, handler, 'conf', conf)
+        settings = handler.Settings.from_module(conf)
+        return handler.Settings(dict(settings.values, **values), version)
+
+    def write_settings(self, path, extra=''):
+        """Writes conf.py.dist with extra appended to path"""
+        with open(os.path.join(os.path.dirname(__file__),
+                               'conf.py.dist')) as dist:
+            source = dist.read()
+        with open(path, 'w') as settings_file:
+            settings_file.write(source + extra)
+
+    def test_settings_load_and_validate(self):
+        """
+        Settings are a file's upper-case names, read-only, and are checked
+        for missing and out-of-range values.
+        """
+        path = os.path.join(tempfile.mkdtemp(), 'conf.py')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        self.write_settings(path, 'CEILING = 3\n')
+        settings = handler.Settings.load(path, 4)
+        self.assertEqual((settings.version, settings.path), (4, path))
+        self.assertEqual(settings.CEILING, 3)
+        self.assertEqual(getattr(settings, 'UNSET', 'default'), 'default')
+        self.assertNotIn('os', settings.values)
+        with self.assertRaises(AttributeError):
+            settings.CEILING = 5
+        settings.validate()
+        self.assertEqual(settings.changed(conf), {'CEILING'})
+        for values, message in (
+                ({'TOKEN': None}, 'TOKEN is not set'),
+                ({'CEILING': -1}, 'CEILING must be a number'),
+                ({'RT_TIMEOUT': True}, 'RT_TIMEOUT must be a number'),
+                ({'NEAR_DUPLICATE_DISTANCE': 64}, 'from 0 to 63'),
+                ({'LOG_LEVEL': 'LOUD'}, 'logging level')):
+            values = dict(settings.values, **values)
+            if values['TOKEN'] is None:
+                del values['TOKEN']
+            with self.assertRaisesRegex(ValueError, message):
+                handler.Settings(values).validate()
+
+    def test_apply_settings_keeps_unchanged_parts_warm(self):
+        """
+        Applying settings rebuilds only the parts whose settings changed and
+        tunes the rate and duplicate tables without emptying them.
+        """
+        tenant = self.make_tenant('lab')
+        app = handler.Forms(handler.Controller(), Mock(),
+                            tenants=handler.TenantTable([tenant]))
+        app.controller.increment_rate('10.0.0.1')
+        app.controller.is_duplicate({'name': 'Valid Guy'})
+        kept = [app.recaptcha, app.layouts, app.emails, app.uploads,
+                app.parse_budget, app.admission, app.forms,
+                app.controller.near_duplicates]
+        rt_clients = app.rt_clients
+        settings = self.make_settings(
+            RT_TOKEN='rotated', CLIENT_BURST=2, DUPLICATE_CHECK_TIME=60,
+            VALIDATORS_DISABLED=('name',), LOG_LEVEL='INFO',
+            TENANTS={'lab': {'url': 'https://lab.example.org/REST/2.0/',
+                             'token': 'token'}})
+        self.assertEqual(app.apply_settings(settings), {
+            'RT_TOKEN', 'CLIENT_BURST', 'DUPLICATE_CHECK_TIME',
+            'VALIDATORS_DISABLED', 'LOG_LEVEL', 'TENANTS'})
+        self.assertIs(handler.conf, settings)
+        self.assertEqual(app.settings_version, 2)
+        self.assertEqual(kept, [app.recaptcha, app.layouts, app.emails,
+                                app.uploads, app.parse_budget, app.admission,
+                                app.forms, app.controller.near_duplicates])
+        self.assertIsNot(app.rt_clients, rt_clients)
+        self.assertEqual(
+            app.rt_clients.create().session.headers['Authorization'],
+            'token rotated')
+        self.assertNotIn('name', [validator.name
+                                  for validator in app.validators])
+        self.assertIs(app.tenants.get('lab').controller, tenant.controller)
+        self.assertIs(app.tenants.get('lab').rt_breaker.metrics, app.metrics)
+        self.assertIsNot(app.tenants.get('lab').rt_clients,
+                         tenant.rt_clients)
+        self.assertEqual(app.controller.clients.burst, 2)
+        self.assertEqual(app.controller.clients.stats()['entries'], 1)
+        self.assertEqual(app.controller.duplicates.ttl, 60)
+        self.assertTrue(app.controller.is_duplicate({'name': 'Valid Guy'}))
+        app.logger.setLevel.assert_called_once_with('INFO')
+        self.assertIn(('formsender_settings_version', {}, 2),
+                      app.collect_metrics())
+        # The near-duplicate index starts over with its new distance
+        app.apply_settings(self.make_settings(3, NEAR_DUPLICATE_DISTANCE=2))
+        self.assertEqual(app.controller.near_duplicates.distance, 2)
+        app.logger.warning.assert_not_called()
+        app.apply_settings(self.make_settings(4, METRICS_DIR='/tmp'))
+        app.logger.warning.assert_called_once_with(
+            'formsender: %s changes when the worker restarts', 'METRICS_DIR')
+
+    def test_apply_settings_turns_mx_on_and_off(self):
+        """The ASGI app's mx check and resolver come and go together."""
+        app, _ = self.make_async_app()
+        self.assertIsNone(app.mx)
+        async_clients = app.async_rt_clients
+        app.apply_settings(self.make_settings(CHECK_MX=True,
+                                              MX_NAMESERVER='127.0.0.1'))
+        self.assertIsInstance(app.mx, handler.AsyncMXResolver)
+        self.assertIn('mx', [validator.name for validator in app.validators])
+        self.assertIs(app.async_rt_clients, async_clients)
+        app.apply_settings(self.make_settings(3, ASGI_RT_POOL_SIZE=5))
+        self.assertEqual(app.async_rt_clients.size, 5)
+        app.apply_settings(self.make_settings(4))
+        self.assertIsNone(app.mx)
+        self.assertNotIn('mx', [validator.name
+                                for validator in app.validators])
+
+    def test_invalid_settings_are_not_applied(self):
+        """
+        Settings that don't validate, or that a part can't be built from,
+        leave the current settings and app in place.
+        """
+        app = handler.Forms(handler.Controller(), Mock())
+        validators = app.validators
+        with self.assertRaisesRegex(ValueError, 'CEILING'):
+            app.apply_settings(self.make_settings(CEILING='ten'))
+        with self.assertRaisesRegex(ValueError, 'unknown validators: nope'):
+            app.apply_settings(self.make_settings(VALIDATOR_ORDER=('nope',)))
+        self.assertIs(handler.conf, conf)
+        self.assertIs(app.validators, validators)
+        self.assertEqual(app.settings_version, 1)
+        path = os.path.join(tempfile.mkdtemp(), 'conf.py')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        self.write_settings(path, 'CEILING = (\n')
+        self.assertFalse(app.reload_settings(path))
+        self.assertIs(handler.conf, conf)
+        self.assertIn('formsender_settings_reloads_total{result="rejected"} 1',
+                      app.metrics.render())
+
+    def test_settings_reloader_reloads_changed_file(self):
+        """
+        The reloader reloads the settings file when it changes or when it is
+        asked to, e.g. by SIGHUP.
+        """
+        path = os.path.join(tempfile.mkdtemp(), 'conf.py')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        self.addCleanup(setattr, handler, 'conf', conf)
+        self.write_settings(path)
+        app = handler.Forms(handler.Controller(), Mock())
+        reloader = handler.SettingsReloader(app, path, interval=0.01)
+        self.assertFalse(reloader.check())
+        self.write_settings(path, 'CEILING = 3\n')
+        self.assertTrue(reloader.check())
+        self.assertEqual((handler.conf.CEILING, app.settings_version), (3, 2))
+        self.assertFalse(reloader.check())
+        previous = signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        self.addCleanup(signal.signal, signal.SIGHUP, previous)
+        reloader.listen()
+        os.kill(os.getpid(), signal.SIGHUP)
+        self.assertTrue(reloader.check())
+        self.assertEqual(app.settings_version, 3)
+        self.assertIn('formsender_settings_reloads_total{result="applied"} 2',
+                      app.metrics.render())
+        self.write_settings(path, 'CEILING = 4\n')
+        reloader.start()
+        deadline = time.monotonic() + 5
+        while app.settings_version < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        reloader.stop()
+        reloader.join(1)
+        self.assertFalse(reloader.is_alive())
+        self.assertEqual(handler.conf.CEILING, 4)
+        os.remove(path)
+        self.assertIsNone(reloader.read_stamp())
+
+    # Benchmark
+
+    def test_bench_smoke(self):
+        """bench.py runs a tiny scenario end to end without errors."""
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        output = os.path.join(output_dir, 'bench.json')
+        bench = subprocess.run(
+            [sys.executable, 'bench.py', '--scenario', 'urlencoded',
+             '--requests', '2', '--concurrency', '1', '--alloc-samples', '1',
+             '--rt-latency', '0', '--recaptcha-latency', '0',
+             '--timeout', '60', '--output', output],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=120)
+        self.assertEqual(bench.returncode, 0, bench.stderr)
+        with open(output) as results:
+            result = json.load(results)['scenarios']['urlencoded']
+        self.assertEqual((result['requests'], result['errors']), (2, 0))
 
 
 if __name__ == '__main__':